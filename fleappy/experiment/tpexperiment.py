@@ -7,11 +7,11 @@ import fleappy.analysis
 from fleappy.metadata import TPMetadata
 from fleappy.experiment import BaseExperiment
 from fleappy.experiment import baselinefunctions
-from fleappy.roimanager import Roi
-from fleappy.roimanager import nproi, imagejroi
+from fleappy.imgregistration import stores
+from fleappy.roimanager import Roi, RoiSet
+from fleappy.roimanager import nproi, imagejroi, traces
 import natsort as ns
 import numpy as np
-import skimage.io as io
 from scipy.sparse import csr_matrix
 
 
@@ -27,7 +27,7 @@ class TPExperiment(BaseExperiment):
     __slots__ = ['roi']
 
     def __init__(self, path: str, expt_id: str, **kwargs):
-        self.roi = []
+        self.roi = RoiSet()
         BaseExperiment.__init__(self)
         self.metadata = TPMetadata(path=path, expt_id=expt_id)
 
@@ -45,8 +45,9 @@ class TPExperiment(BaseExperiment):
     def load_roi(self):
         """Load roi from tif filed.
 
-        Looks for rois in tif file in default path. If can not be found, looks for .zip file of ImageJ roi and converts 
-        them to a tif file. Loads each roi into experiment roi array.
+        Looks for rois in tif file in default path. If can not be found, looks for .zip file of ImageJ roi and
+        rasterizes them to sparse masks of the frame size of the registered images. Loads each roi into experiment roi
+        array.
 
         Raises:
             OSError: ROI files (.zip and .tif) are not available
@@ -55,58 +56,64 @@ class TPExperiment(BaseExperiment):
         slice_id = 'slice1'
         roi_path = self._roi_path(slice_id=slice_id)
         logging.debug(roi_path)
+        name_path = self._name_path(slice_id=slice_id)
         if roi_path.exists():
-            rois = nproi.load_from_file(roi_path)
+            masks = [csr_matrix(mask) for mask in nproi.load_from_file(roi_path)]
+            if name_path.exists():
+                roi_names = np.loadtxt(name_path, dtype=str, delimiter=';')
+            else:
+                roi_names = []
         else:
             zip_path = self._zip_path(slice_id=slice_id)
             if zip_path.exists():
-                imagejroi.zip_to_tif(str(zip_path), str(roi_path))
-                rois = nproi.load_from_file(roi_path)
+                roi_names, masks = imagejroi.zip_to_masks(zip_path, framesize=self._frame_size(slice_id))
             else:
                 raise OSError('ROI files could not be found!')
 
-        name_path = self._name_path(slice_id=slice_id)
-        if name_path.exists():
-            roi_names = np.loadtxt(name_path, dtype=str, delimiter=';')
-        else:
-            roi_names = []
-
-        for idx, mask in enumerate(rois):
+        for idx, mask in enumerate(masks):
             roi_name = roi_names[idx] if len(
-                roi_names) == rois.shape[0] else str(idx)
+                roi_names) == len(masks) else str(idx)
 
             roi = Roi(id=idx, name=roi_name, roi_type='primary',
-                      mask=csr_matrix(mask))
+                      mask=mask)
             if roi not in self.roi:
                 self.roi.append(roi)
             else:
                 logging.debug(
                     'ROI#{0} already exists, skipping...'.format(roi.id))
 
-    def load_ts_data(self):
+    def load_ts_data(self, channel: int = 1, workers: int = 1, chunk_frames: int = 500, dtype=np.float64):
         """Loads time series data based on the properties associated with the experiment.
 
-           Load time series for roi preloaded and tif files specified in the file directory.
+           Load time series for roi preloaded and tif files specified in the file directory. If the series was
+           registered with rois and no registered images were written, the time series extracted during registration
+           are loaded instead.
+
+        Args:
+            channel (int, optional): Defaults to 1. ScanImage channel the time series are loaded from, the channel the
+                rois were drawn on.
+            workers (int, optional): Defaults to 1. Number of worker processes reading the registered files.
+            chunk_frames (int, optional): Defaults to 500. Number of frames read at once by a worker.
+            dtype (type, optional): Defaults to numpy.float64. Data type of the time series, numpy.float32 halves the
+                memory used.
         """
 
         slice_id = 'slice1'
         tif_path = self._tif_path(slice_id)
         tif_files = ns.natsorted(
-            list(tif_path.glob('stack_*.tif')), alg=ns.PATH)
+            [path for path in tif_path.glob(f'stack_c{channel}_*') if path.suffix in stores.WRITERS], alg=ns.PATH)
         if len(self.roi) == 0:
             self.load_roi()
 
-        rois = np.empty(
-            (len(self.roi), self.roi[0].mask.shape[0], self.roi[0].mask.shape[1]), dtype=np.bool)
-        for idx, roi in enumerate(self.roi):
-            rois[idx, :, :] = roi.mask.todense()
-
-        ts_data = np.empty((len(self.roi), 0))
-
-        for ts_file in tif_files:
-            logging.debug('Loading file: {0}'.format(ts_file.name))
-            ts_temp = nproi.tseries_data(rois, io.imread(ts_file))
-            ts_data = np.concatenate((ts_data, ts_temp), axis=1)
+        if not tif_files and any(tif_path.glob(f'stack_c{channel}_*' + traces.TraceWriter.suffix)):
+            logging.debug('Loading time series extracted during registration from {0}'.format(tif_path))
+            ts_data = traces.read_traces(tif_path, channel=channel).astype(dtype, copy=False)
+            assert len(ts_data) == len(self.roi), 'Time series were extracted for other rois'
+        else:
+            weights = nproi.roi_weights([roi.mask for roi in self.roi], dtype=dtype)
+            logging.debug('Loading files: {0}'.format(', '.join(ts_file.name for ts_file in tif_files)))
+            ts_data = traces.extract_files(weights, tif_files, workers=workers, chunk_frames=chunk_frames,
+                                           dtype=dtype)
 
         for idx, data in enumerate(ts_data):
             self.roi[idx].ts_data['rawF'] = data
@@ -264,6 +271,13 @@ class TPExperiment(BaseExperiment):
     def _tif_path(self, slice_id=1):
         return Path(self.metadata.expt['path'], self.metadata.expt['expt_id'], f'Registered/{slice_id}/')
 
+    def _frame_size(self, slice_id=1):
+        template_path = self._tif_path(slice_id).joinpath('MasterTemplate.tif')
+        if template_path.exists():
+            return stores.read_stack(template_path).shape[-2:]
+        logging.warning('No registered template in {0}, using the default frame size'.format(template_path.parent))
+        return imagejroi.DEFAULT_FRAME_SIZE
+
     def _roi_path(self, slice_id=1):
         return Path(self.metadata.expt['path'], self.metadata.expt['expt_id'], f'Registered/{slice_id}_ROIs.tif')
 
@@ -3,4 +3,4 @@ name = 'imgregistration'
 from .imgregistration import ImageRegistration
 
 
-__all__ = ['imgregistration', 'templatematching', 'dftreg', 'templatematchpc', 'dummy']
+__all__ = ['imgregistration', 'templatematching', 'dftreg', 'templatematchpc', 'fftreg', 'dummy', 'parallel', 'prefetch', 'translate', 'tspec', 'piecewise', 'pyramid', 'checkpoint', 'stores', 'templates', 'quality', 'benchmark']
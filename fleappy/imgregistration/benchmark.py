@@ -0,0 +1,227 @@
+"""Speed and accuracy benchmark of the registration modules.
+
+Writes a synthetic ScanImage acquisition with known motion and line phase (see fleappy.tiffread.synthetic), registers
+it with every registration module through ImageRegistration.register, and reports for each module:
+
+* fps: Pages (all slices and channels) read, registered and written per second.
+* peak_rss: Peak resident memory in bytes of the process running the registration, and worker_peak_rss of its
+  largest worker process. Both are None where the platform does not report them.
+* shift_rms, shift_max: RMS and largest error in pixels of the estimated shifts, after removing the constant offset
+  between the template and the ground truth.
+* phase_rms: RMS error in pixels of the line phase offset for modules that estimate it, otherwise None.
+* quality_seconds: Time spent measuring the quality metrics of the registered frames (see quality), timed again on
+  the registered files after registration, and quality_fraction its share of the registration time.
+
+Every module runs in a fresh process so that peak memory is its own. Results are written as json together with the
+versions and settings they were measured with, for comparison between versions.
+
+Example:
+    Benchmark all modules on 2000 frames of 512 x 512 pixels:
+    ::code-block
+
+        $ python -m fleappy.imgregistration.benchmark --volumes 2000 --shape 512 512 --output benchmark.json
+"""
+
+import argparse
+import datetime
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from fleappy.tiffread import scanimage, siindex, synthetic
+
+BENCHMARK_VERSION = 1
+"""int: Version of the result file format."""
+
+MODULES = ('dummy', 'dftreg', 'fftreg', 'piecewise', 'templatematching', 'templatematchpc')
+"""tuple: Registration modules benchmarked by default, by name within fleappy.imgregistration."""
+
+logger = logging.getLogger(__name__)
+
+
+def run(directory=None, modules=MODULES, num_volumes: int = 1000, shape: tuple = (256, 256), slices: int = 1,
+        channels: tuple = (1,), chunksize: int = 500, workers: int = 1, output=None, seed: int = 0,
+        **series_kwargs) -> dict:
+    """Benchmark registration modules on a synthetic acquisition.
+
+    Args:
+        directory (Path, optional): Defaults to None and will use a temporary directory that is removed afterwards.
+            Directory to write the synthetic acquisition and registered images to.
+        modules (tuple, optional): Defaults to MODULES. Registration modules, by name within fleappy.imgregistration
+            or as module objects such as a PyramidModule.
+        num_volumes (int, optional): Defaults to 1000. Number of volumes acquired.
+        shape (tuple, optional): Defaults to (256, 256). Frame size (y, x).
+        slices (int, optional): Defaults to 1. Number of piezo slices.
+        channels (tuple, optional): Defaults to (1,). Saved channels.
+        chunksize (int, optional): Defaults to 500. Number of frames per registered batch.
+        workers (int, optional): Defaults to 1. Number of worker processes per registration.
+        output (Path, optional): Defaults to None. Json file to write the results to.
+        seed (int, optional): Defaults to 0. Seed of the synthetic acquisition.
+        **series_kwargs: Further arguments passed on to synthetic.make_series, e.g. max_shift or line_phase.
+
+    Returns:
+        dict: Benchmark results with the environment, the settings and a result for each module.
+    """
+
+    settings = dict(num_volumes=num_volumes, shape=list(shape), slices=slices, channels=list(channels),
+                    chunksize=chunksize, workers=workers, seed=seed, **series_kwargs)
+    with tempfile.TemporaryDirectory() as temp_directory:
+        directory = Path(temp_directory if directory is None else directory)
+        logger.info('Writing %i volumes of synthetic data to %s', num_volumes, directory)
+        truth = synthetic.make_series(directory, 'bench_', num_volumes, shape=shape, slices=slices, channels=channels,
+                                      seed=seed, **series_kwargs)
+        results = []
+        for reg_module in modules:
+            name = reg_module if isinstance(reg_module, str) else reg_module.__name__.split('.')[-1]
+            logger.info('Benchmarking %s', name)
+            result = {'module': name}
+            try:
+                # A fresh process per module, so that the peak memory is that of the module
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                    measured = executor.submit(_register, reg_module, str(directory), 'bench_', chunksize,
+                                               workers).result()
+            except Exception as err:  # pylint: disable=broad-except
+                logger.exception('Benchmark of %s failed', name)
+                result['error'] = f'{type(err).__name__}: {err}'
+                results.append(result)
+                continue
+            frames = num_volumes * slices * len(channels)
+            result.update(frames=frames, seconds=measured['seconds'], fps=frames / measured['seconds'],
+                          peak_rss=measured['peak_rss'], worker_peak_rss=measured['worker_peak_rss'],
+                          quality_seconds=measured['quality_seconds'],
+                          quality_fraction=measured['quality_seconds'] / measured['seconds'])
+            result.update(_accuracy(measured['transforms'], truth))
+            logger.info('%s: %.1f fps, shift error %.3f px', name, result['fps'], result['shift_rms'])
+            results.append(result)
+
+    report = {'benchmark_version': BENCHMARK_VERSION,
+              'created': datetime.datetime.now().isoformat(timespec='seconds'),
+              'environment': _environment(),
+              'settings': settings,
+              'results': results}
+    if output is not None:
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=2)
+    return report
+
+
+def main(argv: list = None) -> None:
+    """Command line entry point, see the module documentation."""
+
+    parser = argparse.ArgumentParser(description='Benchmark the registration modules on synthetic ScanImage data.')
+    parser.add_argument('--volumes', type=int, default=1000, help='number of volumes acquired')
+    parser.add_argument('--shape', type=int, nargs=2, default=(256, 256), help='frame size (y x)')
+    parser.add_argument('--slices', type=int, default=1, help='number of piezo slices')
+    parser.add_argument('--channels', type=int, nargs='+', default=(1,), help='saved channels')
+    parser.add_argument('--modules', nargs='+', default=MODULES, help='registration modules to benchmark')
+    parser.add_argument('--chunksize', type=int, default=500, help='number of frames per registered batch')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes per registration')
+    parser.add_argument('--max-shift', type=float, default=4.0, help='largest displacement in pixels')
+    parser.add_argument('--line-phase', type=float, default=1.5, help='line phase offset in pixels')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--directory', default=None, help='directory for the data, a temporary one if not given')
+    parser.add_argument('--output', default='benchmark.json', help='json file to write the results to')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    run(directory=args.directory, modules=tuple(args.modules), num_volumes=args.volumes, shape=tuple(args.shape),
+        slices=args.slices, channels=tuple(args.channels), chunksize=args.chunksize, workers=args.workers,
+        output=args.output, seed=args.seed, max_shift=args.max_shift, line_phase=args.line_phase)
+
+
+def _register(reg_module, directory: str, seriesname: str, chunksize: int, workers: int) -> dict:
+    """Worker: time the registration of the series and measure the peak memory of this process."""
+
+    # Imported here so that the registration modules are only loaded in the benchmark process
+    from fleappy.imgregistration.imgregistration import ImageRegistration  # pylint: disable=import-outside-toplevel
+
+    if isinstance(reg_module, str):
+        reg_module = importlib.import_module(f'fleappy.imgregistration.{reg_module}')
+    imgreg = ImageRegistration(reg_module=reg_module)
+    start = time.perf_counter()
+    imgreg.register(directory, seriesname, chunksize=chunksize, workers=workers, resume=False)
+    seconds = time.perf_counter() - start
+    peak_rss, worker_peak_rss = _peak_rss()
+    return {'seconds': seconds, 'peak_rss': peak_rss, 'worker_peak_rss': worker_peak_rss,
+            'quality_seconds': _quality_seconds(imgreg, directory, seriesname, chunksize),
+            'transforms': [np.asarray(imgreg.transform[seriesname][slice_id])
+                           for slice_id in sorted(imgreg.transform[seriesname])]}
+
+
+def _quality_seconds(imgreg, directory: str, seriesname: str, chunksize: int) -> float:
+    """Time the quality metrics of the registered reference channel, a batch at a time as during registration."""
+
+    # Imported here so that the registration modules are only loaded in the benchmark process
+    from fleappy.imgregistration import quality, stores  # pylint: disable=import-outside-toplevel
+
+    reference_channel = scanimage.channels(siindex.SIIndex(directory, seriesname).header)[0]
+    seconds = 0
+    for slice_id, transform_spec in sorted(imgreg.transform[seriesname].items()):
+        slice_path = Path(directory, seriesname, 'Registered', f'slice{slice_id + 1}')
+        template = stores.read_stack(slice_path.joinpath('IntermediateTemplate.tif'))[0]
+        with stores.open_registered(slice_path, reference_channel) as stack:
+            for batch_start in range(0, len(stack), chunksize):
+                corrected = stack[batch_start:batch_start + chunksize]
+                start = time.perf_counter()
+                quality.frame_metrics(template, corrected, transform_spec[batch_start:batch_start + len(corrected)])
+                seconds += time.perf_counter() - start
+    return seconds
+
+
+def _accuracy(transforms: list, truth: dict) -> dict:
+    """Shift and line phase errors of the transformations of every slice against the ground truth."""
+
+    shift_errors = []
+    phase_errors = []
+    for transform_spec in transforms:
+        error = transform_spec[:, 0:2] - truth['shifts'][:len(transform_spec)]
+        shift_errors.append(error - np.median(error, axis=0))
+        if transform_spec.shape[1] == 3:
+            phase_errors.append(transform_spec[:, 2] - truth['phase'])
+    shift_errors = np.concatenate(shift_errors, axis=0)
+    return {'shift_rms': float(np.sqrt(np.mean(np.sum(shift_errors ** 2, axis=1)))),
+            'shift_max': float(np.max(np.hypot(shift_errors[:, 0], shift_errors[:, 1]))),
+            'phase_rms': float(np.sqrt(np.mean(np.concatenate(phase_errors) ** 2))) if phase_errors else None}
+
+
+def _peak_rss() -> tuple:
+    """Returns the peak resident memory in bytes of this process and of its largest finished child process."""
+
+    try:
+        import resource  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return None, None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+def _environment() -> dict:
+    """Versions and machine the benchmark ran on."""
+
+    versions = {}
+    for package in ['numpy', 'scipy', 'cv2', 'skimage', 'tifffile', 'h5py']:
+        try:
+            versions[package] = importlib.import_module(package).__version__
+        except ImportError:
+            versions[package] = None
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'packages': versions}
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""Checkpoints of registration runs.
+
+A registration run writes a manifest for every batch once all of its registered stacks are on disk. The manifest
+lists the number of frames and the size and modification time of every stack written. Next to the manifests the
+checkpoint holds the transformations and quality metrics of each batch and slice, and the master and intermediate
+templates. The settings of the run (registration module and its settings, header hash, batch size, channels and
+slices) are stored as well. A checkpoint is only reused by a run with the same settings.
+
+On a rerun the batches are verified in order and registration continues with the first batch that is missing, changed
+on disk or, after files were appended to the series, no longer complete.
+
+Example:
+    Find where to continue a run:
+    ::code-block
+
+        $ checkpoint = Checkpoint(Path('run_/Registered/checkpoint'), settings)
+        $ batches_done = checkpoint.completed_batches(total_frames)
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+
+import numpy as np
+
+CHECKPOINT_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+class Checkpoint(object):
+    """Checkpoint of a registration run of one series.
+
+    Attributes:
+        path (Path): Checkpoint directory.
+        settings (dict): Settings of the run, a checkpoint written with other settings is discarded.
+        batch_size (int): Number of frames per batch.
+    """
+
+    __slots__ = ['path', 'settings', 'batch_size']
+
+    def __init__(self, path: Path, settings: dict, batch_size: int) -> None:
+        """Open the checkpoint in a directory, discarding it if it was written with other settings.
+
+        Args:
+            path (Path): Checkpoint directory, created if it does not exist.
+            settings (dict): JSON serializable settings of the run.
+            batch_size (int): Number of frames per batch.
+        """
+
+        self.path = Path(path)
+        self.settings = dict(settings, version=CHECKPOINT_VERSION, batch_size=batch_size)
+        self.batch_size = batch_size
+        self.path.mkdir(parents=True, exist_ok=True)
+        settings_file = self.path.joinpath('settings.json')
+        if settings_file.exists():
+            with open(settings_file, 'r') as file:
+                if json.load(file) == self.settings:
+                    return
+            logger.info('Settings changed, discarding checkpoint %s', self.path)
+        self.clear()
+
+    def clear(self) -> None:
+        """Discard all checkpointed batches and templates."""
+
+        for item in self.path.iterdir():
+            if item.is_file():
+                item.unlink()
+        with open(self.path.joinpath('settings.json'), 'w') as file:
+            json.dump(self.settings, file)
+
+    def completed_batches(self, total_frames: int, num_slices: int) -> int:
+        """Returns the number of leading batches that are complete and unchanged on disk.
+
+        Args:
+            total_frames (int): Number of frames in the series.
+            num_slices (int): Number of piezo slices, each needs a transformation per batch.
+
+        Returns:
+            int: Number of batches that need not be registered again.
+        """
+
+        if not self.path.joinpath('templates.npz').exists():
+            return 0
+        batch_num = 0
+        while batch_num * self.batch_size < total_frames:
+            expected_frames = min(self.batch_size, total_frames - batch_num * self.batch_size)
+            if not self._verify(batch_num, expected_frames, num_slices):
+                break
+            batch_num += 1
+        return batch_num
+
+    def transform_path(self, batch_num: int, slice_id: int) -> Path:
+        """File holding the transformations of a batch of a slice."""
+
+        return self.path.joinpath(f'batch{batch_num + 1:05d}_slice{slice_id + 1}.tspec')
+
+    def quality_path(self, batch_num: int, slice_id: int) -> Path:
+        """File holding the quality metrics of a batch of a slice."""
+
+        return self.path.joinpath(f'batch{batch_num + 1:05d}_slice{slice_id + 1}.quality.npz')
+
+    def save_templates(self, template: np.ndarray, intermediate_template: np.ndarray) -> None:
+        """Save the master template (y, x, slices) and intermediate templates (slices, y, x) of the run."""
+
+        with open(self.path.joinpath('templates.npz'), 'wb') as file:
+            np.savez(file, template=template, intermediate_template=intermediate_template)
+
+    def load_templates(self) -> tuple:
+        """Returns the master template and intermediate templates of the run."""
+
+        with np.load(self.path.joinpath('templates.npz'), allow_pickle=False) as archive:
+            return archive['template'], archive['intermediate_template']
+
+    def commit_batch(self, batch_num: int, num_frames: int, outputs: list) -> None:
+        """Record a batch as complete once its registered stacks are written.
+
+        Args:
+            batch_num (int): Number of the batch, from 0.
+            num_frames (int): Number of frames in the batch.
+            outputs (list): Paths of the registered stacks written for the batch.
+        """
+
+        files = []
+        for output in outputs:
+            stat = os.stat(output)
+            files.append({'path': str(output), 'size': stat.st_size, 'mtime': stat.st_mtime_ns})
+        manifest_path = self._manifest_path(batch_num)
+        temp_path = manifest_path.with_suffix('.tmp')
+        with open(temp_path, 'w') as file:
+            json.dump({'batch': batch_num, 'frames': num_frames, 'outputs': files}, file)
+        os.replace(temp_path, manifest_path)
+
+    def _manifest_path(self, batch_num: int) -> Path:
+        return self.path.joinpath(f'batch{batch_num + 1:05d}.json')
+
+    def _verify(self, batch_num: int, expected_frames: int, num_slices: int) -> bool:
+        """Check that a batch is complete, holds the expected frames and its files are unchanged."""
+
+        manifest_path = self._manifest_path(batch_num)
+        if not manifest_path.exists():
+            return False
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+        if manifest['frames'] != expected_frames:
+            return False
+        if not all(self.transform_path(batch_num, slice_id).exists() and self.quality_path(batch_num, slice_id).exists()
+                   for slice_id in range(num_slices)):
+            return False
+        for output in manifest['outputs']:
+            try:
+                stat = os.stat(output['path'])
+            except FileNotFoundError:
+                return False
+            if stat.st_size != output['size'] or stat.st_mtime_ns != output['mtime']:
+                return False
+        return True
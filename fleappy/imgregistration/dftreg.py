@@ -1,8 +1,8 @@
 from skimage.feature import register_translation
 import numpy as np
 import cv2
-from scipy.ndimage.interpolation import shift
 from pathlib import Path
+from . import translate, tspec
 
 
 def register(avg_img, tiff_stack):
@@ -27,22 +27,19 @@ def register(avg_img, tiff_stack):
     return transform_spec
 
 
-def transform(img_stack, transform_spec):
+def transform(img_stack, transform_spec, out=None):
     """Applies (y,x) translation to a series of images
 
     Args:
-        img_stack (numpy array):  Uncorrected tiff stack (z, y, x)
-        transform_spec (numpy array): Shifts to be applied to tiff stack in format (frameNum, (y,x))
+        img_stack (numpy.ndarray):  Uncorrected tiff stack (z, y, x)
+        transform_spec (numpy.ndarray): Shifts to be applied to tiff stack in format (frameNum, (y,x))
+        out (numpy.ndarray, optional): Defaults to None. Buffer (z, y, x) to write the corrected stack into.
 
     Returns:
         numpy.ndarray: Motion corrected tiff stack (z, y, x)
     """
 
-    z, w, h = img_stack.shape
-    registered = np.zeros((z, w, h))
-    for idx, frame in enumerate(img_stack):
-        registered[idx, :, :] = shift(frame, transform_spec[idx, :])
-    return registered.astype(np.int16)
+    return translate.apply_shifts(img_stack, transform_spec[:, 0:2], out=out, dtype=np.int16)
 
 
 def join(transform_list, transform_spec):
@@ -61,7 +58,7 @@ def join(transform_list, transform_spec):
 
     if transform_list is None:
         return transform_spec
-    elif isinstance(transform_list. np.ndarray) and transform_list.shape[1] == 2:
+    elif isinstance(transform_list, np.ndarray) and transform_list.shape[1] == 2:
         return np.concatenate((transform_list, transform_spec), axis=0)
     else:
         raise ValueError('The transform list isn\'t a numpy array of dimensions (n,2)!')
@@ -71,23 +68,24 @@ def save(transform_list, target: Path):
     """Write the list of transformations to a file.
 
     Args:
-        transform_list ([type]): [description]
-        target (Path): [description]
+        transform_list (numpy.ndarray): List of transformations.
+        target (Path): File to write transformations to.
     """
 
-    np.savetxt(target, np.squeeze(transform_list), delimiter=',', fmt='%.3f', header=__name__)
+    tspec.write(target, transform_list, __name__)
 
 
-def load():
+def load(source):
     """Load frame by frame transformations from file.
 
-    TODO:
-        * Implement dftreg file loading.
+    Args:
+        source (Path): File to read transformations from.
 
-    Raises:
-        NotImplementedError: File loading is not yet supported
+    Returns:
+        numpy.ndarray: Frame by frame transformations (n, 2).
     """
-    raise NotImplementedError('Transformation loading is not yet implemented.')
+
+    return tspec.read(source, module_name=__name__)
 
 
 def create_template(img_stack):
@@ -1,26 +1,31 @@
 from pathlib import Path
 import numpy as np
+from . import tspec
 
 
 def register(avg_img, tiff_stack):
-    return []
+    return np.zeros((len(tiff_stack), 2))
 
 
-def transform(img_stack, transform_spec):
-
-    return img_stack
+def transform(img_stack, transform_spec, out=None):
+    if out is not None:
+        out[:] = img_stack
+        return out
+    return np.array(img_stack)
 
 
 def join(transform_list, transform_spec):
-    pass
+    if transform_list is None:
+        return transform_spec
+    return np.concatenate((transform_list, transform_spec), axis=0)
 
 
 def save(transform_list, target: Path):
-    pass
+    tspec.write(target, transform_list, __name__)
 
 
-def load():
-    pass
+def load(source):
+    return tspec.read(source, module_name=__name__)
 
 
 def create_template(img_stack):
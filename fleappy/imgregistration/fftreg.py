@@ -0,0 +1,234 @@
+"""Batched phase correlation registration.
+
+Estimates translations for whole blocks of frames at once. The template spectrum is computed once per call, every
+block of frames is transformed with a single stacked real FFT, and the peak of each frame's phase correlation is
+refined to sub-pixel precision with a batched upsampled DFT around the integer peak (Guizar-Sicairos et al., 2008).
+Memory use is bounded by the block size rather than the length of the stack.
+"""
+
+import numpy as np
+
+from . import translate, tspec
+
+
+def register(avg_img, tiff_stack, maxmovement=10, upsample_factor=10, block_size=64, smooth_sigma=1.5):
+    """ Register time series tiff using batched phase correlation.
+
+    Returns the transform_spec, translational shifts in (y,x) that move each frame onto the template. Frames and
+    template are mean subtracted and tapered towards the border to suppress edge effects, and the phase correlation is
+    smoothed with a gaussian to reduce high frequency noise.
+
+    Args:
+        avg_img (numpy.ndarray (y,x)): Template image to register to
+        tiff_stack (numpy.ndarray (z,y,x)): Tiff stack to register
+        maxmovement (int, optional): Defaults to 10. Largest shift searched for in pixels, None to search the whole
+            frame.
+        upsample_factor (int, optional): Defaults to 10. Shifts are estimated to 1/upsample_factor of a pixel.
+        block_size (int, optional): Defaults to 64. Number of frames transformed at once, bounds memory use.
+        smooth_sigma (float, optional): Defaults to 1.5. Width in pixels of the gaussian smoothing applied to the
+            phase correlation, 0 to disable.
+
+    Returns:
+        transform_spec (numpy.ndarray float (z, 2)): translation pixel shifts (y,x) to register tiff_stack
+    """
+
+    shape_y, shape_x = avg_img.shape
+    taper = _taper(shape_y, shape_x)
+    template_fft = np.conj(np.fft.rfft2(_apodize(avg_img, taper)))
+    smoothing = _gaussian_filter(shape_y, shape_x, smooth_sigma)
+
+    transform_spec = np.zeros((tiff_stack.shape[0], 2))
+    for block_start in range(0, tiff_stack.shape[0], block_size):
+        block = _apodize(tiff_stack[block_start:block_start + block_size], taper)
+        cross_power = np.fft.rfft2(block) * template_fft
+        cross_power *= smoothing / (np.abs(cross_power) + np.finfo(np.float32).eps)
+        peaks = _integer_peaks(cross_power, maxmovement, (shape_y, shape_x))
+        if upsample_factor > 1:
+            peaks = _refine_peaks(cross_power, peaks, upsample_factor, (shape_y, shape_x))
+        transform_spec[block_start:block_start + len(block), :] = -peaks
+
+    return transform_spec
+
+
+def transform(img_stack, transform_spec, out=None):
+    """Applies (y,x) translation to a series of images
+
+    Args:
+        img_stack (numpy.ndarray):  Uncorrected tiff stack (z, y, x)
+        transform_spec (numpy.ndarray): Shifts to be applied to tiff stack in format (frameNum, (y,x))
+        out (numpy.ndarray, optional): Defaults to None. Buffer (z, y, x) to write the corrected stack into.
+
+    Returns:
+        numpy.ndarray: Motion corrected tiff stack (z, y, x)
+    """
+
+    return translate.apply_shifts(img_stack, transform_spec[:, 0:2], out=out, dtype=np.int16)
+
+
+def join(transform_list, transform_spec):
+    """Appends the next set of transformations to a previous set.
+
+    Args:
+        transform_list (numpy.ndarray): Next set of frame by frame transformations.
+        transform_spec (numpy.ndarray): Previous frame by frame transformations.
+
+    Raises:
+        ValueError: If the new transform_list isn't of a (n,2) numpy array.
+
+    Returns:
+        numpy.ndarray: Joined transformation specification.
+    """
+
+    if transform_list is None:
+        return transform_spec
+    elif isinstance(transform_list, np.ndarray) and transform_list.shape[1] == 2:
+        return np.concatenate((transform_list, transform_spec), axis=0)
+    else:
+        raise ValueError('The transform list isn\'t a numpy array of dimensions (n,2)!')
+
+
+def save(transform_list, target):
+    """Write the list of transformations to a file.
+
+    Args:
+        transform_list (numpy.ndarray): List of transformations.
+        target (Path): File to write transformations to.
+    """
+
+    tspec.write(target, transform_list, __name__)
+
+
+def load(source):
+    """Load frame by frame transformations from file.
+
+    Args:
+        source (Path): File to read transformations from.
+
+    Returns:
+        numpy.ndarray: Frame by frame transformations (n, 2).
+    """
+
+    return tspec.read(source, module_name=__name__)
+
+
+def create_template(img_stack):
+    """Creates a template from the image stack.
+
+    Args:
+        img_stack (numpy.ndarray): image stack (t, y, x)
+
+    Returns:
+        numpy.ndarray: Mean Image
+    """
+
+    return np.mean(img_stack, axis=0, dtype=np.float64)
+
+
+def _taper(shape_y: int, shape_x: int, slope: float = 3.0, border: float = 0.1) -> np.ndarray:
+    """Returns a mask that falls off smoothly (sigmoid) over the outer border fraction of the frame."""
+
+    def edge(length):
+        distance = np.abs(np.arange(length) - (length - 1) / 2)
+        return 1 / (1 + np.exp((distance - (length - 1) / 2 + border * length) / slope))
+
+    return np.outer(edge(shape_y), edge(shape_x)).astype(np.float32)
+
+
+def _apodize(img_stack, taper: np.ndarray) -> np.ndarray:
+    """Mean subtract and taper images (..., y, x) as float32."""
+
+    img_stack = np.asarray(img_stack, dtype=np.float32)
+    return (img_stack - img_stack.mean(axis=(-2, -1), keepdims=True)) * taper
+
+
+def _gaussian_filter(shape_y: int, shape_x: int, sigma: float) -> np.ndarray:
+    """Returns the rfft2 of a normalized gaussian kernel of width sigma."""
+
+    freq_y = np.fft.fftfreq(shape_y)[:, np.newaxis]
+    freq_x = np.fft.rfftfreq(shape_x)[np.newaxis, :]
+    return np.exp(-2 * (np.pi * sigma) ** 2 * (freq_y ** 2 + freq_x ** 2)).astype(np.float32)
+
+
+def _integer_peaks(cross_power: np.ndarray, maxmovement, shape: tuple) -> np.ndarray:
+    """Find the integer location of the correlation peak of every frame.
+
+    When the search is limited by maxmovement only the correlation within the search window is evaluated, which is
+    cheaper than an inverse FFT of the whole frame.
+
+    Args:
+        cross_power (numpy.ndarray): Half spectrum cross power (z, y, x//2+1).
+        maxmovement (int): Largest shift to consider, None for the whole frame.
+        shape (tuple): Shape of the frames (y, x).
+
+    Returns:
+        numpy.ndarray: Signed peak locations (z, 2) in (y,x).
+    """
+
+    shape_y, shape_x = shape
+    if maxmovement is None:
+        offsets_y = np.fft.ifftshift(np.arange(shape_y) - shape_y // 2)
+        offsets_x = np.fft.ifftshift(np.arange(shape_x) - shape_x // 2)
+        correlation = np.fft.irfft2(cross_power, s=shape)
+    else:
+        offsets_y = np.arange(-min(maxmovement, shape_y // 2), min(maxmovement, (shape_y - 1) // 2) + 1)
+        offsets_x = np.arange(-min(maxmovement, shape_x // 2), min(maxmovement, (shape_x - 1) // 2) + 1)
+        correlation = _correlate_at(cross_power, offsets_y, offsets_x, shape)
+    flat_peaks = np.argmax(correlation.reshape(len(cross_power), -1), axis=1)
+    peak_y, peak_x = np.unravel_index(flat_peaks, correlation.shape[1:])
+    return np.stack((offsets_y[peak_y], offsets_x[peak_x]), axis=1).astype(np.float64)
+
+
+def _refine_peaks(cross_power: np.ndarray, peaks: np.ndarray, upsample_factor: int, shape: tuple) -> np.ndarray:
+    """Refine integer peaks by evaluating the correlation on an upsampled grid around each peak.
+
+    Args:
+        cross_power (numpy.ndarray): Half spectrum cross power (z, y, x//2+1).
+        peaks (numpy.ndarray): Integer peak locations (z, 2).
+        upsample_factor (int): Upsampling factor.
+        shape (tuple): Shape of the frames (y, x).
+
+    Returns:
+        numpy.ndarray: Sub-pixel peak locations (z, 2).
+    """
+
+    window = int(np.ceil(upsample_factor * 1.5))
+    grid = (np.arange(window) - window // 2) / upsample_factor
+    sample_y = peaks[:, 0, np.newaxis] + grid[np.newaxis, :]
+    sample_x = peaks[:, 1, np.newaxis] + grid[np.newaxis, :]
+    upsampled = _correlate_at(cross_power, sample_y, sample_x, shape)
+
+    flat_peaks = np.argmax(upsampled.reshape(len(peaks), -1), axis=1)
+    peak_y, peak_x = np.unravel_index(flat_peaks, (window, window))
+    return peaks + np.stack((grid[peak_y], grid[peak_x]), axis=1)
+
+
+def _correlate_at(cross_power: np.ndarray, sample_y: np.ndarray, sample_x: np.ndarray, shape: tuple) -> np.ndarray:
+    """Evaluate the correlation on a grid of (possibly fractional) shifts.
+
+    The correlation is computed directly from the half (rfft) spectrum with two batched matrix products (a matrix
+    multiply DFT), which is much cheaper than an inverse FFT when only a small window is needed.
+
+    Args:
+        cross_power (numpy.ndarray): Half spectrum cross power (z, y, x//2+1).
+        sample_y (numpy.ndarray): Row shifts to evaluate, (n,) shared by all frames or (z, n) per frame.
+        sample_x (numpy.ndarray): Column shifts to evaluate, (m,) shared by all frames or (z, m) per frame.
+        shape (tuple): Shape of the frames (y, x).
+
+    Returns:
+        numpy.ndarray: Real valued correlation (z, n, m).
+    """
+
+    shape_y, shape_x = shape
+
+    # Hermitian weights so that the half spectrum sums to the real valued full correlation
+    weights = np.full(cross_power.shape[-1], 2.0)
+    weights[0] = 1
+    if shape_x % 2 == 0:
+        weights[-1] = 1
+
+    freq_y = np.fft.fftfreq(shape_y)
+    freq_x = np.fft.rfftfreq(shape_x)
+    kernel_y = np.exp(2j * np.pi * sample_y[..., :, np.newaxis] * freq_y)
+    kernel_x = np.exp(2j * np.pi * freq_x[:, np.newaxis] * sample_x[..., np.newaxis, :])
+    kernel_x *= weights[:, np.newaxis]
+    return np.matmul(np.matmul(kernel_y, cross_power), kernel_x).real
@@ -15,14 +15,18 @@ Returns:
 """
 import logging
 from pathlib import Path
-import math
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import imageio
 import numpy as np
 import skimage.io as io
 from collections import defaultdict
-from fleappy.tiffread import scanimage
-from . import templatematching, templatematchpc, dftreg
+from fleappy.roimanager import traces
+from fleappy.tiffread import scanimage, siindex, siseries
+from . import templatematching, templatematchpc, dftreg, checkpoint, parallel, prefetch, quality, stores, templates
 
 logger = logging.getLogger(__name__)
 
@@ -38,9 +42,10 @@ class ImageRegistration:
         template (numpy.ndarray): Template image to register to.
         reference (str): Reference time series to register all other time series to.
         directory (dict): Dictionary of paths for time series.
+        quality (dict): Per frame quality metrics (frames, 3) of each slice of the registered time series, see quality.
     """
 
-    __slots__ = ['reg_module', 'files', 'transform', 'template', 'reference', 'directory']
+    __slots__ = ['reg_module', 'files', 'transform', 'template', 'reference', 'directory', 'quality']
 
     def __init__(self, reg_module=templatematchpc, template=None) -> None:
         for attr in ['register', 'transform', 'join', 'save', 'load', 'create_template']:
@@ -52,8 +57,12 @@ class ImageRegistration:
         self.template = template
         self.reference = None
         self.directory = {}
+        self.quality = {}
 
-    def register(self, directory: str, seriesname: str, referenceseries=None, chunksize=2000) -> None:
+    def register(self, directory: str, seriesname: str, referenceseries=None, chunksize=2000, prefetch_depth=2,
+                 prefetch_bytes=None, write_depth=2, write_bytes=None, workers=1, chunk_frames=250, index=None,
+                 progress=None, reference_channel=None, resume=True, output='.tif', template_frames=None,
+                 template_iterations=0, rois=None) -> None:
         """ Register a collection of files.
 
         Given a directory and a series name, collect all the files with that series name and register them. This
@@ -64,8 +73,13 @@ class ImageRegistration:
 
         *./<seriesname>/<piezo slice #>/stack_c<channel #>_<file #>.tif*
 
-        Todo:
-            * Multiple Channel Support
+        or with the suffix of the output format chosen, see stores. If rois are given no registered images are
+        written, only the time series of the rois extracted from the corrected frames in memory, which are read back
+        with fleappy.roimanager.traces.read_traces.
+
+        Shifts are estimated on a single structural channel and applied to every saved channel while the frames are in
+        memory. The quality of every registered frame is measured on the corrected frames and saved as quality.npz
+        next to the transformations, with a summary logged for every batch.
 
         Args:
             directory (str): Directory with images to register
@@ -74,118 +88,228 @@ class ImageRegistration:
                 to register to.
             chunksize (int, optional): Defaults to 2000. Number of frames to include in the output file. Increasing
                 this number may result in larger RAM usage.
+            prefetch_depth (int, optional): Defaults to 2. Number of files read ahead on a background thread while
+                the current batch is registered.
+            prefetch_bytes (int, optional): Defaults to None. Maximum number of bytes held by files read ahead.
+            write_depth (int, optional): Defaults to 2. Number of registered stacks queued for writing on a
+                background thread.
+            write_bytes (int, optional): Defaults to None. Maximum number of bytes queued for writing.
+            workers (int, optional): Defaults to 1. Number of worker processes. With more than one worker every batch
+                is split into (slice, chunk) work units that are registered in parallel, results are identical to a
+                serial run.
+            chunk_frames (int, optional): Defaults to 250. Maximum number of frames in a parallel work unit.
+            index (SIIndex, optional): Defaults to None. Index of the series files, built (or loaded from its sidecar)
+                if not given.
+            progress (function, optional): Defaults to None. Called with the number of frames registered after every
+                batch.
+            reference_channel (int, optional): Defaults to None and will use the first saved channel. ScanImage number
+                of the channel used to estimate the shifts.
+            resume (bool, optional): Defaults to True. Continue a previous run of the series from its checkpoint,
+                skipping batches that are complete and unchanged on disk. Files appended to the series since are
+                registered as well. If False the checkpoint is discarded and all batches are registered again.
+            output (str or writer, optional): Defaults to '.tif'. Format of the registered images, '.tif' for
+                uncompressed tif files or '.h5' for chunked, compressed HDF5 files, or a writer object (see stores).
+            template_frames (int, optional): Defaults to None and will use the frames of the first batch. Number of
+                frames at the start of the series the template of each slice is created from.
+            template_iterations (int, optional): Defaults to 0. Largest number of iterations refining the template of
+                each slice on blocks of frames sampled across the whole series, see templates.
+            rois (list, optional): Defaults to None and will write the registered images. Rois of each piezo slice,
+                a list of masks (e.g. Roi.mask) or weights from nproi.roi_weights, whose time series are written as
+                stack_c<channel #>_<file #>.npz instead of the registered images. output is ignored.
 
         Returns:
             None
         """
 
         # Collect Files
-        files = _collect_files(directory, seriesname)
+        if index is None:
+            index = siindex.SIIndex(directory, seriesname)
+        files = index.files
+        assert len(files) > 0, f'No files found for {seriesname} in {directory}'
         self.files[seriesname] = [str(x.absolute()) for x in files]
         self.directory[seriesname] = directory
         logging.info('Search %s and found %s files', directory, len(files))
         self.transform[seriesname] = defaultdict(lambda: None)
+        self.quality[seriesname] = defaultdict(list)
 
-        # Load first file, parse headers, figure out how to load files to meet the chunk size
-        logging.info('Loading...%s', files[0].name)
-        tif_stack, header = scanimage.read_si_tiffstack(
-            files[0], header_only=False)
-        frames_per_file = scanimage.frames_per_file(header)
+        # Parse headers, figure out how to batch files to meet the chunk size
+        header = index.header
         num_slices = scanimage.piezo_slices(header)
         channels = scanimage.channels(header)
         num_channels = len(channels)
-        total_approximate_frames = len(files) * frames_per_file
+        if reference_channel is None:
+            reference_channel = channels[0]
+        assert reference_channel in channels, f'Channel {reference_channel} was not saved, saved {list(channels)}'
+        reference_idx = list(channels).index(reference_channel)
+        channel_offsets = [channel_idx - reference_idx for channel_idx in range(num_channels)]
+        total_frames = index.total_frames
         batch_chunk_size = chunksize * num_slices * num_channels
-        logging.info('\nAligning using %s\n %i Slices \n %i Channels\n %i Frame Batch Size \n %i Total Frames Expected',
-                     self.reg_module.__name__, num_slices, num_channels, batch_chunk_size, total_approximate_frames)
-
-        # Prepare Attributes
-        _, shape_y, shape_x = tif_stack.shape
-        if self.template is None:
-            self.template = np.empty(
-                (shape_y, shape_x, num_slices), dtype=np.float)
-            self.template[:] = np.nan
-            self.reference = seriesname
+        logging.info('\nAligning using %s\n %i Slices \n %i Channels\n %i Frame Batch Size \n %i Total Frames',
+                     self.reg_module.__name__, num_slices, num_channels, batch_chunk_size, total_frames)
 
-        intermediate_template = np.empty(
-            (num_slices, shape_y, shape_x), dtype=np.float)
         for slice_id in range(num_slices):
             target_path = Path(directory + '/' + seriesname +
                                '/Registered/slice' + str(slice_id + 1))
             if not target_path.exists():
                 target_path.mkdir(parents=True)
 
-        for batch_num in range(math.ceil(total_approximate_frames / batch_chunk_size)):
-             # Start Loading Files
-            batch_start_index = batch_num * batch_chunk_size
-            batch_stop_index = (batch_num + 1) * batch_chunk_size - 1
-            if batch_stop_index > total_approximate_frames-1:
-                batch_stop_index = total_approximate_frames-1
-            logging.info('Batch %i to %i', batch_start_index, batch_stop_index)
-            file_start = math.floor((batch_start_index)/frames_per_file)
-            if len(tif_stack) is not 0:
-                file_start = file_start + 1
-            file_end = math.floor(batch_stop_index/frames_per_file)
-
-            for file_num in range(file_start, file_end+1, 1):
-                if file_num > len(files):
-                    break
-                logging.info('Loading... %s', files[file_num].name)
-                file_stack, _ = scanimage.read_si_tiffstack(
-                    files[file_num], header_only=False)
-                if len(tif_stack) is not 0:
-                    tif_stack = np.concatenate((tif_stack, file_stack), axis=0)
-                else:
-                    tif_stack = file_stack
-
-            tif_start_idx = batch_start_index % frames_per_file
-            tif_stop_idx = tif_start_idx+batch_chunk_size
-
-            if tif_stop_idx > tif_stack.shape[0]:
-                tif_stop_idx = tif_stack.shape[0]
-
-            register_stack = tif_stack[tif_start_idx:tif_stop_idx, :, :]
-            tif_stack = tif_stack[tif_stop_idx+1:, :, :]
-            logger.info('Loaded Frames for Batch Register: %i: %i of %i',
-                        tif_start_idx, tif_stop_idx - 1, register_stack.shape[0])
-
-            # Register tif stack based on channel and piezo slice
-            channel = 1
-            for slice_id in range(num_slices):
-                slice_start_idx = slice_id * num_channels
-                # Either generate the template or use the previous template to generate an intermediate template
+        if rois is not None:
+            assert len(rois) == num_slices, f'Need rois for each of the {num_slices} slices'
+            slice_writers = [traces.TraceWriter(slice_rois) for slice_rois in rois]
+        else:
+            slice_writers = [stores.make_writer(output)] * num_slices
+        output_suffix = slice_writers[0].suffix
+
+        # Continue from the checkpoint of a previous run
+        settings = {'module': self.reg_module.__name__, 'header_hash': index.entries[0]['header_hash'],
+                    'channels': [int(channel) for channel in channels], 'reference_channel': int(reference_channel),
+                    'slices': num_slices, 'output': output_suffix, 'template_frames': template_frames,
+                    'template_iterations': template_iterations}
+        if rois is not None:
+            settings['rois'] = [slice_writer.digest() for slice_writer in slice_writers]
+        if hasattr(self.reg_module, 'settings'):
+            settings['module_settings'] = self.reg_module.settings()
+        run_checkpoint = checkpoint.Checkpoint(Path(directory + '/' + seriesname + '/Registered/checkpoint'),
+                                               settings, batch_chunk_size)
+        batches_done = run_checkpoint.completed_batches(total_frames, num_slices) if resume else 0
+        intermediate_template = None
+        if batches_done > 0:
+            template, intermediate_template = run_checkpoint.load_templates()
+            if self.template is not None and not np.array_equal(self.template, template, equal_nan=True):
+                logger.info('Template changed, registering %s from the start', seriesname)
+                batches_done = 0
+                intermediate_template = None
+        if batches_done == 0:
+            run_checkpoint.clear()
+        else:
+            if self.template is None:
+                self.template = template
+                self.reference = seriesname
+            for batch_num in range(batches_done):
+                for slice_id in range(num_slices):
+                    self.transform[seriesname][slice_id] = self.reg_module.join(
+                        self.transform[seriesname][slice_id],
+                        self.reg_module.load(run_checkpoint.transform_path(batch_num, slice_id)))
+                    self.quality[seriesname][slice_id].append(
+                        quality.read(run_checkpoint.quality_path(batch_num, slice_id)))
+            logger.info('Resuming %s after %i completed batches', seriesname, batches_done)
+            if progress is not None:
+                progress(min(batches_done * batch_chunk_size, total_frames))
+
+        # Templates from the start of the series, refined on frames sampled across the whole series
+        projections = None
+        if batches_done == 0 and (template_frames is not None or template_iterations > 0):
+            projections = []
+            with index.open_series() as series:
+                for slice_id in range(num_slices):
+                    plane = series.view(slice_id, reference_channel)
+                    projection = self.reg_module.create_template(plane[:template_frames or chunksize])
+                    if template_iterations > 0:
+                        projection = templates.refine(self.reg_module, plane, initial=projection,
+                                                      iterations=template_iterations)
+                    projections.append(projection)
+
+        start_frame = batches_done * batch_chunk_size
+        file_start, skip = index.locate(start_frame) if start_frame < total_frames else (len(files), 0)
+        reader = prefetch.PrefetchReader(files[file_start:], _read_frames, depth=prefetch_depth,
+                                         max_bytes=prefetch_bytes)
+        writer = prefetch.WriteBehind(_write_with, depth=write_depth, max_bytes=write_bytes)
+        pool = parallel.RegistrationPool(self.reg_module, workers, chunk_frames=chunk_frames) if workers > 1 else None
+
+        try:
+            batches = prefetch.iter_batches(reader, batch_chunk_size, skip=skip,
+                                            total_frames=total_frames - index.file_start(file_start))
+            for batch_num, register_stack in enumerate(batches, start=batches_done):
+                batch_start_index = batch_num * batch_chunk_size
+                logging.info('Batch %i to %i', batch_start_index, batch_start_index + len(register_stack) - 1)
+
+                # Prepare Attributes
+                if batch_num == 0:
+                    _, shape_y, shape_x = register_stack.shape
+                    if self.template is None:
+                        self.template = np.empty(
+                            (shape_y, shape_x, num_slices), dtype=np.float)
+                        self.template[:] = np.nan
+                        self.reference = seriesname
+                    intermediate_template = np.empty(
+                        (num_slices, shape_y, shape_x), dtype=np.float)
+
+                # Register tif stack based on channel and piezo slice
+                for slice_id in range(num_slices):
+                    slice_start_idx = slice_id * num_channels + reference_idx
+                    # Either generate the template or use the previous template to generate an intermediate template
+                    if batch_num == 0:
+                        if projections is not None:
+                            projection = projections[slice_id]
+                        else:
+                            projection = self.reg_module.create_template(
+                                register_stack[slice_start_idx::num_slices * num_channels, :, :])
+                        if np.isnan(self.template[:, :, slice_id]).any():
+                            self.template[:, :, slice_id] = projection
+                            intermediate_template[slice_id, :, :] = self.template[:, :, slice_id].astype(
+                                np.float)
+                            logger.info('Creating New Template for %i', slice_id+1)
+                        else:
+                            transform_spec = self.reg_module.register(
+                                np.squeeze(self.template[:, :, slice_id]),
+                                projection[np.newaxis, :, :])
+                            intermediate_template[slice_id, :, :] = self.reg_module.transform(
+                                projection[np.newaxis, :, :].astype(np.float), transform_spec)
+                            logger.info('Using Old Template for %i', slice_id+1)
                 if batch_num == 0:
-                    projection = self.reg_module.create_template(register_stack
-                                                                 [slice_start_idx::num_slices * num_channels, :, :])
-                    if np.isnan(self.template[:, :, slice_id]).any():
-                        self.template[:, :, slice_id] = projection
-                        intermediate_template[slice_id, :, :] = self.template[:, :, slice_id].astype(
-                            np.float)
-                        logger.info('Creating New Template for %i', slice_id+1)
+                    run_checkpoint.save_templates(self.template, intermediate_template)
+
+                if pool is not None:
+                    results = pool.register_batch(register_stack, list(intermediate_template),
+                                                  [slice_id * num_channels + reference_idx
+                                                   for slice_id in range(num_slices)],
+                                                  num_slices * num_channels, channel_offsets=channel_offsets)
+
+                outputs = []
+                for slice_id in range(num_slices):
+                    slice_start_idx = slice_id * num_channels
+                    if pool is not None:
+                        transform_spec, corrected = results[slice_id]
                     else:
                         transform_spec = self.reg_module.register(
-                            np.squeeze(self.template[:, :, slice_id]),
-                            projection[np.newaxis, :, :])
-                        intermediate_template[slice_id, :, :] = self.reg_module.transform(
-                            projection[np.newaxis, :, :].astype(np.float), transform_spec)
-                        logger.info('Using Old Template for %i', slice_id+1)
-                transform_spec = self.reg_module.register(
-                    np.squeeze(intermediate_template[slice_id, :, :]),
-                    register_stack[slice_start_idx:: num_slices * num_channels, :, :])
-
-                corrected = self.reg_module.transform(
-                    register_stack[slice_start_idx:: num_slices * num_channels, :, :], transform_spec)
-
-                # Write the file and save the transform
-                filename = 'stack_c{0}_{1}.tif'.format(channel, batch_num+1)
-                logger.info('writing to File: %s', filename)
-                target_path = Path(
-                    directory + '/' + seriesname + '/Registered/slice' + str(slice_id + 1))
-                _write_tiff(corrected, target_path.joinpath(filename))
-
-                self.transform[seriesname][slice_id] = self.reg_module.join(
-                    self.transform[seriesname][slice_id], transform_spec)
-                logging.info(self.transform[seriesname][slice_id].shape)
+                            np.squeeze(intermediate_template[slice_id, :, :]),
+                            register_stack[slice_start_idx + reference_idx:: num_slices * num_channels, :, :])
+
+                        corrected = [self.reg_module.transform(
+                            register_stack[slice_start_idx + channel_idx:: num_slices * num_channels, :, :],
+                            transform_spec) for channel_idx in range(num_channels)]
+
+                    # Write the files and save the transform
+                    target_path = Path(
+                        directory + '/' + seriesname + '/Registered/slice' + str(slice_id + 1))
+                    for channel, channel_stack in zip(channels, corrected):
+                        filename = 'stack_c{0}_{1}{2}'.format(channel, batch_num+1, output_suffix)
+                        logger.info('writing to File: %s', filename)
+                        writer.submit(channel_stack, (slice_writers[slice_id], target_path.joinpath(filename)))
+                        outputs.append(target_path.joinpath(filename))
+
+                    self.reg_module.save(transform_spec, run_checkpoint.transform_path(batch_num, slice_id))
+                    self.transform[seriesname][slice_id] = self.reg_module.join(
+                        self.transform[seriesname][slice_id], transform_spec)
+                    logging.info(self.transform[seriesname][slice_id].shape)
+
+                    # Measure how well the frames match the template
+                    metrics = quality.frame_metrics(intermediate_template[slice_id, :, :], corrected[reference_idx],
+                                                    transform_spec)
+                    quality.write(run_checkpoint.quality_path(batch_num, slice_id), metrics)
+                    self.quality[seriesname][slice_id].append(metrics)
+                    logger.info('Batch %i slice %i quality: %s', batch_num + 1, slice_id + 1, quality.summary(metrics))
+                writer.after(functools.partial(run_checkpoint.commit_batch, batch_num, len(register_stack), outputs))
+                if progress is not None:
+                    progress(len(register_stack))
+        finally:
+            reader.close()
+            writer.close()
+            for slice_writer in dict.fromkeys(slice_writers):
+                if slice_writer is not output:
+                    slice_writer.close()
+            if pool is not None:
+                pool.close()
 
         # Save the transform and template
         for slice_id in range(num_slices):
@@ -197,39 +321,259 @@ class ImageRegistration:
                         target_path.joinpath('IntermediateTemplate.tif'))
             self.reg_module.save(
                 self.transform[seriesname][slice_id], target_path.joinpath('transform.tspec'))
+            self.quality[seriesname][slice_id] = np.concatenate(self.quality[seriesname][slice_id], axis=0)
+            quality.write(target_path.joinpath('quality.npz'), self.quality[seriesname][slice_id])
             scanimage.to_json(header, target_path.joinpath('header.json'))
         return None
 
-    def batch_register(self, directory: str, serieslist: list, referenceseries: str = None) -> None:
-        """Batch registration of multiple time series.
+    def apply(self, directory: str, seriesname: str, chunksize=2000, transform_directory: str = None,
+              prefetch_depth=2, prefetch_bytes=None, write_depth=2, write_bytes=None, index=None,
+              output='.tif') -> None:
+        """ Apply saved transformations to a collection of files.
+
+        Recreates the registered images of a series from the transform files written by register without estimating
+        any transformation, so the cost is reading, shifting and writing the images. The transformation of a slice is
+        applied to every saved channel and registered images are written to the same locations as by register.
+
+        Args:
+            directory (str): Directory with images to register
+            seriesname (str): Name of the series of data. Should follow format '<series>*.tif'
+            chunksize (int, optional): Defaults to 2000. Number of frames to include in the output file.
+            transform_directory (str, optional): Defaults to None and will use '<directory>/<seriesname>/Registered'.
+                Directory with a slice<#>/transform.tspec file for each piezo slice.
+            prefetch_depth (int, optional): Defaults to 2. Number of files read ahead on a background thread.
+            prefetch_bytes (int, optional): Defaults to None. Maximum number of bytes held by files read ahead.
+            write_depth (int, optional): Defaults to 2. Number of registered stacks queued for writing.
+            write_bytes (int, optional): Defaults to None. Maximum number of bytes queued for writing.
+            index (SIIndex, optional): Defaults to None. Index of the series files, built (or loaded from its sidecar)
+                if not given.
+            output (str or writer, optional): Defaults to '.tif'. Format of the registered images, see register.
+
+        Raises:
+            ValueError: If the number of transformations of a slice does not match the number of frames.
+
+        Returns:
+            None
+        """
+
+        if index is None:
+            index = siindex.SIIndex(directory, seriesname)
+        files = index.files
+        assert len(files) > 0, f'No files found for {seriesname} in {directory}'
+        if transform_directory is None:
+            transform_directory = directory + '/' + seriesname + '/Registered'
+        self.files[seriesname] = [str(x.absolute()) for x in files]
+        self.directory[seriesname] = directory
+
+        header = index.header
+        num_slices = scanimage.piezo_slices(header)
+        channels = scanimage.channels(header)
+        num_channels = len(channels)
+        period = num_slices * num_channels
+        batch_chunk_size = chunksize * period
 
+        self.transform[seriesname] = defaultdict(lambda: None)
+        for slice_id in range(num_slices):
+            transform_spec = self.reg_module.load(
+                Path(transform_directory).joinpath('slice' + str(slice_id + 1), 'transform.tspec'))
+            num_frames = len(range(slice_id * num_channels, index.total_frames, period))
+            if len(transform_spec) != num_frames:
+                raise ValueError(f'Slice {slice_id + 1} of {seriesname} has {num_frames} frames but '
+                                 f'{len(transform_spec)} transformations')
+            self.transform[seriesname][slice_id] = transform_spec
+            target_path = Path(directory + '/' + seriesname + '/Registered/slice' + str(slice_id + 1))
+            if not target_path.exists():
+                target_path.mkdir(parents=True)
+        logging.info('Applying %s transformations to %i frames', self.reg_module.__name__, index.total_frames)
+
+        output_writer = stores.make_writer(output)
+        reader = prefetch.PrefetchReader(files, _read_frames, depth=prefetch_depth, max_bytes=prefetch_bytes)
+        writer = prefetch.WriteBehind(output_writer.write, depth=write_depth, max_bytes=write_bytes)
+        try:
+            batches = prefetch.iter_batches(reader, batch_chunk_size, total_frames=index.total_frames)
+            for batch_num, register_stack in enumerate(batches):
+                for slice_id in range(num_slices):
+                    target_path = Path(directory + '/' + seriesname + '/Registered/slice' + str(slice_id + 1))
+                    num_frames = len(range(slice_id * num_channels, len(register_stack), period))
+                    transform_spec = self.transform[seriesname][slice_id][batch_num * chunksize:][:num_frames]
+                    for channel_idx, channel in enumerate(channels):
+                        slice_stack = register_stack[slice_id * num_channels + channel_idx::period, :, :]
+                        corrected = self.reg_module.transform(slice_stack, transform_spec)
+
+                        filename = 'stack_c{0}_{1}{2}'.format(channel, batch_num+1, output_writer.suffix)
+                        logger.info('writing to File: %s', filename)
+                        writer.submit(corrected, target_path.joinpath(filename))
+        finally:
+            reader.close()
+            writer.close()
+            if output_writer is not output:
+                output_writer.close()
+        return None
 
-        TODO:
-            * Batch register
+    def watch(self, directory: str, seriesname: str, template_frames=1000, chunksize=None, poll_interval=10.0,
+              idle_timeout=300.0, stop=None, **kwargs) -> None:
+        """ Register a series while it is being acquired.
+
+        Follows the files of a series as ScanImage writes them and registers every file once it is complete, so that
+        registered images and transformations are on disk shortly after the acquisition ends. A file is complete once
+        ScanImage has started the next file of the series. The last file is complete once it has not changed for
+        idle_timeout seconds, which also ends the acquisition. The template of each slice is created from the first
+        template_frames frames of the series and kept for the whole acquisition. Every registration continues from
+        the checkpoint of the previous one, see register.
+
+        Args:
+            directory (str): Directory the series is acquired to.
+            seriesname (str): Name of the series of data. Should follow format '<series>*.tif'
+            template_frames (int, optional): Defaults to 1000. Number of frames at the start of the series the
+                template of each slice is created from. Registration starts once they have been acquired.
+            chunksize (int, optional): Defaults to None and will use the number of frames in a file, so that every
+                complete file is registered as one batch. Number of frames to include in the output file.
+            poll_interval (float, optional): Defaults to 10. Seconds between checks of the directory for new files.
+            idle_timeout (float, optional): Defaults to 300. Seconds without changes to the last file after which the
+                acquisition is taken to have ended.
+            stop (threading.Event, optional): Defaults to None. Event to stop watching early, files completed so far
+                are registered before returning.
+            **kwargs: Further arguments passed on to register.
+
+        Returns:
+            None
+        """
+
+        index = siindex.SIIndex(directory, seriesname, update=False)
+        last_state = None
+        last_change = time.monotonic()
+        registered = None
+        while True:
+            stopped = stop is not None and stop.is_set()
+            files = siseries.find_series_files(directory, seriesname)
+            state = [(path.name, path.stat().st_size, path.stat().st_mtime_ns) for path in files[-1:]]
+            if state != last_state:
+                last_state = state
+                last_change = time.monotonic()
+            finished = len(files) > 0 and time.monotonic() - last_change >= idle_timeout
+            complete = files if finished else files[:-1]
+
+            if [path.name for path in complete] != registered and len(complete) > 0:
+                index.update(files=complete)
+                num_planes = scanimage.piezo_slices(index.header) * len(scanimage.channels(index.header))
+                if finished or stopped or index.total_frames >= template_frames * num_planes:
+                    if chunksize is None:
+                        chunksize = max(1, index.entries[0]['pages'] // num_planes)
+                    logger.info('Registering %i complete files of %s', len(complete), seriesname)
+                    self.register(directory, seriesname, chunksize=chunksize, index=index,
+                                  template_frames=template_frames, resume=True, **kwargs)
+                    registered = [path.name for path in complete]
+            if finished or stopped:
+                logger.info('Stopped watching %s after %i files', seriesname, len(registered or []))
+                return None
+            if stop is not None:
+                stop.wait(poll_interval)
+            else:
+                time.sleep(poll_interval)
+
+    def batch_register(self, directory: str, serieslist: list, referenceseries: str = None, max_concurrent=2,
+                       workers=1, prefetch_bytes=None, write_bytes=None, **kwargs) -> None:
+        """Batch registration of multiple time series.
+
+        The reference series is registered first to create the template, the remaining series are then registered to
+        that shared template concurrently, largest first. File indexes and headers are built once for every series
+        before registration starts. The worker processes and byte limits are a budget for the whole batch and are
+        divided between the series that run at the same time, progress is logged over the total number of frames.
 
         Args:
-             directory (str): Directory with images to register
+            directory (str): Directory with images to register
             serieslist (list): List of the names of the time series to register. Should follow format '<series>*.tif'
-            referenceseries (str, optional): Defaults to None and will use the current series. Name of the series
-                to register to.
+            referenceseries (str, optional): Defaults to None and will use the first series of serieslist. Name of the
+                series to register to. Ignored if the template has already been set.
+            max_concurrent (int, optional): Defaults to 2. Maximum number of series registered at the same time.
+            workers (int, optional): Defaults to 1. Total number of worker processes for the batch.
+            prefetch_bytes (int, optional): Defaults to None. Total number of bytes held by files read ahead.
+            write_bytes (int, optional): Defaults to None. Total number of bytes queued for writing.
+            **kwargs: Further arguments passed on to register.
 
         Raises:
-            NotImplementedError: [description]
+            RuntimeError: If any of the series failed to register.
 
         Returns:
-            None: [description]
+            None
         """
 
-        raise NotImplementedError('Batch register is not yet implemented')
+        assert max_concurrent > 0, 'Need to register at least one series at a time'
+        serieslist = list(serieslist)
+        if self.template is None and referenceseries is None:
+            assert len(serieslist) > 0, 'No series to register'
+            referenceseries = serieslist[0]
+
+        indexes = {}
+        for seriesname in serieslist + ([referenceseries] if self.template is None else []):
+            if seriesname not in indexes:
+                indexes[seriesname] = siindex.SIIndex(directory, seriesname)
+        tracker = _BatchProgress(sum(index.total_frames for index in indexes.values()))
+
+        remaining = list(dict.fromkeys(serieslist))
+        if self.template is None:
+            logger.info('Registering reference series %s', referenceseries)
+            self.register(directory, referenceseries, workers=workers, prefetch_bytes=prefetch_bytes,
+                          write_bytes=write_bytes, index=indexes[referenceseries], progress=tracker.update, **kwargs)
+            remaining = [seriesname for seriesname in remaining if seriesname != referenceseries]
+        remaining.sort(key=lambda seriesname: indexes[seriesname].total_frames, reverse=True)
+        if not remaining:
+            return None
+
+        concurrent = min(max_concurrent, len(remaining))
+        limits = dict(workers=max(1, workers // concurrent),
+                      prefetch_bytes=None if prefetch_bytes is None else prefetch_bytes // concurrent,
+                      write_bytes=None if write_bytes is None else write_bytes // concurrent)
+        logger.info('Registering %i series, %i at a time', len(remaining), concurrent)
+
+        failed = []
+        with ThreadPoolExecutor(max_workers=concurrent) as executor:
+            futures = {executor.submit(self.register, directory, seriesname, index=indexes[seriesname],
+                                       progress=tracker.update, **limits, **kwargs): seriesname
+                       for seriesname in remaining}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    logger.info('Finished registering %s', futures[future])
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('Failed registering %s', futures[future])
+                    failed.append(futures[future])
+        if failed:
+            raise RuntimeError(f'Failed registering {", ".join(failed)}')
+        return None
+
+
+class _BatchProgress(object):
+    """Thread safe count of frames registered over a batch of series."""
+
+    __slots__ = ['total_frames', 'frames_done', '_lock']
+
+    def __init__(self, total_frames: int) -> None:
+        self.total_frames = total_frames
+        self.frames_done = 0
+        self._lock = threading.Lock()
+
+    def update(self, num_frames: int) -> None:
+        with self._lock:
+            self.frames_done += num_frames
+            logger.info('Batch progress: %i of %i frames (%.1f%%)', self.frames_done, self.total_frames,
+                        100 * self.frames_done / max(1, self.total_frames))
 
 
 def _collect_files(pathname, seriesname) -> list:
-    pth = Path(pathname)
-    assert pth.exists(), 'Unknown Path!'
+    return siseries.find_series_files(pathname, seriesname)
+
+
+def _read_frames(path_name) -> np.ndarray:
+    with scanimage.open_si_tiffstack(path_name) as stack:
+        return stack.read()
+
 
-    tiffs = pth.glob('{0}*.tif'.format(seriesname))
+def _write_with(img_stack, target) -> None:
+    """Write a stack with the writer it was submitted with, target is (writer, path_name)."""
 
-    return list(tiffs)
+    slice_writer, path_name = target
+    slice_writer.write(img_stack, path_name)
 
 
 def _write_tiff(img_stack, path_name) -> None:
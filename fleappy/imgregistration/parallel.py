@@ -0,0 +1,160 @@
+"""Process pool registration of image batches.
+
+Registering frames against a fixed template is independent from frame to frame, so a batch is split into (piezo slice,
+frame chunk) work units that are registered and transformed on a pool of worker processes. Modules that estimate
+something per block of consecutive frames declare the block size as FRAME_BLOCK (see templatematchpc), and work units
+are a multiple of it so that blocks start at the same frames as in a serial run. Frame data is exchanged through shared
+memory and never pickled, only the (small) templates and transform specifications are sent between processes. Transform
+specifications are reassembled in frame order, so the output matches a serial run.
+
+Example:
+    Register a batch with 8 workers:
+    ::code-block
+
+        $ with RegistrationPool(templatematching, workers=8) as pool:
+        $     results = pool.register_batch(register_stack, templates, slice_offsets, period)
+"""
+
+import importlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from types import ModuleType
+
+import numpy as np
+
+from fleappy.tiffread.sharedstack import SharedStack, pool_context
+
+logger = logging.getLogger(__name__)
+
+
+class RegistrationPool(object):
+    """Pool of worker processes registering (slice, chunk) work units.
+
+    Attributes:
+        reg_module (module): Registration module with register and transform methods.
+        workers (int): Number of worker processes.
+        chunk_frames (int): Maximum number of frames per work unit, a multiple of the module's FRAME_BLOCK.
+    """
+
+    __slots__ = ['reg_module', 'workers', 'chunk_frames', '_executor', '_input', '_output', '_output_dtype']
+
+    def __init__(self, reg_module, workers: int, chunk_frames: int = 250) -> None:
+        self.reg_module = reg_module
+        self.workers = workers
+        frame_block = getattr(reg_module, 'FRAME_BLOCK', 1)
+        self.chunk_frames = -(-chunk_frames // frame_block) * frame_block
+        self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=pool_context())
+        self._input = None
+        self._output = None
+        self._output_dtype = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def register_batch(self, register_stack: np.ndarray, templates: list, slice_offsets: list, period: int,
+                       channel_offsets: list = None) -> list:
+        """Register and transform the interleaved slices of a batch.
+
+        Slice i of the batch is register_stack[slice_offsets[i]::period] and is registered to templates[i]. The
+        transformation of a slice is applied to the frames at each of the channel_offsets relative to the slice.
+
+        Args:
+            register_stack (numpy.ndarray): Interleaved batch of frames (pages, y, x).
+            templates (list): Template image (y, x) for each slice.
+            slice_offsets (list): Page offset of each slice in the batch.
+            period (int): Number of pages between consecutive frames of a slice.
+            channel_offsets (list, optional): Defaults to None and will only transform the registered frames. Page
+                offsets relative to the slice offset of the channels to transform.
+
+        Returns:
+            list: (transform_spec, corrected) tuple for each slice, corrected is a list with a stack for each channel
+                offset.
+        """
+
+        if channel_offsets is None:
+            channel_offsets = [0]
+        if self._output_dtype is None:
+            self._output_dtype = _output_dtype(self.reg_module, templates[0], register_stack[slice_offsets[0]])
+        source = self._buffer('_input', register_stack.shape, register_stack.dtype)
+        target = self._buffer('_output', register_stack.shape, self._output_dtype)
+        source.array[:len(register_stack)] = register_stack
+
+        module = _module_reference(self.reg_module)
+        futures = []
+        for slice_idx, offset in enumerate(slice_offsets):
+            num_frames = len(range(offset, len(register_stack), period))
+            for chunk_start in range(0, num_frames, self.chunk_frames):
+                chunk_stop = min(chunk_start + self.chunk_frames, num_frames)
+                futures.append((slice_idx, self._executor.submit(
+                    _register_unit, module, templates[slice_idx], source, target,
+                    offset + chunk_start * period, offset + chunk_stop * period, period, channel_offsets)))
+
+        transform_specs = [[] for _ in slice_offsets]
+        for slice_idx, future in futures:
+            transform_specs[slice_idx].append(future.result())
+
+        results = []
+        for slice_idx, offset in enumerate(slice_offsets):
+            if transform_specs[slice_idx]:
+                transform_spec = np.concatenate(transform_specs[slice_idx], axis=0)
+            else:
+                transform_spec = self.reg_module.register(templates[slice_idx], register_stack[offset::period])
+            corrected = [np.array(target.array[offset + channel_offset:len(register_stack):period])
+                         for channel_offset in channel_offsets]
+            results.append((transform_spec, corrected))
+        return results
+
+    def close(self) -> None:
+        """Shut down the worker processes and free shared memory."""
+
+        self._executor.shutdown()
+        for attr in ['_input', '_output']:
+            if getattr(self, attr) is not None:
+                getattr(self, attr).close()
+                setattr(self, attr, None)
+
+    def _buffer(self, attr: str, shape: tuple, dtype) -> SharedStack:
+        """Returns a shared buffer at least as large as shape, reallocating only when it needs to grow."""
+
+        buffer = getattr(self, attr)
+        if buffer is None or buffer.shape[0] < shape[0] or buffer.shape[1:] != tuple(shape[1:]) or \
+                buffer.dtype != np.dtype(dtype):
+            if buffer is not None:
+                buffer.close()
+            buffer = SharedStack(shape, dtype)
+            setattr(self, attr, buffer)
+        return buffer
+
+
+def _output_dtype(reg_module, template: np.ndarray, frame: np.ndarray) -> np.dtype:
+    """Data type the registration module's transform returns, found by registering a single frame."""
+
+    frame = np.array(frame)[np.newaxis, :, :]
+    return np.asarray(reg_module.transform(frame, reg_module.register(template, frame))).dtype
+
+
+def _module_reference(reg_module):
+    """Modules are not picklable, so they are sent to the workers by name."""
+
+    if isinstance(reg_module, ModuleType):
+        return reg_module.__name__
+    return reg_module
+
+
+def _register_unit(module, template: np.ndarray, source: SharedStack, target: SharedStack, start: int, stop: int,
+                   step: int, channel_offsets: list) -> np.ndarray:
+    """Worker: register frames start:stop:step of the shared batch and transform them at each channel offset."""
+
+    reg_module = importlib.import_module(module) if isinstance(module, str) else module
+    try:
+        transform_spec = reg_module.register(template, source.array[start:stop:step])
+        for channel_offset in channel_offsets:
+            channel_frames = slice(start + channel_offset, stop + channel_offset, step)
+            reg_module.transform(source.array[channel_frames], transform_spec, out=target.array[channel_frames])
+    finally:
+        source.close()
+        target.close()
+    return transform_spec
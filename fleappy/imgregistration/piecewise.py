@@ -0,0 +1,243 @@
+"""Piecewise rigid registration.
+
+Frames are split into a grid of overlapping patches and a translation is estimated for every patch. The rigid shift of
+the whole frame is estimated first by phase correlation (see fftreg), the shift of each patch is then searched for in a
+small window around it. All patches of a block of frames are transformed with a single stacked real FFT. To transform
+a frame the patch shifts are interpolated bilinearly between the patch centers to a smooth shift field.
+
+The transform_spec of a frame holds, in order: the rigid shift (y,x), the patch grid (rows, columns) and patch size
+(y,x), followed by the shift (y,x) of every patch in row major order. Frames whose patches all move with the rigid
+shift are transformed with a plain translation.
+
+Example:
+    Register with 96 pixel patches:
+    ::code-block
+
+        $ transform_spec = piecewise.register(template, tiff_stack, patch_size=96)
+        $ registered = piecewise.transform(tiff_stack, transform_spec)
+"""
+# pylint: disable=protected-access
+
+import numpy as np
+
+from . import fftreg, pyramid, translate, tspec
+
+
+def register(avg_img, tiff_stack, patch_size=128, overlap=0.25, maxmovement=10, max_deviation=3, upsample_factor=10,
+             block_size=16, smooth_sigma=1.5, pyramid_levels=0):
+    """ Register time series tiff using piecewise rigid phase correlation.
+
+    Args:
+        avg_img (numpy.ndarray (y,x)): Template image to register to
+        tiff_stack (numpy.ndarray (z,y,x)): Tiff stack to register
+        patch_size (int, optional): Defaults to 128. Size in pixels of the square patches, limited to the frame size.
+        overlap (float, optional): Defaults to 0.25. Fraction of a patch overlapping its neighbours.
+        maxmovement (int, optional): Defaults to 10. Largest rigid shift searched for in pixels.
+        max_deviation (int, optional): Defaults to 3. Largest deviation in pixels of a patch from the rigid shift.
+        upsample_factor (int, optional): Defaults to 10. Shifts are estimated to 1/upsample_factor of a pixel.
+        block_size (int, optional): Defaults to 16. Number of frames transformed at once, bounds memory use.
+        smooth_sigma (float, optional): Defaults to 1.5. Width in pixels of the gaussian smoothing applied to the
+            phase correlation, 0 to disable.
+        pyramid_levels (int, optional): Defaults to 0. Number of pyramid levels used to estimate the rigid shift coarse
+            to fine, see pyramid.
+
+    Returns:
+        transform_spec (numpy.ndarray float (z, 6 + 2 * patches)): rigid shift, patch grid and patch shifts to register
+            tiff_stack
+    """
+
+    shape_y, shape_x = avg_img.shape
+    starts_y, patch_y = _patch_starts(shape_y, patch_size, overlap)
+    starts_x, patch_x = _patch_starts(shape_x, patch_size, overlap)
+    num_patches = len(starts_y) * len(starts_x)
+
+    transform_spec = np.zeros((tiff_stack.shape[0], 6 + 2 * num_patches))
+    transform_spec[:, 0:2] = pyramid.register(fftreg, avg_img, tiff_stack, levels=pyramid_levels,
+                                              maxmovement=maxmovement, upsample_factor=upsample_factor, block_size=64,
+                                              smooth_sigma=smooth_sigma)
+    transform_spec[:, 2:6] = (len(starts_y), len(starts_x), patch_y, patch_x)
+
+    taper = fftreg._taper(patch_y, patch_x)
+    template_patches = _patches(avg_img[np.newaxis, :, :], starts_y, starts_x, patch_y, patch_x)
+    template_fft = np.conj(np.fft.rfft2(fftreg._apodize(template_patches, taper)))
+    smoothing = fftreg._gaussian_filter(patch_y, patch_x, smooth_sigma)
+    offsets = np.arange(-max_deviation, max_deviation + 1)
+
+    for block_start in range(0, tiff_stack.shape[0], block_size):
+        block = tiff_stack[block_start:block_start + block_size]
+        patches = fftreg._apodize(_patches(block, starts_y, starts_x, patch_y, patch_x), taper)
+        cross_power = np.fft.rfft2(patches) * template_fft
+        cross_power *= smoothing / (np.abs(cross_power) + np.finfo(np.float32).eps)
+        cross_power = cross_power.reshape((-1,) + cross_power.shape[2:])
+
+        # Search each patch in a window around the rigid displacement of its frame
+        centers = np.repeat(np.round(-transform_spec[block_start:block_start + len(block), 0:2]), num_patches, axis=0)
+        correlation = fftreg._correlate_at(cross_power, centers[:, 0:1] + offsets, centers[:, 1:2] + offsets,
+                                           (patch_y, patch_x))
+        peak_y, peak_x = np.unravel_index(np.argmax(correlation.reshape(len(centers), -1), axis=1),
+                                          correlation.shape[1:])
+        peaks = centers + np.stack((offsets[peak_y], offsets[peak_x]), axis=1)
+        if upsample_factor > 1:
+            peaks = fftreg._refine_peaks(cross_power, peaks, upsample_factor, (patch_y, patch_x))
+        transform_spec[block_start:block_start + len(block), 6:] = -peaks.reshape(len(block), -1)
+
+    return transform_spec
+
+
+def transform(img_stack, transform_spec, out=None, block_size=16):
+    """Applies the piecewise rigid transformation to a series of images
+
+    Args:
+        img_stack (numpy.ndarray):  Uncorrected tiff stack (z, y, x)
+        transform_spec (numpy.ndarray): Transformations to be applied to tiff stack as returned by register.
+        out (numpy.ndarray, optional): Defaults to None. Buffer (z, y, x) to write the corrected stack into.
+        block_size (int, optional): Defaults to 16. Number of non-rigid frames corrected at once.
+
+    Returns:
+        numpy.ndarray: Motion corrected tiff stack (z, y, x)
+    """
+
+    if out is None:
+        out = np.empty(img_stack.shape, dtype=np.int16)
+    transform_spec = np.asarray(transform_spec, dtype=np.float64)
+    grid_y, grid_x, patch_y, patch_x = transform_spec[0, 2:6].astype(int)
+    patch_shifts = transform_spec[:, 6:].reshape(-1, grid_y, grid_x, 2)
+
+    is_rigid = np.abs(patch_shifts - transform_spec[:, np.newaxis, np.newaxis, 0:2]).max(axis=(1, 2, 3)) < 1e-6
+    rigid_frames = np.flatnonzero(is_rigid)
+    if len(rigid_frames) == len(img_stack):
+        return translate.apply_shifts(img_stack, transform_spec[:, 0:2], out=out)
+    if len(rigid_frames) > 0:
+        out[rigid_frames] = translate.apply_shifts(img_stack[rigid_frames], transform_spec[rigid_frames, 0:2],
+                                                   dtype=out.dtype)
+
+    shape_y, shape_x = img_stack.shape[1:]
+    weights_y = _interpolation_weights(shape_y, _patch_starts(shape_y, patch_y, 0, grid_y)[0] + (patch_y - 1) / 2)
+    weights_x = _interpolation_weights(shape_x, _patch_starts(shape_x, patch_x, 0, grid_x)[0] + (patch_x - 1) / 2)
+    warped_frames = np.flatnonzero(~is_rigid)
+    for block_start in range(0, len(warped_frames), block_size):
+        frames = warped_frames[block_start:block_start + block_size]
+        field_y = np.matmul(np.matmul(weights_y, patch_shifts[frames, :, :, 0]), weights_x.T)
+        field_x = np.matmul(np.matmul(weights_y, patch_shifts[frames, :, :, 1]), weights_x.T)
+        out[frames] = translate._cast(_remap(img_stack[frames], field_y, field_x), out.dtype)
+    return out
+
+
+def join(transform_list, transform_spec):
+    """Appends the next set of transformations to a previous set.
+
+    Args:
+        transform_list (numpy.ndarray): Next set of frame by frame transformations.
+        transform_spec (numpy.ndarray): Previous frame by frame transformations.
+
+    Raises:
+        ValueError: If the new transform_list isn't a numpy array with the same patch grid.
+
+    Returns:
+        numpy.ndarray: Joined transformation specification.
+    """
+
+    if transform_list is None:
+        return transform_spec
+    elif isinstance(transform_list, np.ndarray) and transform_list.shape[1] == transform_spec.shape[1]:
+        return np.concatenate((transform_list, transform_spec), axis=0)
+    else:
+        raise ValueError('The transform list isn\'t a numpy array with the same patch grid!')
+
+
+def save(transform_list, target):
+    """Write the list of transformations to a file.
+
+    Args:
+        transform_list (numpy.ndarray): List of transformations.
+        target (Path): File to write transformations to.
+    """
+
+    tspec.write(target, transform_list, __name__)
+
+
+def load(source):
+    """Load frame by frame transformations from file.
+
+    Args:
+        source (Path): File to read transformations from.
+
+    Returns:
+        numpy.ndarray: Frame by frame transformations (n, 6 + 2 * patches).
+    """
+
+    return tspec.read(source, module_name=__name__)
+
+
+def create_template(img_stack):
+    """Creates a template from the image stack.
+
+    Args:
+        img_stack (numpy.ndarray): image stack (t, y, x)
+
+    Returns:
+        numpy.ndarray: Mean Image
+    """
+
+    return np.mean(img_stack, axis=0, dtype=np.float64)
+
+
+def _patch_starts(length: int, patch_size: int, overlap: float, num_patches: int = None) -> tuple:
+    """Returns the start of every patch along one axis, evenly spaced to cover the axis, and the patch size."""
+
+    patch_size = min(int(patch_size), length)
+    if num_patches is None:
+        stride = max(1, int(round(patch_size * (1 - overlap))))
+        num_patches = int(np.ceil((length - patch_size) / stride)) + 1
+    return np.round(np.linspace(0, length - patch_size, num_patches)).astype(int), patch_size
+
+
+def _patches(img_stack, starts_y: np.ndarray, starts_x: np.ndarray, patch_y: int, patch_x: int) -> np.ndarray:
+    """Cut a stack (z, y, x) into patches (z, patches, patch_y, patch_x) in row major order."""
+
+    return np.stack([img_stack[:, start_y:start_y + patch_y, start_x:start_x + patch_x]
+                     for start_y in starts_y for start_x in starts_x], axis=1)
+
+
+def _interpolation_weights(length: int, centers: np.ndarray) -> np.ndarray:
+    """Linear interpolation matrix (length, centers) from values at the patch centers to every pixel.
+
+    Values beyond the outermost centers are held constant.
+    """
+
+    weights = np.zeros((length, len(centers)))
+    if len(centers) == 1:
+        weights[:] = 1
+        return weights
+    position = np.interp(np.arange(length), centers, np.arange(len(centers)))
+    lower = np.minimum(np.floor(position).astype(int), len(centers) - 2)
+    fraction = position - lower
+    weights[np.arange(length), lower] = 1 - fraction
+    weights[np.arange(length), lower + 1] = fraction
+    return weights
+
+
+def _remap(img_stack, field_y: np.ndarray, field_x: np.ndarray) -> np.ndarray:
+    """Shift every pixel of a stack by a shift field with bilinear interpolation, outside pixels are 0."""
+
+    num_frames, shape_y, shape_x = img_stack.shape
+    flat = np.asarray(img_stack, dtype=np.float32).reshape(num_frames, -1)
+    source_y = np.arange(shape_y, dtype=np.float32)[np.newaxis, :, np.newaxis] - field_y.astype(np.float32)
+    source_x = np.arange(shape_x, dtype=np.float32)[np.newaxis, np.newaxis, :] - field_x.astype(np.float32)
+    floor_y = np.floor(source_y)
+    floor_x = np.floor(source_x)
+    fraction_y = source_y - floor_y
+    fraction_x = source_x - floor_x
+    floor_y = floor_y.astype(np.intp)
+    floor_x = floor_x.astype(np.intp)
+
+    remapped = np.zeros((num_frames, shape_y, shape_x), dtype=np.float32)
+    for step_y, weight_y in ((0, 1 - fraction_y), (1, fraction_y)):
+        for step_x, weight_x in ((0, 1 - fraction_x), (1, fraction_x)):
+            pixel_y = floor_y + step_y
+            pixel_x = floor_x + step_x
+            inside = (pixel_y >= 0) & (pixel_y < shape_y) & (pixel_x >= 0) & (pixel_x < shape_x)
+            pixels = (np.clip(pixel_y, 0, shape_y - 1) * shape_x + np.clip(pixel_x, 0, shape_x - 1))
+            values = np.take_along_axis(flat, pixels.reshape(num_frames, -1), axis=1).reshape(pixels.shape)
+            remapped += np.where(inside, values * weight_y * weight_x, 0)
+    return remapped
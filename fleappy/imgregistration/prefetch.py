@@ -0,0 +1,306 @@
+"""Background reading and writing of image stacks.
+
+Reading, registering and writing a batch otherwise happen strictly in sequence. The classes here move the file I/O onto
+worker threads so that decoding the next file and writing the previous batch overlap with registration. Both queues are
+bounded in number of items and, optionally, in bytes held. `iter_batches` cuts the files read into fixed size batches.
+
+Example:
+    Read files ahead and write results behind:
+    ::code-block
+
+        $ with PrefetchReader(files, read_func, depth=2) as reader, WriteBehind(write_func) as writer:
+        $     for file_path, img_stack in reader:
+        $         writer.submit(process(img_stack), target)
+"""
+
+import logging
+import os
+import threading
+from collections import deque
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class _BoundedQueue(object):
+    """FIFO queue bounded by number of items and total bytes.
+
+    A single item larger than the byte cap is still accepted when the queue is empty so that it can not deadlock.
+    """
+
+    __slots__ = ['depth', 'max_bytes', '_items', '_bytes', '_closed', '_condition']
+
+    def __init__(self, depth: int, max_bytes: int = None) -> None:
+        assert depth > 0, 'Queue depth must be at least 1'
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self._items = deque()
+        self._bytes = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def put(self, item, nbytes: int = 0) -> bool:
+        with self._condition:
+            while not self._closed and self._items and self._is_full(nbytes):
+                self._condition.wait()
+            if self._closed:
+                return False
+            self._items.append((item, nbytes))
+            self._bytes += nbytes
+            self._condition.notify_all()
+            return True
+
+    def wait_for_space(self, nbytes: int = 0) -> bool:
+        """Block until an item of nbytes would be accepted by put, returns False if the queue was closed."""
+
+        with self._condition:
+            while not self._closed and self._items and self._is_full(nbytes):
+                self._condition.wait()
+            return not self._closed
+
+    def get(self):
+        with self._condition:
+            while not self._items:
+                self._condition.wait()
+            item, nbytes = self._items.popleft()
+            self._bytes -= nbytes
+            self._condition.notify_all()
+            return item
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._items.clear()
+            self._bytes = 0
+            self._condition.notify_all()
+
+    def _is_full(self, nbytes: int) -> bool:
+        if len(self._items) >= self.depth:
+            return True
+        return self.max_bytes is not None and self._bytes + nbytes > self.max_bytes
+
+
+class PrefetchReader(object):
+    """Reads a list of files in order on a background thread.
+
+    Iterating over the reader yields (file, data) tuples in the order of the file list while up to `depth` files are
+    read ahead. A file is only read once its size on disk fits within `max_bytes` next to the files already read ahead,
+    so for uncompressed files the data read ahead stays within `max_bytes`. A single file larger than `max_bytes` is
+    still read once nothing else is held.
+
+    Attributes:
+        files (list): Files to read.
+        depth (int): Maximum number of files read ahead.
+        max_bytes (int): Maximum number of bytes held by files read ahead, None for no limit.
+    """
+
+    __slots__ = ['files', 'depth', 'max_bytes', '_read_func', '_queue', '_thread']
+
+    _DONE = object()
+
+    def __init__(self, files: list, read_func, depth: int = 2, max_bytes: int = None) -> None:
+        """Start reading files in the background.
+
+        Args:
+            files (list): Files to read, in order.
+            read_func (function): Function taking a file and returning a numpy.ndarray.
+            depth (int, optional): Defaults to 2. Maximum number of files read ahead.
+            max_bytes (int, optional): Defaults to None. Maximum number of bytes held by files read ahead, checked
+                against the size of each file on disk before it is read.
+        """
+
+        self.files = list(files)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self._read_func = read_func
+        self._queue = _BoundedQueue(depth, max_bytes)
+        self._thread = threading.Thread(target=self._run, name='PrefetchReader', daemon=True)
+        self._thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> tuple:
+        item = self._queue.get()
+        if item is PrefetchReader._DONE:
+            self._queue.put(item)
+            raise StopIteration
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Stop reading ahead and release any prefetched data."""
+
+        self._queue.close()
+        self._thread.join()
+
+    def _run(self) -> None:
+        for file_path in self.files:
+            if not self._queue.wait_for_space(_file_size(file_path) if self.max_bytes is not None else 0):
+                return
+            try:
+                data = self._read_func(file_path)
+            except Exception as err:  # pylint: disable=broad-except
+                self._queue.put(err)
+                return
+            if not self._queue.put((file_path, data), data.nbytes):
+                return
+        self._queue.put(PrefetchReader._DONE)
+
+
+class WriteBehind(object):
+    """Writes image stacks on a background thread.
+
+    `submit` returns as soon as the stack is queued, blocking only when `depth` stacks (or `max_bytes`) are waiting
+    to be written. Errors raised while writing are raised again on the next call to `submit` or `close`.
+
+    Attributes:
+        depth (int): Maximum number of stacks waiting to be written.
+        max_bytes (int): Maximum number of bytes waiting to be written, None for no limit.
+    """
+
+    __slots__ = ['depth', 'max_bytes', '_write_func', '_queue', '_thread', '_error']
+
+    _DONE = object()
+
+    def __init__(self, write_func, depth: int = 2, max_bytes: int = None) -> None:
+        """Start the writer thread.
+
+        Args:
+            write_func (function): Function taking a numpy.ndarray and a target.
+            depth (int, optional): Defaults to 2. Maximum number of stacks waiting to be written.
+            max_bytes (int, optional): Defaults to None. Maximum number of bytes waiting to be written.
+        """
+
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self._write_func = write_func
+        self._queue = _BoundedQueue(depth, max_bytes)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='WriteBehind', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def submit(self, img_stack, target) -> None:
+        """Queue an image stack to be written.
+
+        Args:
+            img_stack (numpy.ndarray): Data to write. Must not be modified after submitting.
+            target: Target passed on to the write function.
+        """
+
+        self._raise_error()
+        self._queue.put((img_stack, target), img_stack.nbytes)
+
+    def after(self, func) -> None:
+        """Queue a function to be called on the writer thread once all stacks submitted before it are written.
+
+        Args:
+            func (function): Function without arguments. It is not called if writing a previous stack failed.
+        """
+
+        self._raise_error()
+        self._queue.put((None, func))
+
+    def close(self) -> None:
+        """Wait for all queued stacks to be written and stop the writer thread."""
+
+        if self._thread.is_alive():
+            self._queue.put(WriteBehind._DONE)
+            self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is WriteBehind._DONE:
+                return
+            if self._error is not None:
+                continue
+            img_stack, target = item
+            try:
+                if img_stack is None:
+                    target()
+                else:
+                    self._write_func(img_stack, target)
+            except Exception as err:  # pylint: disable=broad-except
+                logger.error('Failed writing %s', target)
+                self._error = err
+
+
+def iter_batches(reader, batch_size: int, total_frames: int = None, skip: int = 0):
+    """Assemble exact, contiguous windows of frames from a sequence of files.
+
+    Frames are copied at most once into a single preallocated batch buffer, windows that lie within one file are
+    returned as views without copying. Every batch holds batch_size frames except for the last one, which holds the
+    remainder.
+
+    The returned batch is only valid until the next batch is requested, as the buffer is reused.
+
+    Args:
+        reader (iterable): Iterable of (file, data) tuples with data (frames, y, x), e.g. a PrefetchReader.
+        batch_size (int): Number of frames per batch.
+        total_frames (int, optional): Defaults to None. Expected number of frames, checked once all files are read.
+        skip (int, optional): Defaults to 0. Number of frames at the start of the first file to leave out of the
+            batches, counted in total_frames.
+
+    Raises:
+        ValueError: If the number of frames read does not match total_frames.
+
+    Yields:
+        numpy.ndarray: Batch of frames (batch_size, y, x).
+    """
+
+    assert batch_size > 0, 'Batch size must be at least 1'
+    buffer = None
+    filled = 0
+    frames_read = 0
+    for file_path, data in reader:
+        position = min(max(skip - frames_read, 0), len(data))
+        frames_read += len(data)
+        while position < len(data):
+            if filled == 0 and len(data) - position >= batch_size:
+                yield data[position:position + batch_size]
+                position += batch_size
+                continue
+            if buffer is None or buffer.shape[1:] != data.shape[1:] or buffer.dtype != data.dtype:
+                assert filled == 0, f'Frames of {file_path} do not match the shape or type of the previous file'
+                buffer = np.empty((batch_size,) + data.shape[1:], dtype=data.dtype)
+            num_frames = min(batch_size - filled, len(data) - position)
+            buffer[filled:filled + num_frames] = data[position:position + num_frames]
+            filled += num_frames
+            position += num_frames
+            if filled == batch_size:
+                yield buffer
+                filled = 0
+    if total_frames is not None and frames_read != total_frames:
+        raise ValueError(f'Read {frames_read} frames but expected {total_frames}')
+    if filled > 0:
+        yield buffer[:filled]
+
+
+def _file_size(file_path) -> int:
+    """Size of a file on disk in bytes, 0 if it can not be determined."""
+
+    try:
+        return os.path.getsize(file_path)
+    except (OSError, TypeError):
+        return 0
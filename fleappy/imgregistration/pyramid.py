@@ -0,0 +1,182 @@
+"""Coarse to fine registration for any registration module.
+
+Shifts are first estimated on frames and template downsampled by 2**levels, where the search for a large movement is
+cheap. Every frame is then cropped so that it lines up with the center of the template according to the coarse shift,
+and the registration module refines the shift on the crops at full resolution, searching only a small window. The
+coarse row shift is kept even so that crops start on the same line parity as the frame, which keeps bidirectional phase
+offsets (see templatematchpc) valid.
+
+The registration module has to bound its search by a maxmovement argument, as fftreg, templatematching,
+templatematchpc and piecewise do. Modules that always search the whole frame, such as dftreg, would gain nothing from
+the coarse estimate and are rejected.
+
+Example:
+    Register with two pyramid levels and a large search range:
+    ::code-block
+
+        $ imgreg = ImageRegistration(reg_module=PyramidModule(templatematching, levels=2, maxmovement=30))
+        $ imgreg.register(filepath, seriesname)
+"""
+
+import importlib
+import inspect
+import math
+from types import ModuleType
+
+import numpy as np
+
+
+def register(reg_module, avg_img, tiff_stack, levels: int = 2, maxmovement: int = 10, refine: int = 2,
+             **kwargs) -> np.ndarray:
+    """Register a stack coarse to fine with a registration module.
+
+    Args:
+        reg_module (module): Registration module whose register method takes a maxmovement argument.
+        avg_img (numpy.ndarray): Template image (y, x).
+        tiff_stack (numpy.ndarray): Stack to register (z, y, x).
+        levels (int, optional): Defaults to 2. Number of times the frames are downsampled by 2 for the coarse estimate,
+            0 registers at full resolution only.
+        maxmovement (int, optional): Defaults to 10. Largest shift searched for in pixels.
+        refine (int, optional): Defaults to 2. Largest correction of the coarse shift searched for at full resolution,
+            in pixels.
+        **kwargs: Further arguments passed on to the register method of the module.
+
+    Returns:
+        numpy.ndarray: transform_spec of the registration module, with the shift in the first two columns.
+    """
+
+    assert _bounds_search(reg_module), f'{reg_module.__name__}.register has no maxmovement argument to bound the search'
+    if levels == 0:
+        return reg_module.register(avg_img, tiff_stack, **_arguments(reg_module, maxmovement=maxmovement, **kwargs))
+
+    factor = 2 ** levels
+    coarse_spec = reg_module.register(downsample(avg_img, factor), downsample(tiff_stack, factor),
+                                      **_arguments(reg_module, maxmovement=math.ceil(maxmovement / factor) + 1,
+                                                   **kwargs))
+    limit = maxmovement + factor
+    shift = np.clip(coarse_spec[:, 0:2] * factor, -limit, limit)
+    shift = np.stack((2 * np.round(shift[:, 0] / 2), np.round(shift[:, 1])), axis=1).astype(int)
+
+    # Crops of the frames that line up with the center of the template according to the coarse shift. The margin only
+    # depends on the settings, so the estimate of a frame does not depend on the other frames of the stack.
+    margin = limit + 1 + refine + 1
+    margin += margin % 2
+    shape_y, shape_x = avg_img.shape
+    assert 2 * margin < min(shape_y, shape_x), f'maxmovement {maxmovement} is too large for the frame size'
+    crops = np.empty((len(tiff_stack), shape_y - 2 * margin, shape_x - 2 * margin), dtype=tiff_stack.dtype)
+    for idx, (shift_y, shift_x) in enumerate(shift):
+        crops[idx] = tiff_stack[idx, margin - shift_y:shape_y - margin - shift_y,
+                                margin - shift_x:shape_x - margin - shift_x]
+
+    transform_spec = np.array(reg_module.register(avg_img[margin:shape_y - margin, margin:shape_x - margin], crops,
+                                                  **_arguments(reg_module, maxmovement=refine, **kwargs)),
+                              dtype=np.float64)
+    transform_spec[:, 0:2] += shift
+    return transform_spec
+
+
+def downsample(img_stack, factor: int) -> np.ndarray:
+    """Downsample images (..., y, x) by averaging blocks of factor x factor pixels, trimming incomplete blocks.
+
+    Args:
+        img_stack (numpy.ndarray): Image or stack of images (..., y, x).
+        factor (int): Downsampling factor.
+
+    Returns:
+        numpy.ndarray: Downsampled images (..., y // factor, x // factor) as float32.
+    """
+
+    shape_y, shape_x = img_stack.shape[-2] // factor, img_stack.shape[-1] // factor
+    blocks = np.asarray(img_stack[..., :shape_y * factor, :shape_x * factor], dtype=np.float32)
+    blocks = blocks.reshape(img_stack.shape[:-2] + (shape_y, factor, shape_x, factor))
+    return blocks.mean(axis=(-3, -1))
+
+
+class PyramidModule(object):
+    """Registration module that registers coarse to fine with another registration module.
+
+    Provides the register, transform, join, save, load and create_template methods so that it can be used as the
+    reg_module of ImageRegistration. Everything but register is passed on to the wrapped module, so transformations
+    are saved and applied as by the wrapped module. Modules whose register takes a pyramid_levels argument (see
+    piecewise) do their own coarse to fine estimation and are passed the number of levels.
+
+    Attributes:
+        reg_module (module): Wrapped registration module.
+        levels (int): Number of times the frames are downsampled by 2 for the coarse estimate.
+        maxmovement (int): Largest shift searched for in pixels.
+        refine (int): Largest correction of the coarse shift searched for at full resolution, in pixels.
+    """
+
+    __slots__ = ['reg_module', 'levels', 'maxmovement', 'refine']
+
+    def __init__(self, reg_module, levels: int = 2, maxmovement: int = 10, refine: int = 2) -> None:
+        """Wrap a registration module.
+
+        Args:
+            reg_module (module): Registration module whose register method takes a maxmovement argument, or its
+                name.
+            levels (int, optional): Defaults to 2. Number of times the frames are downsampled by 2.
+            maxmovement (int, optional): Defaults to 10. Largest shift searched for in pixels.
+            refine (int, optional): Defaults to 2. Largest correction of the coarse shift at full resolution.
+        """
+
+        self.reg_module = importlib.import_module(reg_module) if isinstance(reg_module, str) else reg_module
+        assert _bounds_search(self.reg_module), \
+            f'{self.reg_module.__name__}.register has no maxmovement argument to bound the search'
+        self.levels = levels
+        self.maxmovement = maxmovement
+        self.refine = refine
+
+    def __reduce__(self):
+        # Registration modules are not picklable, so they are sent to worker processes by name
+        reg_module = self.reg_module.__name__ if isinstance(self.reg_module, ModuleType) else self.reg_module
+        return (PyramidModule, (reg_module, self.levels, self.maxmovement, self.refine))
+
+    @property
+    def __name__(self) -> str:
+        return self.reg_module.__name__
+
+    @property
+    def FRAME_BLOCK(self) -> int:  # pylint: disable=invalid-name
+        return getattr(self.reg_module, 'FRAME_BLOCK', 1)
+
+    def settings(self) -> dict:
+        """Returns the pyramid settings, stored with the checkpoint of a run so that a run with other settings or
+        without the pyramid is not resumed from it."""
+
+        return {'levels': self.levels, 'maxmovement': self.maxmovement, 'refine': self.refine}
+
+    def register(self, avg_img, tiff_stack) -> np.ndarray:
+        if 'pyramid_levels' in inspect.signature(self.reg_module.register).parameters:
+            return self.reg_module.register(avg_img, tiff_stack, maxmovement=self.maxmovement,
+                                            pyramid_levels=self.levels)
+        return register(self.reg_module, avg_img, tiff_stack, levels=self.levels, maxmovement=self.maxmovement,
+                        refine=self.refine)
+
+    def transform(self, img_stack, transform_spec, out=None) -> np.ndarray:
+        return self.reg_module.transform(img_stack, transform_spec, out=out)
+
+    def join(self, transform_list, transform_spec) -> np.ndarray:
+        return self.reg_module.join(transform_list, transform_spec)
+
+    def save(self, transform_list, target) -> None:
+        self.reg_module.save(transform_list, target)
+
+    def load(self, source) -> np.ndarray:
+        return self.reg_module.load(source)
+
+    def create_template(self, img_stack) -> np.ndarray:
+        return self.reg_module.create_template(img_stack)
+
+
+def _bounds_search(reg_module) -> bool:
+    """Whether the register method of a module limits its search by a maxmovement argument."""
+
+    return 'maxmovement' in inspect.signature(reg_module.register).parameters
+
+
+def _arguments(reg_module, **kwargs) -> dict:
+    """Keep the keyword arguments that the register method of the module accepts."""
+
+    parameters = inspect.signature(reg_module.register).parameters
+    return {key: value for key, value in kwargs.items() if key in parameters}
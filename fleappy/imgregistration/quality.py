@@ -0,0 +1,115 @@
+"""Per frame quality of a registration.
+
+Quality is measured on the corrected frames of the registered channel while they are in memory, in a pass of its own
+after registration. None of the scores the registration modules compute while searching for the shift (the error and
+phase difference of skimage.feature.register_translation, the peak of cv2.matchTemplate) are kept, every metric is
+computed here from the corrected frame and the template, so the numbers are the same for every registration module.
+The pass converts every corrected frame to float64 and takes a few dot products with the template, the benchmark
+reports its share of the registration time as quality_fraction:
+
+* correlation: Pearson correlation of the corrected frame with the template.
+* residual: RMS of what is left of the corrected frame after subtracting its best scaled fit to the template,
+  relative to the RMS of the frame, sqrt(1 - <frame, template>^2 / (|frame|^2 |template|^2)). It is taken at zero lag,
+  the frame is already shifted, and without removing the means, so unlike the correlation it also grows with a change
+  of baseline. It is 0 for a frame that is a scaled copy of the template.
+* shift: Length in pixels of the (y,x) shift applied to the frame.
+
+Both image measures are taken over the part of the field of view that is inside every frame of the batch after the
+shift, so the border filled in by the transformation is left out. Low correlation or a high residual flags frames that
+did not register well, e.g. because of movement out of the focal plane.
+
+Example:
+    List the frames of a slice that correlate poorly with the template:
+    ::code-block
+
+        $ metrics = quality.read(Path(directory, seriesname, 'Registered', 'slice1', 'quality.npz'))
+        $ bad_frames = np.flatnonzero(metrics[:, quality.FIELDS.index('correlation')] < 0.5)
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+FIELDS = ('correlation', 'residual', 'shift')
+"""tuple: Names of the columns of the quality metrics."""
+
+
+def frame_metrics(template, corrected, transform_spec, block_size: int = 32) -> np.ndarray:
+    """Measure how well each corrected frame matches the template.
+
+    Args:
+        template (numpy.ndarray): Template image (y, x) the frames were registered to.
+        corrected (numpy.ndarray): Corrected frames (z, y, x).
+        transform_spec (numpy.ndarray): Transformations of the frames with the (y,x) shift in the first two columns.
+        block_size (int, optional): Defaults to 32. Number of frames measured at once, bounds memory use.
+
+    Returns:
+        numpy.ndarray: Quality metrics (z, 3), columns in the order of FIELDS.
+    """
+
+    transform_spec = np.asarray(transform_spec, dtype=np.float64)
+    metrics = np.empty((len(corrected), len(FIELDS)))
+    metrics[:, 2] = np.hypot(transform_spec[:, 0], transform_spec[:, 1])
+
+    margin = int(np.ceil(np.abs(transform_spec[:, 0:2]).max(initial=0))) + 1
+    if 2 * margin >= min(template.shape):
+        margin = 0
+    inside = (slice(margin, template.shape[0] - margin), slice(margin, template.shape[1] - margin))
+    template = np.asarray(template, dtype=np.float64)[inside].ravel()
+    template_centered = template - template.mean()
+    eps = np.finfo(np.float64).eps
+
+    for block_start in range(0, len(corrected), block_size):
+        block = np.asarray(corrected[block_start:block_start + block_size], dtype=np.float64)
+        block = block[(slice(None),) + inside].reshape(len(block), -1)
+        block_centered = block - block.mean(axis=1, keepdims=True)
+        metrics[block_start:block_start + len(block), 0] = np.dot(block_centered, template_centered) / (
+            np.linalg.norm(block_centered, axis=1) * np.linalg.norm(template_centered) + eps)
+        cross = np.dot(block, template)
+        metrics[block_start:block_start + len(block), 1] = np.sqrt(np.abs(
+            1 - cross ** 2 / (np.einsum('ij,ij->i', block, block) * np.dot(template, template) + eps)))
+    return metrics
+
+
+def summary(metrics: np.ndarray) -> str:
+    """Returns a one line summary of the quality metrics of a batch for logging."""
+
+    if len(metrics) == 0:
+        return 'no frames'
+    correlation, residual, shift = metrics[:, 0], metrics[:, 1], metrics[:, 2]
+    return (f'correlation median {np.median(correlation):.3f} min {correlation.min():.3f}, '
+            f'residual median {np.median(residual):.3f} max {residual.max():.3f}, '
+            f'shift median {np.median(shift):.2f} max {shift.max():.2f} px')
+
+
+def write(target, metrics: np.ndarray) -> None:
+    """Write quality metrics to file.
+
+    Args:
+        target (Path): File to write the metrics to.
+        metrics (numpy.ndarray): Quality metrics (frames, 3) as returned by frame_metrics.
+
+    Raises:
+        TypeError: If target is not a Path.
+    """
+
+    if not isinstance(target, Path):
+        raise TypeError('Please specifiy a Path')
+    metrics = np.asarray(metrics, dtype=np.float64).reshape(-1, len(FIELDS))
+    with open(target, 'wb') as file:
+        np.savez(file, frame=np.arange(len(metrics), dtype=np.int64),
+                 **{field: metrics[:, idx] for idx, field in enumerate(FIELDS)})
+
+
+def read(source) -> np.ndarray:
+    """Read quality metrics from file.
+
+    Args:
+        source (Path): File to read the metrics from.
+
+    Returns:
+        numpy.ndarray: Quality metrics (frames, 3), columns in the order of FIELDS.
+    """
+
+    with np.load(Path(source), allow_pickle=False) as archive:
+        return np.column_stack([archive[field] for field in FIELDS]).reshape(-1, len(FIELDS))
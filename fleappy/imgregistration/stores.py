@@ -0,0 +1,183 @@
+"""Output formats for registered images.
+
+Registered stacks are written one file per batch, slice and channel as `stack_c<channel #>_<batch #><suffix>`. The
+writer decides the file format:
+
+* TiffWriter writes uncompressed multi-page tif files, as read by ImageJ.
+* HDF5Writer writes a chunked, losslessly compressed HDF5 dataset. Chunks hold a block of frames and optionally a
+  tile of each frame, so a range of frames or a region of the field of view is read without decompressing the rest of
+  the file. Chunks are byte shuffled and deflated on a pool of threads and stored with the standard HDF5 shuffle and
+  gzip filters, so the files can be read by any HDF5 reader.
+
+RegisteredStack, open_registered and read_stack read the files back. They live in fleappy.tiffread.registered, so
+that readers of registered images do not depend on the registration package, and are imported here for convenience.
+
+Example:
+    Register to compressed HDF5 files and read frames 5000 to 6000 of the first slice back:
+    ::code-block
+
+        $ imgreg.register(filepath, seriesname, output='h5')
+        $ with open_registered(Path(filepath, seriesname, 'Registered', 'slice1'), channel=1) as stack:
+        $     frames = stack[5000:6000]
+"""
+
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import h5py
+import imageio
+import numpy as np
+
+from fleappy.tiffread import registered
+from fleappy.tiffread.registered import DATASET, RegisteredStack, open_registered, read_stack
+
+
+class TiffWriter(object):
+    """Writes registered stacks as uncompressed multi-page tif files."""
+
+    __slots__ = []
+
+    suffix = registered.TIFF_SUFFIX
+
+    def write(self, img_stack, path_name) -> None:
+        """Write a stack (z, y, x) to a tif file.
+
+        Args:
+            img_stack (numpy.ndarray): Images (z, y, x) or a single image (y, x).
+            path_name (Path): File to write to, must end in .tif.
+        """
+
+        assert Path(path_name).suffix == self.suffix, 'Please specify a .tif'
+        if len(img_stack.shape) < 3:
+            img_stack = img_stack[np.newaxis, :, :]
+        imageio.mimwrite(Path(path_name), img_stack)
+
+    def close(self) -> None:
+        """Nothing to release, present for symmetry with HDF5Writer."""
+
+
+class HDF5Writer(object):
+    """Writes registered stacks as chunked, losslessly compressed HDF5 files.
+
+    Attributes:
+        chunk_frames (int): Number of frames in a chunk.
+        tile_size (int): Size in pixels of the square tile of a frame in a chunk, None for whole frames.
+        level (int): Deflate compression level from 1 (fastest) to 9 (smallest).
+        shuffle (bool): Byte shuffle the chunks before compressing, which compresses 16 bit images much better.
+        workers (int): Number of threads compressing chunks.
+    """
+
+    __slots__ = ['chunk_frames', 'tile_size', 'level', 'shuffle', 'workers', '_executor']
+
+    suffix = registered.HDF5_SUFFIX
+
+    def __init__(self, chunk_frames: int = 32, tile_size: int = None, level: int = 4, shuffle: bool = True,
+                 workers: int = None) -> None:
+        """Configure the chunk layout and compression.
+
+        Args:
+            chunk_frames (int, optional): Defaults to 32. Number of frames in a chunk.
+            tile_size (int, optional): Defaults to None, chunks hold whole frames. Size in pixels of the square tile
+                of a frame in a chunk.
+            level (int, optional): Defaults to 4. Deflate compression level from 1 to 9.
+            shuffle (bool, optional): Defaults to True. Byte shuffle chunks before compressing.
+            workers (int, optional): Defaults to None and will use the number of CPUs, at most 8. Number of threads
+                compressing chunks.
+        """
+
+        assert chunk_frames > 0, 'Chunks need at least one frame'
+        assert 1 <= level <= 9, 'Compression level must be between 1 and 9'
+        self.chunk_frames = chunk_frames
+        self.tile_size = tile_size
+        self.level = level
+        self.shuffle = shuffle
+        self.workers = workers if workers is not None else min(8, os.cpu_count() or 1)
+        self._executor = None
+
+    def chunk_shape(self, shape: tuple) -> tuple:
+        """Returns the chunk shape (frames, y, x) used for a stack of a shape (z, y, x)."""
+
+        num_frames, shape_y, shape_x = shape
+        tile_y, tile_x = (shape_y, shape_x) if self.tile_size is None else (min(self.tile_size, shape_y),
+                                                                            min(self.tile_size, shape_x))
+        return (max(1, min(self.chunk_frames, num_frames)), tile_y, tile_x)
+
+    def write(self, img_stack, path_name) -> None:
+        """Write a stack (z, y, x) to an HDF5 file, compressing its chunks in parallel.
+
+        Args:
+            img_stack (numpy.ndarray): Images (z, y, x) or a single image (y, x).
+            path_name (Path): File to write to, must end in .h5.
+        """
+
+        assert Path(path_name).suffix == self.suffix, 'Please specify a .h5'
+        img_stack = np.asarray(img_stack)
+        if len(img_stack.shape) < 3:
+            img_stack = img_stack[np.newaxis, :, :]
+        img_stack = img_stack.astype(img_stack.dtype.newbyteorder('='), copy=False)
+        chunks = self.chunk_shape(img_stack.shape)
+        starts = [(start_t, start_y, start_x)
+                  for start_t in range(0, img_stack.shape[0], chunks[0])
+                  for start_y in range(0, img_stack.shape[1], chunks[1])
+                  for start_x in range(0, img_stack.shape[2], chunks[2])]
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        with h5py.File(str(path_name), 'w') as file:
+            dataset = file.create_dataset(DATASET, shape=img_stack.shape, dtype=img_stack.dtype, chunks=chunks,
+                                          compression='gzip', compression_opts=self.level, shuffle=self.shuffle)
+            compressed = self._executor.map(lambda start: self._compress(img_stack, start, chunks), starts)
+            for start, data in zip(starts, compressed):
+                dataset.id.write_direct_chunk(start, data)
+
+    def close(self) -> None:
+        """Stop the compression threads."""
+
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _compress(self, img_stack: np.ndarray, start: tuple, chunks: tuple) -> bytes:
+        """Returns the filtered bytes of the chunk at start, zero padded to the full chunk shape as HDF5 stores it."""
+
+        block = img_stack[tuple(slice(offset, offset + size) for offset, size in zip(start, chunks))]
+        if block.shape != chunks:
+            block = np.pad(block, [(0, size - extent) for size, extent in zip(chunks, block.shape)], mode='constant')
+        data = np.ascontiguousarray(block).view(np.uint8)
+        if self.shuffle and block.dtype.itemsize > 1:
+            data = data.reshape(-1, block.dtype.itemsize).T
+        return zlib.compress(data.tobytes(), self.level)
+
+
+WRITERS = {TiffWriter.suffix: TiffWriter, HDF5Writer.suffix: HDF5Writer}
+"""dict: Writer class for each file suffix."""
+
+
+def make_writer(output):
+    """Returns a writer for an output format.
+
+    Args:
+        output (str or writer): File suffix of the format ('.tif' or '.h5', the dot may be left out) or a writer
+            object, which is returned as is.
+
+    Raises:
+        ValueError: If the format is unknown.
+
+    Returns:
+        writer: Object with a suffix attribute and write and close methods.
+    """
+
+    if not isinstance(output, str):
+        return output
+    return WRITERS[_suffix(output)]()
+
+
+def _suffix(output: str) -> str:
+    """Returns the file suffix of an output format, raising a ValueError if it is unknown."""
+
+    suffix = output if output.startswith('.') else '.' + output
+    if suffix not in WRITERS:
+        raise ValueError(f'Unknown output format {output}, use one of {", ".join(WRITERS)}')
+    return suffix
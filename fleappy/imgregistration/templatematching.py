@@ -1,7 +1,6 @@
 import cv2
 import numpy as np
-from scipy.ndimage.interpolation import shift
-from pathlib import Path
+from . import translate, tspec
 
 
 def register(avg_img, tiff_stack, maxmovement=10):
@@ -39,22 +38,19 @@ def register(avg_img, tiff_stack, maxmovement=10):
     return transform_spec
 
 
-def transform(img_stack, transform_spec):
+def transform(img_stack, transform_spec, out=None):
     """Applies (y,x) translation to a series of images
 
     Args:
         img_stack (numpy.ndarray):  Uncorrected tiff stack (z, y, x)
         transform_spec (numpy.ndarray): Shifts to be applied to tiff stack in format (frameNum, (y,x))
+        out (numpy.ndarray, optional): Defaults to None. Buffer (z, y, x) to write the corrected stack into.
 
     Returns:
         numpy.ndarray: Motion corrected tiff stack (z, y, x)
     """
 
-    z, w, h = img_stack.shape
-    registered = np.zeros((z, w, h))
-    for idx, frame in enumerate(img_stack):
-        registered[idx, :, :] = shift(frame, transform_spec[idx, :])
-    return registered.astype(np.int16)
+    return translate.apply_shifts(img_stack, transform_spec[:, 0:2], out=out, dtype=np.int16)
 
 
 def join(transform_list, transform_spec):
@@ -86,22 +82,21 @@ def save(transform_list, target):
         transform_list (numpy.ndarray): List of transformations.
         target (Path): File to write transformations to.
     """
-    if isinstance(target, Path):
-        np.savetxt(target, np.squeeze(transform_list), delimiter=',', fmt='%.1f', header=__name__)
-    else:
-        raise TypeError('Please specifiy a Path')
+
+    tspec.write(target, transform_list, __name__)
 
 
-def load():
+def load(source):
     """Load frame by frame transformations from file.
 
-    TODO:
-        * Implement template matching file loading.
+    Args:
+        source (Path): File to read transformations from.
 
-    Raises:
-        NotImplementedError: File loading is not yet supported
+    Returns:
+        numpy.ndarray: Frame by frame transformations (n, 2).
     """
-    raise NotImplementedError('Transformation loading is not yet implemented.')
+
+    return tspec.read(source, module_name=__name__)
 
 
 def create_template(img_stack):
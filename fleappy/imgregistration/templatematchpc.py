@@ -1,71 +1,115 @@
 import cv2
-from scipy.ndimage.interpolation import shift
-from skimage.feature import register_translation
 import numpy as np
 import logging
-from pathlib import Path
+from . import translate, tspec
 
+FRAME_BLOCK = 50
+"""int: Number of consecutive frames sharing a line phase offset by default. Parallel work units are a multiple of it,
+so that they fit the same offsets as a serial run."""
 
-def register(avg_img, tiff_stack, maxmovement=10):
+
+def register(avg_img, tiff_stack, maxmovement=10, phase_block=FRAME_BLOCK, upsample_factor=20):
     """ Register time series tiff using OpenCV template matching.
 
     Uses opencv to template match template to tiff stack, and returns the transform_spec, translational shifts in (y,x),
     necessary to correct movements. A 5x5 smoothing kernel is applied to reduce high frequency noise. This version also
-    does frame by frame phase correction for resonant scanning.
+    does phase correction for resonant scanning, the line phase offset is fit once for every block of frames from the
+    mean of their odd and even lines.
 
     Args:
         avg_img (numpy.ndarray (y,x)): Template image to register to
         tiff_stack (numpy.ndarray (z,y,x)): Tiff stack to register
+        maxmovement (int, optional): Defaults to 10. Largest shift searched for in pixels.
+        phase_block (int, optional): Defaults to FRAME_BLOCK. Number of consecutive frames sharing a line phase offset.
+            Blocks start at the first frame of tiff_stack.
+        upsample_factor (int, optional): Defaults to 20. Line phase offsets are estimated to 1/upsample_factor of a
+            pixel.
 
     Returns:
-        transform_spec (numpy.ndarray float (y,x): translation pixel shifts to register tiff_stack
+        transform_spec (numpy.ndarray float (z, 3)): translation pixel shifts (y,x) and line phase offset to register
+            tiff_stack
     """
 
-    background = np.zeros_like(tiff_stack)
+    assert phase_block >= 1, 'Need at least one frame per phase block'
     frameSizeX, frameSizeY = avg_img.shape
     transform_spec = np.zeros((tiff_stack.shape[0], 3))
+    transform_spec[:, 2] = phase_offsets(tiff_stack, phase_block=phase_block, upsample_factor=upsample_factor)
     avg_img = cv2.UMat(avg_img.astype(np.float32))
 
     kernel = np.ones((5, 5), np.float32)/25
     avg_img = cv2.filter2D(avg_img, -1, kernel)
-    pixel_previous = None
-    for idx, frame in enumerate(tiff_stack):
-        pixel_shiftA, _, _ = register_translation(frame[1::2, :], frame[0::2, :], upsample_factor=20)
-        pixel_shiftB, _, _ = register_translation(frame[1:-1:2, :], frame[2::2, :], upsample_factor=20)
-        pixel_shift = [0, np.mean([pixel_shiftA[1], pixel_shiftB[1]])]
-        frame[0::2, :] = shift(frame[0::2, :], pixel_shift)
-
-        background[idx, :, :] = np.zeros_like(avg_img, dtype='float32')
-        trim_frame = cv2.UMat(cv2.convertScaleAbs(
-            frame[maxmovement:frameSizeX-maxmovement, maxmovement:frameSizeY-maxmovement]).astype(np.float32))
-        trim_frame = cv2.filter2D(trim_frame, -1, kernel)
-        res = cv2.matchTemplate(trim_frame, avg_img, cv2.TM_CCOEFF_NORMED)
-        _, _, _, max_loc = cv2.minMaxLoc(res)
-        yshift = max_loc[0]-maxmovement
-        xshift = max_loc[1]-maxmovement
-        transform_spec[idx, :] = [xshift, yshift, pixel_shift[1]]
+    for block_start in range(0, tiff_stack.shape[0], phase_block):
+        block = _correct_phase(tiff_stack[block_start:block_start + phase_block],
+                               transform_spec[block_start:block_start + phase_block, 2])
+        for idx, frame in enumerate(block, start=block_start):
+            trim_frame = cv2.UMat(cv2.convertScaleAbs(
+                frame[maxmovement:frameSizeX-maxmovement, maxmovement:frameSizeY-maxmovement]).astype(np.float32))
+            trim_frame = cv2.filter2D(trim_frame, -1, kernel)
+            res = cv2.matchTemplate(trim_frame, avg_img, cv2.TM_CCOEFF_NORMED)
+            _, _, _, max_loc = cv2.minMaxLoc(res)
+            yshift = max_loc[0]-maxmovement
+            xshift = max_loc[1]-maxmovement
+            transform_spec[idx, 0:2] = [xshift, yshift]
 
     return transform_spec
 
 
-def transform(img_stack, transform_spec):
-    """Applies (y,x) translation to a series of images
+def phase_offsets(tiff_stack, phase_block=FRAME_BLOCK, upsample_factor=20, max_offset=10):
+    """Estimate the bidirectional scanning line phase offset.
+
+    The offset is the shift along x that aligns the odd lines with the average of the neighbouring even lines. Frames
+    are averaged over a block and the cross correlation is summed over all lines before the peak is found, so a single
+    fit per block is cheap and robust to noise. Neighbouring lines are only partially correlated, so the correlation is
+    not whitened as in phase correlation. Odd and even lines are tapered with a Hann window so that the ends of the
+    lines, which wrap around in the circular correlation, do not bias the offset, and the correlation is divided by the
+    autocorrelation of the window, which would otherwise pull the peak towards zero on short lines. The search is
+    evaluated directly with a matrix multiply DFT, first at integer offsets and then on an upsampled grid around the
+    best one.
+
+    Args:
+        tiff_stack (numpy.ndarray): Tiff stack (z, y, x).
+        phase_block (int, optional): Defaults to FRAME_BLOCK. Number of consecutive frames sharing a line phase offset,
+            1 fits the offset of every frame. Blocks start at the first frame of tiff_stack.
+        upsample_factor (int, optional): Defaults to 20. Offsets are estimated to 1/upsample_factor of a pixel.
+        max_offset (int, optional): Defaults to 10. Largest offset searched for in pixels.
+
+    Returns:
+        numpy.ndarray: Line phase offset of every frame (z,), the shift to apply to the odd lines.
+    """
+
+    assert phase_block >= 1, 'Need at least one frame per phase block'
+    starts = np.arange(0, tiff_stack.shape[0], phase_block)
+    offsets = np.zeros(len(starts))
+    for group_start in range(0, len(starts), 64):
+        lines = np.stack([np.mean(tiff_stack[start:start + phase_block], axis=0, dtype=np.float32)
+                          for start in starts[group_start:group_start + 64]])
+        offsets[group_start:group_start + 64] = _fit_offsets(lines, upsample_factor, max_offset)
+    return np.repeat(offsets, phase_block)[:tiff_stack.shape[0]]
+
+
+def transform(img_stack, transform_spec, out=None, block_size=64):
+    """Applies line phase correction and (y,x) translation to a series of images
 
     Args:
         img_stack (numpy.ndarray):  Uncorrected tiff stack (z, y, x)
-        transform_spec (numpy.ndarray): Shifts to be applied to tiff stack in format (frameNum, (y,x))
+        transform_spec (numpy.ndarray): Shifts to be applied to tiff stack in format (frameNum, (y,x, phase))
+        out (numpy.ndarray, optional): Defaults to None. Buffer (z, y, x) to write the corrected stack into.
+        block_size (int, optional): Defaults to 64. Number of frames corrected at once.
 
     Returns:
         numpy.ndarray: Motion corrected tiff stack (z, y, x)
     """
 
-    z, w, h = img_stack.shape
-    registered = np.zeros((z, w, h))
-    for idx, frame in enumerate(img_stack):
-        frame[1::2, :] = shift(frame[1::2, :], (0, transform_spec[idx, 2]))
-        registered[idx, :, :] = shift(frame, transform_spec[idx, 0:2])
-    registered[registered < 0] = 0
-    return registered.astype(np.uint16)
+    if out is None:
+        out = np.empty(img_stack.shape, dtype=np.uint16)
+    for block_start in range(0, img_stack.shape[0], block_size):
+        block_stop = min(block_start + block_size, img_stack.shape[0])
+        block = np.array(img_stack[block_start:block_stop], dtype=np.float32)
+        phase_shift = np.zeros((block_stop - block_start, 2))
+        phase_shift[:, 1] = transform_spec[block_start:block_stop, 2]
+        block[:, 1::2, :] = translate.apply_shifts(block[:, 1::2, :], phase_shift, dtype=np.float32)
+        translate.apply_shifts(block, transform_spec[block_start:block_stop, 0:2], out=out[block_start:block_stop])
+    return out
 
 
 def join(transform_list, transform_spec):
@@ -99,22 +143,21 @@ def save(transform_list, target):
         transform_list (numpy.ndarray): List of transformations.
         target (Path): File to write transformations to.
     """
-    if isinstance(target, Path):
-        np.savetxt(target, np.squeeze(transform_list), delimiter=',', fmt='%.1f', header=__name__)
-    else:
-        raise TypeError('Please specifiy a Path')
 
+    tspec.write(target, transform_list, __name__)
 
-def load():
+
+def load(source):
     """Load frame by frame transformations from file.
 
-    TODO:
-        * Implement templatematchingpc file loading.
+    Args:
+        source (Path): File to read transformations from.
 
-    Raises:
-        NotImplementedError: File loading is not yet supported
+    Returns:
+        numpy.ndarray: Frame by frame transformations (n, 3).
     """
-    raise NotImplementedError('Transformation loading is not yet implemented.')
+
+    return tspec.read(source, module_name=__name__)
 
 
 def create_template(img_stack):
@@ -124,9 +167,52 @@ def create_template(img_stack):
         img_stack (numpy.ndarray): image stack (t, y, x)
 
     Returns:
-        numpy.ndarray: Mean Image 
+        numpy.ndarray: Mean Image
     """
-    for idx, frame in enumerate(img_stack):
-        pixel_shift, _, _ = register_translation(frame[0::2, :], frame[1::2, :], upsample_factor=20)
-        img_stack[idx, 1::2, :] = shift(frame[1::2, :], (0, pixel_shift[1]))
-    return np.mean(img_stack, axis=0, dtype=np.float)
+
+    return np.mean(_correct_phase(img_stack, phase_offsets(img_stack)), axis=0, dtype=np.float64)
+
+
+def _fit_offsets(lines: np.ndarray, upsample_factor: int, max_offset: int) -> np.ndarray:
+    """Fit the line phase offset of each image (n, y, x) by cross correlation of its odd and even lines."""
+
+    odd = lines[:, 1::2, :]
+    even = lines[:, 0::2, :]
+    below = np.concatenate((even[:, 1:, :], even[:, -1:, :]), axis=1)
+    even = (even[:, :odd.shape[1], :] + below[:, :odd.shape[1], :]) / 2
+    shape_x = lines.shape[2]
+    window = np.hanning(shape_x)
+    odd = (odd - odd.mean(axis=2, keepdims=True)) * window
+    even = (even - even.mean(axis=2, keepdims=True)) * window
+    cross_power = (np.fft.rfft(even, axis=2) * np.conj(np.fft.rfft(odd, axis=2))).sum(axis=1)
+    window_power = np.abs(np.fft.rfft(window)) ** 2
+
+    peaks = _line_peaks(cross_power, window_power, np.arange(-max_offset, max_offset + 1)[np.newaxis, :], shape_x)
+    grid = (np.arange(2 * upsample_factor + 1) - upsample_factor) / upsample_factor
+    return _line_peaks(cross_power, window_power, peaks[:, np.newaxis] + grid[np.newaxis, :], shape_x)
+
+
+def _line_peaks(cross_power: np.ndarray, window_power: np.ndarray, samples: np.ndarray, shape_x: int) -> np.ndarray:
+    """Returns the sample of each row of samples (n, m) with the highest line correlation relative to the window's."""
+
+    weights = np.full(cross_power.shape[-1], 2.0)
+    weights[0] = 1
+    if shape_x % 2 == 0:
+        weights[-1] = 1
+    frequencies = np.fft.rfftfreq(shape_x)
+    samples = np.broadcast_to(samples, (len(cross_power), samples.shape[1]))
+    kernel = np.exp(2j * np.pi * frequencies[np.newaxis, :, np.newaxis] * samples[:, np.newaxis, :])
+    correlation = np.matmul((cross_power * weights)[:, np.newaxis, :], kernel)[:, 0, :].real
+    overlap = np.matmul((window_power * weights)[np.newaxis, np.newaxis, :], kernel)[:, 0, :].real
+    correlation = correlation / overlap
+    return samples[np.arange(len(samples)), np.argmax(correlation, axis=1)]
+
+
+def _correct_phase(img_stack, offsets: np.ndarray) -> np.ndarray:
+    """Returns a float32 copy of the stack with the odd lines shifted by the line phase offset of each frame."""
+
+    img_stack = np.array(img_stack, dtype=np.float32)
+    phase_shift = np.zeros((len(img_stack), 2))
+    phase_shift[:, 1] = offsets
+    img_stack[:, 1::2, :] = translate.apply_shifts(img_stack[:, 1::2, :], phase_shift, dtype=np.float32)
+    return img_stack
@@ -0,0 +1,91 @@
+"""Iterative refinement of registration templates.
+
+A template made from the mean of the first frames of a session is blurred by any movement in those frames. The template
+is refined by registering blocks of frames sampled evenly across the whole series to the current template and averaging
+the aligned frames, which is repeated until the template stops changing. Sampled blocks are read one at a time and only
+running sums of the aligned frames are kept, so memory use does not depend on the length of the session.
+
+Every aligned frame is averaged with a weight of how much of it lies inside the field of view after the transformation,
+so pixels shifted in from outside the frame do not darken the edges of the template.
+
+Example:
+    Refine the template of the first slice in channel 1:
+    ::code-block
+
+        $ with index.open_series() as series:
+        $     template = templates.refine(fftreg, series.view(0, 1))
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def refine(reg_module, img_stack, initial=None, num_blocks: int = 20, block_frames: int = 50, iterations: int = 5,
+           tolerance: float = 1e-3) -> np.ndarray:
+    """Refine a template by registering frames sampled across a series.
+
+    Args:
+        reg_module (module): Registration module with register, transform and create_template methods.
+        img_stack (numpy.ndarray or SISeriesView): Frames of one slice and channel (z, y, x), read lazily if it is a
+            view of a series.
+        initial (numpy.ndarray, optional): Defaults to None and will use the template of the first sampled block.
+            Template (y, x) to start from.
+        num_blocks (int, optional): Defaults to 20. Number of blocks of consecutive frames sampled evenly over the
+            series.
+        block_frames (int, optional): Defaults to 50. Number of frames in a sampled block.
+        iterations (int, optional): Defaults to 5. Largest number of times the samples are registered.
+        tolerance (float, optional): Defaults to 1e-3. Refinement stops once the template changes by less than this
+            fraction of its norm.
+
+    Returns:
+        numpy.ndarray: Refined template (y, x).
+    """
+
+    assert num_blocks > 0 and block_frames > 0, 'Need at least one sampled frame'
+    starts = sample_blocks(len(img_stack), num_blocks, block_frames)
+    template = np.asarray(initial if initial is not None else
+                          reg_module.create_template(np.asarray(img_stack[starts[0]:starts[0] + block_frames])),
+                          dtype=np.float64)
+
+    for iteration in range(iterations):
+        frame_sum = np.zeros(template.shape, dtype=np.float64)
+        weight_sum = np.zeros(template.shape, dtype=np.float64)
+        for start in starts:
+            block = np.asarray(img_stack[start:start + block_frames])
+            transform_spec = reg_module.register(template, block)
+            aligned = reg_module.transform(block, transform_spec, out=np.empty(block.shape, dtype=np.float32))
+            coverage = reg_module.transform(np.ones(block.shape, dtype=np.float32), transform_spec,
+                                            out=np.empty(block.shape, dtype=np.float32))
+            frame_sum += aligned.sum(axis=0, dtype=np.float64)
+            weight_sum += coverage.sum(axis=0, dtype=np.float64)
+
+        covered = weight_sum > 0.5
+        refined = template.copy()
+        refined[covered] = frame_sum[covered] / weight_sum[covered]
+        change = np.linalg.norm(refined - template) / max(np.linalg.norm(template), np.finfo(np.float64).eps)
+        template = refined
+        logger.info('Template iteration %i changed by %.2e', iteration + 1, change)
+        if change < tolerance:
+            break
+    return template
+
+
+def sample_blocks(num_frames: int, num_blocks: int, block_frames: int) -> np.ndarray:
+    """Returns the first frame of blocks of consecutive frames spread evenly over a series.
+
+    Args:
+        num_frames (int): Number of frames in the series.
+        num_blocks (int): Number of blocks to sample.
+        block_frames (int): Number of frames in a block.
+
+    Returns:
+        numpy.ndarray: Start of every block, blocks do not overlap and cover the series if it is short.
+    """
+
+    assert num_frames > 0, 'No frames to sample'
+    if num_blocks * block_frames >= num_frames:
+        return np.arange(0, num_frames, block_frames)
+    return np.round(np.linspace(0, num_frames - block_frames, num_blocks)).astype(int)
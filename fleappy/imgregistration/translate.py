@@ -0,0 +1,188 @@
+"""Batched application of translations to image stacks.
+
+Shared by the registration modules to apply transform specifications. Frames with integer shifts are moved with a plain
+slice copy straight into the output, frames with sub-pixel shifts are interpolated a block at a time with either a
+bilinear or a Fourier shift. Bilinear shifts are applied with four weighted slice additions for all frames that share
+the integer part of their shift. Temporaries are float32 and bounded by the block size, and the output can be written
+into a caller supplied buffer of the target dtype. Fourier spectra are complex64 with scipy.fft (scipy 1.4 or later),
+older versions fall back to numpy.fft, which always computes in double precision.
+
+Shifts follow the scipy.ndimage.shift convention: a shift of (1, 0) moves the image content down by one row and pixels
+shifted in from outside the frame are 0.
+"""
+
+import numpy as np
+
+try:
+    from scipy import fft as _fft
+except ImportError:
+    _fft = np.fft
+
+CACHE_BYTES = 2 ** 20
+"""int: Size of the float32 frames interpolated at once by the bilinear shift, small enough to stay in cache."""
+
+
+def apply_shifts(img_stack, shifts, out=None, dtype=np.int16, method: str = 'bilinear',
+                 block_size: int = 64) -> np.ndarray:
+    """Translate every frame of an image stack.
+
+    Args:
+        img_stack (numpy.ndarray): Image stack (z, y, x).
+        shifts (numpy.ndarray): Shifts to apply to each frame (z, 2) in (y,x).
+        out (numpy.ndarray, optional): Defaults to None. Buffer (z, y, x) to write the result into, a new array of
+            dtype is allocated if not given.
+        dtype (numpy.dtype, optional): Defaults to numpy.int16. Data type of the new output array, ignored if out is
+            given. Integer outputs are rounded and clipped to the range of the type.
+        method (str, optional): Defaults to 'bilinear'. Interpolation used for sub-pixel shifts, 'bilinear' or
+            'fourier'.
+        block_size (int, optional): Defaults to 64. Number of sub-pixel frames interpolated at once.
+
+    Returns:
+        numpy.ndarray: Translated image stack (z, y, x).
+    """
+
+    assert method in ('bilinear', 'fourier'), f'Unknown interpolation method {method}'
+    shifts = np.asarray(shifts, dtype=np.float64).reshape(-1, 2)
+    assert shifts.shape[0] == img_stack.shape[0], 'Need one shift per frame!'
+    if out is None:
+        out = np.empty(img_stack.shape, dtype=dtype)
+    else:
+        assert out.shape == img_stack.shape, 'Output buffer must match the shape of the image stack'
+
+    rounded = np.round(shifts)
+    is_integer = (np.abs(shifts - rounded) < 1e-6).all(axis=1)
+
+    integer_frames = np.flatnonzero(is_integer)
+    for shift_y, shift_x in np.unique(rounded[integer_frames], axis=0):
+        frames = integer_frames[(rounded[integer_frames] == (shift_y, shift_x)).all(axis=1)]
+        _copy_shifted(img_stack, frames, int(shift_y), int(shift_x), out)
+
+    subpixel_frames = np.flatnonzero(~is_integer)
+    for block_start in range(0, len(subpixel_frames), block_size):
+        frames = subpixel_frames[block_start:block_start + block_size]
+        if method == 'fourier':
+            shifted = _fourier_shift(img_stack[frames], shifts[frames])
+        else:
+            shifted = _bilinear_shift(img_stack[frames], shifts[frames])
+        out[frames] = _cast(shifted, out.dtype)
+    return out
+
+
+def _copy_shifted(img_stack, frames: np.ndarray, shift_y: int, shift_x: int, out: np.ndarray) -> None:
+    """Integer shift of a set of frames by slice copy into out, zero filling the uncovered border."""
+
+    shape_y, shape_x = img_stack.shape[1:]
+    if abs(shift_y) >= shape_y or abs(shift_x) >= shape_x:
+        out[frames] = 0
+        return
+    source_y, target_y = _integer_slices(shift_y, shape_y)
+    source_x, target_x = _integer_slices(shift_x, shape_x)
+
+    if len(frames) == frames[-1] - frames[0] + 1:
+        frames = slice(frames[0], frames[-1] + 1)
+    target = out[frames]
+    target[:, target_y, target_x] = _cast(img_stack[frames][:, source_y, source_x], out.dtype)
+    _zero_border(target, shift_y, shift_x)
+    if not isinstance(frames, slice):
+        out[frames] = target
+
+
+def _integer_slices(shift: int, length: int) -> tuple:
+    """Returns (source, target) slices along one axis for an integer shift."""
+
+    if shift >= 0:
+        return slice(0, length - shift), slice(shift, length)
+    return slice(-shift, length), slice(0, length + shift)
+
+
+def _zero_border(img_stack: np.ndarray, shift_y: int, shift_x: int) -> None:
+    """Zero the rows and columns that were shifted in from outside the frame."""
+
+    if shift_y > 0:
+        img_stack[:, :shift_y, :] = 0
+    elif shift_y < 0:
+        img_stack[:, shift_y:, :] = 0
+    if shift_x > 0:
+        img_stack[:, :, :shift_x] = 0
+    elif shift_x < 0:
+        img_stack[:, :, shift_x:] = 0
+
+
+def _bilinear_shift(img_stack, shifts: np.ndarray) -> np.ndarray:
+    """Sub-pixel shift by bilinear interpolation between the four neighbouring integer shifts.
+
+    Frames that share the integer part of their shift are interpolated together with four weighted slice additions,
+    a group of at most CACHE_BYTES of float32 frames at a time.
+    """
+
+    shape_y, shape_x = img_stack.shape[1:]
+    floor = np.floor(shifts).astype(int)
+    fraction = (shifts - floor).astype(np.float32)[:, :, np.newaxis, np.newaxis]
+    group_size = max(1, CACHE_BYTES // (4 * shape_y * shape_x))
+    shifted = np.empty(img_stack.shape, dtype=np.float32)
+    scratch = np.empty((min(group_size, len(img_stack)), shape_y, shape_x), dtype=np.float32)
+    for floor_y, floor_x in np.unique(floor, axis=0):
+        same_floor = np.flatnonzero((floor == (floor_y, floor_x)).all(axis=1))
+        for group_start in range(0, len(same_floor), group_size):
+            frames = same_floor[group_start:group_start + group_size]
+            source = np.asarray(img_stack[frames], dtype=np.float32)
+            target = np.zeros_like(source)
+            frac_y, frac_x = fraction[frames, 0], fraction[frames, 1]
+            for step_y, weight_y in ((0, 1 - frac_y), (1, frac_y)):
+                for step_x, weight_x in ((0, 1 - frac_x), (1, frac_x)):
+                    weight = weight_y * weight_x
+                    if weight.any():
+                        _add_shifted(source, floor_y + step_y, floor_x + step_x, weight, target,
+                                     scratch[:len(frames)])
+            shifted[frames] = target
+    return shifted
+
+
+def _add_shifted(img_stack: np.ndarray, shift_y: int, shift_x: int, weight: np.ndarray, target: np.ndarray,
+                 scratch: np.ndarray) -> None:
+    """Add integer shifted frames (z, y, x), weighted by weight (z, 1, 1), onto target using a scratch buffer."""
+
+    shape_y, shape_x = img_stack.shape[1:]
+    if abs(shift_y) >= shape_y or abs(shift_x) >= shape_x:
+        return
+    source_y, target_y = _integer_slices(shift_y, shape_y)
+    source_x, target_x = _integer_slices(shift_x, shape_x)
+    weighted = scratch[:, source_y, source_x]
+    np.multiply(img_stack[:, source_y, source_x], weight, out=weighted)
+    target[:, target_y, target_x] += weighted
+
+
+def _fourier_shift(img_stack, shifts: np.ndarray) -> np.ndarray:
+    """Sub-pixel shift by a phase ramp in the Fourier domain, zero filling the wrapped border."""
+
+    img_stack = np.asarray(img_stack, dtype=np.float32)
+    num_frames, shape_y, shape_x = img_stack.shape
+    freq_y = np.fft.fftfreq(shape_y).astype(np.float32)[np.newaxis, :, np.newaxis]
+    freq_x = np.fft.rfftfreq(shape_x).astype(np.float32)[np.newaxis, np.newaxis, :]
+    phase = (freq_y * shifts[:, 0, np.newaxis, np.newaxis].astype(np.float32) +
+             freq_x * shifts[:, 1, np.newaxis, np.newaxis].astype(np.float32))
+    ramp = np.exp(phase * np.complex64(-2j * np.pi))
+    shifted = _fft.irfft2(_fft.rfft2(img_stack) * ramp, s=(shape_y, shape_x)).astype(np.float32, copy=False)
+
+    rows = np.arange(shape_y)[np.newaxis, :]
+    cols = np.arange(shape_x)[np.newaxis, :]
+    shift_y, shift_x = shifts[:, 0, np.newaxis], shifts[:, 1, np.newaxis]
+    wrapped_rows = (rows < np.ceil(shift_y)) | (rows >= shape_y + np.floor(shift_y))
+    wrapped_cols = (cols < np.ceil(shift_x)) | (cols >= shape_x + np.floor(shift_x))
+    shifted[wrapped_rows[:, :, np.newaxis] | wrapped_cols[:, np.newaxis, :]] = 0
+    return shifted
+
+
+def _cast(img_stack: np.ndarray, dtype) -> np.ndarray:
+    """Cast to dtype, rounding and clipping to the representable range for integer types."""
+
+    dtype = np.dtype(dtype)
+    if img_stack.dtype == dtype or not np.issubdtype(dtype, np.integer):
+        return img_stack.astype(dtype, copy=False)
+    if np.issubdtype(img_stack.dtype, np.integer):
+        info = np.iinfo(dtype)
+        if np.iinfo(img_stack.dtype).min >= info.min and np.iinfo(img_stack.dtype).max <= info.max:
+            return img_stack.astype(dtype)
+        return np.clip(img_stack, info.min, info.max).astype(dtype)
+    info = np.iinfo(dtype)
+    return np.clip(np.rint(img_stack), info.min, info.max).astype(dtype)
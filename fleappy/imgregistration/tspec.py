@@ -0,0 +1,103 @@
+"""Binary storage of transform specifications.
+
+A transform file holds the frame by frame transformation of one piezo slice: the frame index, the (y,x) shift, the
+bidirectional phase offset, any further module specific parameters and the name of the registration module that
+estimated it. Values are stored at full precision in an uncompressed numpy archive, so a saved transform applies
+exactly as it was estimated.
+
+Transform files written as comma separated text by earlier versions can still be read.
+
+Example:
+    Save and reload a transformation:
+    ::code-block
+
+        $ tspec.write(Path('transform.tspec'), transform_spec, 'fleappy.imgregistration.fftreg')
+        $ transform_spec = tspec.read(Path('transform.tspec'), module_name='fleappy.imgregistration.fftreg')
+"""
+
+from pathlib import Path
+
+import numpy as np
+
+TSPEC_VERSION = 1
+
+
+def write(target, transform_spec, module_name: str) -> None:
+    """Write a transform specification to file.
+
+    Args:
+        target (Path): File to write the transformations to.
+        transform_spec (numpy.ndarray): Transformations (frames, 2) in (y,x), (frames, 3) with the phase offset in the
+            last column, or (frames, 2 + k) with k module specific parameters after the shift.
+        module_name (str): Name of the registration module the transformations belong to.
+
+    Raises:
+        TypeError: If target is not a Path.
+    """
+
+    if not isinstance(target, Path):
+        raise TypeError('Please specifiy a Path')
+    transform_spec = np.asarray(transform_spec, dtype=np.float64).reshape(-1, np.shape(transform_spec)[-1])
+    assert transform_spec.shape[1] >= 2, 'Transform specification must be of dimensions (n,2) or larger'
+    has_phase = transform_spec.shape[1] == 3
+    phase = transform_spec[:, 2] if has_phase else np.zeros(len(transform_spec))
+    params = transform_spec[:, 2:] if transform_spec.shape[1] > 3 else np.zeros((len(transform_spec), 0))
+    with open(target, 'wb') as file:
+        np.savez(file, version=np.array(TSPEC_VERSION), module=np.array(module_name),
+                 frame=np.arange(len(transform_spec), dtype=np.int64), shift=transform_spec[:, 0:2], phase=phase,
+                 has_phase=np.array(has_phase), params=params)
+
+
+def read(source, module_name: str = None) -> np.ndarray:
+    """Read a transform specification from file.
+
+    Args:
+        source (Path): File to read the transformations from.
+        module_name (str, optional): Defaults to None. Registration module expected to have written the file.
+
+    Raises:
+        ValueError: If the file was written by a different registration module or is of a newer version.
+
+    Returns:
+        numpy.ndarray: Transformations in frame order, (frames, 2) followed by the phase offset or module specific
+            parameters if the file holds them.
+    """
+
+    file_module, frame, shift, phase, params = _read_fields(Path(source))
+    if module_name is not None and file_module != module_name:
+        raise ValueError(f'{source} holds transformations of {file_module} not {module_name}')
+    order = np.argsort(frame, kind='stable')
+    columns = [shift] + ([phase] if phase is not None else []) + [params]
+    return np.column_stack(columns)[order]
+
+
+def module(source) -> str:
+    """Returns the name of the registration module that wrote a transform file."""
+
+    return _read_fields(Path(source))[0]
+
+
+def _read_fields(source: Path) -> tuple:
+    """Returns (module, frame, shift, phase, params) of a transform file, phase is None if it was not stored."""
+
+    with open(source, 'rb') as file:
+        is_archive = file.read(4) == b'PK\x03\x04'
+    if not is_archive:
+        return _read_text(source)
+    with np.load(source, allow_pickle=False) as archive:
+        if int(archive['version']) > TSPEC_VERSION:
+            raise ValueError(f'{source} is of transform file version {int(archive["version"])}, newer than '
+                             f'{TSPEC_VERSION}')
+        phase = archive['phase'] if bool(archive['has_phase']) else None
+        params = archive['params'] if 'params' in archive.files else np.zeros((len(archive['frame']), 0))
+        return str(archive['module']), archive['frame'], archive['shift'], phase, params
+
+
+def _read_text(source: Path) -> tuple:
+    """Reads the comma separated text files with a module name header written by earlier versions."""
+
+    with open(source, 'r') as file:
+        file_module = file.readline().lstrip('#').strip()
+    values = np.loadtxt(source, delimiter=',', ndmin=2)
+    phase = values[:, 2] if values.shape[1] == 3 else None
+    return file_module, np.arange(len(values)), values[:, 0:2], phase, np.zeros((len(values), 0))
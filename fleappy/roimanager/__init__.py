@@ -1,5 +1,6 @@
 name = 'roimanager'
 
 
-__all__ = ['imagejroi', 'roiplotter', 'nproi', 'roi']
-from fleappy.roimanager.roi import Roi
\ No newline at end of file
+__all__ = ['imagejroi', 'roiplotter', 'nproi', 'roi', 'roiset', 'traces']
+from fleappy.roimanager.roi import Roi
+from fleappy.roimanager.roiset import RoiSet
\ No newline at end of file
@@ -9,17 +9,59 @@ from read_roi import read_roi_zip
 from matplotlib.path import Path as MplPath
 import numpy as np
 from pathlib import Path
+from scipy.sparse import csr_matrix
 from . import nproi
 import imageio
 
 DEFAULT_FRAME_SIZE = (512, 512)
 """tuple: Frame size in pixels to be used for generating roi masks."""
 
+POLYGON_TYPES = ('polygon', 'freehand', 'traced')
+"""tuple: ImageJ roi types rasterized from their outline."""
+
 
 def _fill_contour(roi):
     return np.maximum.accumulate(roi, 1) & np.maximum.accumulate(roi[:, ::-1], 1)[:, ::-1]
 
 
+def to_sparse(roi_value, framesize: tuple = DEFAULT_FRAME_SIZE)->csr_matrix:
+    """Convert ImageJ roi to a sparse mask.
+
+    Only the bounding box of the roi is rasterized. Polygon, freehand and traced rois hold the pixels whose (x, y)
+    coordinates lie inside the outline. Rectangle and oval rois, and freehand ellipses, hold the pixels whose centers
+    lie inside the shape as in ImageJ. Parts of a roi outside the frame are cut off.
+
+    Args:
+        roi_value (ImageJ ROI): ImageJ Roi as read by read_roi.
+        framesize (tuple, optional): Defaults to DEFAULT_FRAME_SIZE. Frame size to use (y,x) should be type int.
+
+    Raises:
+        ValueError: If the roi type is not supported.
+
+    Returns:
+        scipy.sparse.csr_matrix: Boolean mask (y, x).
+    """
+
+    roi_type = roi_value.get('type')
+    if roi_type == 'rectangle':
+        top, left, inside = _rectangle_mask(roi_value, framesize)
+    elif roi_type == 'oval':
+        top, left, inside = _oval_mask(roi_value, framesize)
+    elif roi_type == 'freehand' and 'ex1' in roi_value:
+        top, left, inside = _ellipse_mask(roi_value, framesize)
+    elif roi_type in POLYGON_TYPES:
+        top, left, inside = _polygon_mask(roi_value, framesize)
+    else:
+        raise ValueError(f'Unsupported ImageJ roi type {roi_type}, use one of rectangle, oval, '
+                         f'{", ".join(POLYGON_TYPES)}')
+    # The bounding box mask is row major, so its pixels are already in CSR order
+    _, columns = np.nonzero(inside)
+    indptr = np.zeros(framesize[0] + 1, dtype=np.int32)
+    indptr[top + 1:top + 1 + inside.shape[0]] = inside.sum(axis=1)
+    return csr_matrix((np.ones(len(columns), dtype=np.bool_), (columns + left).astype(np.int32), np.cumsum(indptr)),
+                      shape=tuple(framesize))
+
+
 def to_array(roi_value, framesize: tuple = DEFAULT_FRAME_SIZE)->np.ndarray:
     """Convert ImageJ roi to numpy array mask.
 
@@ -28,17 +70,24 @@ def to_array(roi_value, framesize: tuple = DEFAULT_FRAME_SIZE)->np.ndarray:
         framesize (tuple, optional): Defaults to DEFAULT_FRAME_SIZE. Frame size to use (y,x) should be type int.
 
     Returns:
-        numpy.ndarray: [description]
+        numpy.ndarray: Boolean mask (y, x).
     """
 
-    x, y = np.meshgrid(np.arange(framesize[0]), np.arange(framesize[1]))
-    x, y = x.flatten(), y.flatten()
-    points = np.vstack((x, y)).T
+    return to_sparse(roi_value, framesize=framesize).toarray()
 
-    pth = MplPath(list(zip(roi_value['x'], roi_value['y'])))
-    grid = pth.contains_points(points)
-    mask = grid.reshape(framesize[1], framesize[0])
-    return mask
+
+def to_masks(rois: dict, framesize: tuple = DEFAULT_FRAME_SIZE)->tuple:
+    """Convert dictionary of ImageJ rois to sparse masks.
+
+    Args:
+        rois (dict): ImageJ rois from zip file.
+        framesize (tuple, optional): Defaults to DEFAULT_FRAME_SIZE. Frame size to use (y,x) should be type int.
+
+    Returns:
+        list, list: list of roi names, list of sparse masks (y, x)
+    """
+
+    return list(rois.keys()), [to_sparse(roi_value, framesize=framesize) for roi_value in rois.values()]
 
 
 def to_stack(rois: dict, framesize: tuple = DEFAULT_FRAME_SIZE):
@@ -52,15 +101,29 @@ def to_stack(rois: dict, framesize: tuple = DEFAULT_FRAME_SIZE):
         list, numpy.ndarray: list of roi names, numpy array of masks (# cell , y , x)
     """
 
+    names, masks = to_masks(rois, framesize=framesize)
     tiffstack = np.zeros(
-        (len(rois.keys()), framesize[0], framesize[1]), dtype=np.bool)
+        (len(masks), framesize[0], framesize[1]), dtype=np.bool_)
 
-    for idx, (roi_name, roi_value) in enumerate(rois.items()):
-        tiffstack[idx, :, :] = to_array(roi_value, framesize=framesize)
-    names = list(rois.keys())
+    for idx, mask in enumerate(masks):
+        tiffstack[idx, :, :] = mask.toarray()
     return names, tiffstack
 
 
+def zip_to_masks(filesource, framesize: tuple = DEFAULT_FRAME_SIZE)->tuple:
+    """Open a .zip of imagej rois as sparse masks.
+
+    Args:
+        filesource (str or Path): File path for ImageJ rois as a zip file
+        framesize (tuple, optional): Defaults to DEFAULT_FRAME_SIZE. Frame size to use (y,x) should be type int.
+
+    Returns:
+        list, list: list of roi names, list of sparse masks (y, x)
+    """
+
+    return to_masks(read_roi_zip(str(filesource)), framesize=framesize)
+
+
 def zip_to_tif(filesource: str, filetarget: str, framesize: tuple = DEFAULT_FRAME_SIZE):
     """Open a .zip of imagej rois and write them to a tif file
 
@@ -69,7 +132,7 @@ def zip_to_tif(filesource: str, filetarget: str, framesize: tuple = DEFAULT_FRAM
     Args:
         filesource(str): File path for ImageJ rois as a zip file
         filetarget(str): File path to write tif stack of ROIS
-        framesize(tuple, optional): Defaults to DEFAULT_FRAME_SIZE. [description]
+        framesize(tuple, optional): Defaults to DEFAULT_FRAME_SIZE. Frame size to use (y,x) should be type int.
 
     Returns:
         None
@@ -82,10 +145,73 @@ def zip_to_tif(filesource: str, filetarget: str, framesize: tuple = DEFAULT_FRAM
     assert isinstance(filetarget, str) and filetarget.endswith(
         '.tif') and '\\' not in filetarget, 'Specify file target as a .tif file as a string using unix style!'
 
-    names, tiffstack = to_stack(read_roi_zip(Path(filesource)))
+    names, tiffstack = to_stack(read_roi_zip(Path(filesource)), framesize=framesize)
 
     imageio.mimwrite(Path(filetarget), tiffstack.astype(np.uint8))
     with open(filetarget+'.names', 'w') as f:
         f.write(';'.join(names))
 
     return None
+
+
+def _clip_box(top: float, left: float, bottom: float, right: float, framesize: tuple) -> tuple:
+    """Returns the integer pixel box (top, left, bottom, right) of a bounding box within the frame."""
+
+    return (max(0, int(np.floor(top))), max(0, int(np.floor(left))),
+            min(framesize[0], int(np.ceil(bottom)) + 1), min(framesize[1], int(np.ceil(right)) + 1))
+
+
+def _rectangle_mask(roi_value, framesize: tuple) -> tuple:
+    """Pixels with centers inside a rectangle roi, as (top, left, mask of the bounding box)."""
+
+    top, left, bottom, right = _clip_box(roi_value['top'], roi_value['left'], roi_value['top'] + roi_value['height'],
+                                         roi_value['left'] + roi_value['width'], framesize)
+    centers_y = np.arange(top, max(top, bottom)) + 0.5
+    centers_x = np.arange(left, max(left, right)) + 0.5
+    inside_y = (centers_y >= roi_value['top']) & (centers_y < roi_value['top'] + roi_value['height'])
+    inside_x = (centers_x >= roi_value['left']) & (centers_x < roi_value['left'] + roi_value['width'])
+    return top, left, inside_y[:, np.newaxis] & inside_x[np.newaxis, :]
+
+
+def _oval_mask(roi_value, framesize: tuple) -> tuple:
+    """Pixels with centers inside an oval roi, as (top, left, mask of the bounding box)."""
+
+    radius_y, radius_x = roi_value['height'] / 2, roi_value['width'] / 2
+    center_y, center_x = roi_value['top'] + radius_y, roi_value['left'] + radius_x
+    top, left, bottom, right = _clip_box(roi_value['top'], roi_value['left'], roi_value['top'] + roi_value['height'],
+                                         roi_value['left'] + roi_value['width'], framesize)
+    if radius_y <= 0 or radius_x <= 0:
+        return top, left, np.zeros((0, 0), dtype=np.bool_)
+    offset_y = (np.arange(top, max(top, bottom)) + 0.5 - center_y) / radius_y
+    offset_x = (np.arange(left, max(left, right)) + 0.5 - center_x) / radius_x
+    return top, left, offset_y[:, np.newaxis] ** 2 + offset_x[np.newaxis, :] ** 2 <= 1
+
+
+def _ellipse_mask(roi_value, framesize: tuple) -> tuple:
+    """Pixels with centers inside a freehand ellipse roi, as (top, left, mask of the bounding box)."""
+
+    center_x, center_y = (roi_value['ex1'] + roi_value['ex2']) / 2, (roi_value['ey1'] + roi_value['ey2']) / 2
+    major = np.hypot(roi_value['ex2'] - roi_value['ex1'], roi_value['ey2'] - roi_value['ey1']) / 2
+    minor = major * roi_value['aspect_ratio']
+    top, left, bottom, right = _clip_box(center_y - major, center_x - major, center_y + major, center_x + major,
+                                         framesize)
+    if minor <= 0:
+        return top, left, np.zeros((0, 0), dtype=np.bool_)
+    angle = np.arctan2(roi_value['ey2'] - roi_value['ey1'], roi_value['ex2'] - roi_value['ex1'])
+    offset_y = np.arange(top, max(top, bottom))[:, np.newaxis] + 0.5 - center_y
+    offset_x = np.arange(left, max(left, right))[np.newaxis, :] + 0.5 - center_x
+    along = offset_x * np.cos(angle) + offset_y * np.sin(angle)
+    across = -offset_x * np.sin(angle) + offset_y * np.cos(angle)
+    return top, left, (along / major) ** 2 + (across / minor) ** 2 <= 1
+
+
+def _polygon_mask(roi_value, framesize: tuple) -> tuple:
+    """Pixels with coordinates inside a polygon roi, as (top, left, mask of the bounding box)."""
+
+    vertices_x, vertices_y = np.asarray(roi_value['x'], dtype=np.float64), np.asarray(roi_value['y'], dtype=np.float64)
+    top, left, bottom, right = _clip_box(vertices_y.min(), vertices_x.min(), vertices_y.max(), vertices_x.max(),
+                                         framesize)
+    grid_y, grid_x = np.mgrid[top:max(top, bottom), left:max(left, right)]
+    pth = MplPath(np.column_stack((vertices_x, vertices_y)))
+    inside = pth.contains_points(np.column_stack((grid_x.ravel(), grid_y.ravel())))
+    return top, left, inside.reshape(grid_y.shape)
@@ -1,5 +1,6 @@
 import numpy as np
 from scipy.ndimage.measurements import center_of_mass
+from scipy.sparse import csr_matrix, issparse
 import skimage.io as io
 from pathlib import Path
 from typing import Union
@@ -20,23 +21,88 @@ def centroid(roi)->tuple:
     return center_of_mass(roi)
 
 
-def tseries_data(rois: np.ndarray, timedata: np.ndarray)->np.ndarray:
+def tseries_data(rois, timedata, chunk_frames: int = 500, dtype=np.float64)->np.ndarray:
     """Compute time series data for rois over timedata.
 
+    Each value is the mean of the roi over a frame, weighted by the mask values for non-binary masks.
+
     Args:
-        rois (np.ndarray): Array of ROIs.
-        timedata (np.ndarray): Array of imaging data.
+        rois (np.ndarray or list): Array of ROIs (cells, y, x) or list of sparse roi masks.
+        timedata (np.ndarray): Array of imaging data (time, y, x), read a chunk at a time.
+        chunk_frames (int, optional): Defaults to 500. Number of frames reduced at once.
+        dtype (type, optional): Defaults to numpy.float64. Data type of the time series,
+            numpy.float32 halves the memory used.
 
     Returns:
         np.ndarray: Array of time series data (cell, time).
     """
 
-    ts_data = np.empty((rois.shape[0], timedata.shape[0]))
+    return extract_traces(roi_weights(rois, dtype=dtype), timedata, chunk_frames=chunk_frames, dtype=dtype)
+
+
+def roi_weights(rois, dtype=np.float64)->csr_matrix:
+    """Build the sparse weight matrix that averages every roi over a flattened frame.
+
+    Row i holds the mask of roi i over the frame flattened in C order, scaled to sum to 1, so that the product with a
+    flattened frame is the (weighted) mean of each roi. Rois with an empty mask get an empty row.
+
+    Args:
+        rois (np.ndarray or list): Array of ROIs (cells, y, x) or list of sparse roi masks, e.g. Roi.mask.
+        dtype (type, optional): Defaults to numpy.float64. Data type of the weights.
+
+    Returns:
+        scipy.sparse.csr_matrix: Roi weights (cells, y * x).
+    """
 
+    rows, columns, values = [], [], []
+    frame_shape = None
     for roi_idx, roi in enumerate(rois):
-        for t_index, frame in enumerate(timedata):
-            ts_data[roi_idx, t_index] = np.mean(frame[roi])
-    return ts_data
+        mask = roi.tocoo() if issparse(roi) else csr_matrix(np.asarray(roi)).tocoo()
+        assert frame_shape is None or mask.shape == frame_shape, 'All rois need the same frame size'
+        frame_shape = mask.shape
+        values.append(mask.data.astype(np.float64) / max(mask.data.sum(dtype=np.float64), np.finfo(np.float64).tiny))
+        rows.append(np.full(mask.nnz, roi_idx, dtype=np.int64))
+        columns.append(mask.row.astype(np.int64) * mask.shape[1] + mask.col)
+    assert frame_shape is not None, 'No rois'
+    return csr_matrix((np.concatenate(values).astype(dtype), (np.concatenate(rows), np.concatenate(columns))),
+                      shape=(len(values), frame_shape[0] * frame_shape[1]))
+
+
+def extract_traces(weights: csr_matrix, timedata, chunk_frames: int = 500, dtype=np.float64,
+                   out: np.ndarray = None)->np.ndarray:
+    """Compute the time series of every roi from a sparse weight matrix.
+
+    Only the pixels inside some roi are read from each chunk of frames, which is then reduced to all time series by a
+    single sparse matrix product.
+
+    Args:
+        weights (scipy.sparse.csr_matrix): Roi weights (cells, y * x) as returned by roi_weights.
+        timedata (np.ndarray): Array of imaging data (time, y, x), read a chunk at a time.
+        chunk_frames (int, optional): Defaults to 500. Number of frames reduced at once, bounds memory use.
+        dtype (type, optional): Defaults to numpy.float64. Data type of the time series,
+            numpy.float32 halves the memory used.
+        out (np.ndarray, optional): Defaults to None. Array (cells, time) to write the time series to.
+
+    Returns:
+        np.ndarray: Array of time series data (cell, time), rois with an empty mask are nan.
+    """
+
+    num_frames = len(timedata)
+    if out is None:
+        out = np.empty((weights.shape[0], num_frames), dtype=dtype)
+    assert out.shape == (weights.shape[0], num_frames), 'Output does not match the rois and frames'
+    assert chunk_frames > 0, 'Need at least one frame per chunk'
+
+    pixels = np.unique(weights.indices)
+    pixel_weights = weights[:, pixels].astype(out.dtype)
+    empty = np.diff(weights.indptr) == 0
+    for start in range(0, num_frames, chunk_frames):
+        chunk = np.asarray(timedata[start:start + chunk_frames])
+        assert chunk.shape[1] * chunk.shape[2] == weights.shape[1], 'Frame size does not match the rois'
+        values = chunk.reshape(len(chunk), -1)[:, pixels].astype(out.dtype, copy=False)
+        out[:, start:start + len(chunk)] = pixel_weights.dot(values.T)
+    out[empty] = np.nan
+    return out
 
 
 def load_from_file(filename: Union[str, Path])->np.ndarray:
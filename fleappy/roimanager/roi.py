@@ -1,7 +1,8 @@
+import hashlib
 import os
 import numpy as np
 import fleappy.roimanager.nproi
-from scipy.sparse import csr_matrix
+from scipy.sparse import csr_matrix, issparse
 
 
 class Roi(object):
@@ -35,9 +36,27 @@ class Roi(object):
         return ret_str
 
     def __eq__(self, other):
-        if (self.mask.todense() != other.mask.todense()).any():
+        if self.mask.shape != other.mask.shape:
             return False
-        return True
+        mask, other_mask = _canonical(self.mask), _canonical(other.mask)
+        return (np.array_equal(mask.indptr, other_mask.indptr) and np.array_equal(mask.indices, other_mask.indices)
+                and np.array_equal(mask.data, other_mask.data))
+
+    def mask_hash(self)->str:
+        """Returns a hash of the pixels in the roi mask.
+
+        The hash is taken over the shape and the indices and indptr of the mask in canonical CSR form, so rois with
+        equal masks have equal hashes whatever the dtype or storage of their masks. Mask values are not hashed.
+
+        Returns:
+            str: Hex digest of the mask.
+        """
+
+        mask = _canonical(self.mask)
+        sha = hashlib.sha1(np.asarray(mask.shape, dtype=np.int64).tobytes())
+        sha.update(mask.indptr.astype(np.int64).tobytes())
+        sha.update(mask.indices.astype(np.int64).tobytes())
+        return sha.hexdigest()
 
     def centroid(self)->tuple:
         """Returns the centroid of the roi
@@ -47,3 +66,14 @@ class Roi(object):
         """
 
         return fleappy.roimanager.nproi.centroid(self.mask.toarray())
+
+
+def _canonical(mask) -> csr_matrix:
+    """Returns a mask in CSR form with sorted indices and without duplicate or explicitly stored zero entries."""
+
+    mask = mask.tocsr() if issparse(mask) else csr_matrix(mask)
+    if not mask.has_canonical_format or not mask.data.all():
+        mask = mask.copy()
+        mask.sum_duplicates()
+        mask.eliminate_zeros()
+    return mask
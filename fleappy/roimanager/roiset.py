@@ -0,0 +1,157 @@
+"""Hash indexed collection of ROIs.
+
+RoiSet is a list of Roi objects that also keeps each ROI in dictionaries keyed by the hash of its mask (see
+Roi.mask_hash), its id and its name. Membership tests and lookups by id or name take constant time instead of
+comparing against every ROI, while indexing, iteration and len behave as for a list. ROIs with equal hashes are
+compared with Roi.__eq__, so membership is exact.
+
+Masks are hashed when a ROI is added, so a mask must not be changed in place while its ROI is in a set.
+
+Example:
+    Merge the rois of two sessions, skipping duplicate masks:
+    ::code-block
+
+        $ rois = RoiSet(session1.roi)
+        $ num_added = rois.merge(session2.roi)
+        $ soma = rois.by_name('0012-0034')
+"""
+
+from fleappy.roimanager.roi import Roi
+
+
+class RoiSet(list):
+    """List of ROIs indexed by mask hash, id and name."""
+
+    __slots__ = ['_by_hash', '_by_id', '_by_name']
+
+    def __init__(self, rois=()) -> None:
+        list.__init__(self)
+        self._reindex()
+        self.extend(rois)
+
+    def __reduce__(self):
+        return (RoiSet, (list(self),))
+
+    def __contains__(self, roi) -> bool:
+        if not isinstance(roi, Roi):
+            return False
+        return any(roi == other for other in self._by_hash.get(roi.mask_hash(), ()))
+
+    def __setitem__(self, key, value) -> None:
+        list.__setitem__(self, key, value)
+        self._reindex()
+
+    def __delitem__(self, key) -> None:
+        list.__delitem__(self, key)
+        self._reindex()
+
+    def __iadd__(self, rois):
+        self.extend(rois)
+        return self
+
+    def __imul__(self, count: int):
+        list.__imul__(self, count)
+        self._reindex()
+        return self
+
+    def append(self, roi: Roi) -> None:
+        """Add a roi at the end of the set."""
+
+        list.append(self, roi)
+        self._add(roi)
+
+    def extend(self, rois) -> None:
+        """Add rois at the end of the set."""
+
+        for roi in rois:
+            self.append(roi)
+
+    def insert(self, index: int, roi: Roi) -> None:
+        """Insert a roi before index."""
+
+        list.insert(self, index, roi)
+        self._add(roi)
+
+    def pop(self, index: int = -1) -> Roi:
+        """Remove and return the roi at index, the last by default."""
+
+        roi = list.pop(self, index)
+        self._discard(roi)
+        return roi
+
+    def remove(self, roi: Roi) -> None:
+        """Remove the first roi equal to roi.
+
+        Raises:
+            ValueError: If there is no equal roi.
+        """
+
+        for idx, other in enumerate(self):
+            if other is roi:
+                break
+        else:
+            idx = self.index(roi)
+        self.pop(idx)
+
+    def clear(self) -> None:
+        """Remove all rois."""
+
+        list.clear(self)
+        self._reindex()
+
+    def merge(self, rois) -> int:
+        """Add the rois whose masks are not in the set yet.
+
+        Args:
+            rois (iterable): Rois to add.
+
+        Returns:
+            int: Number of rois added.
+        """
+
+        num_added = 0
+        for roi in rois:
+            if roi not in self:
+                self.append(roi)
+                num_added += 1
+        return num_added
+
+    def by_id(self, roi_id) -> Roi:
+        """Returns the roi with an id, the one added first if several share it.
+
+        Raises:
+            KeyError: If no roi has the id.
+        """
+
+        return self._by_id[roi_id][0]
+
+    def by_name(self, name: str) -> Roi:
+        """Returns the roi with a name, the one added first if several share it.
+
+        Raises:
+            KeyError: If no roi has the name.
+        """
+
+        return self._by_name[name][0]
+
+    def _add(self, roi: Roi) -> None:
+        assert isinstance(roi, Roi), 'Only Roi objects can be added to a RoiSet'
+        self._by_hash.setdefault(roi.mask_hash(), []).append(roi)
+        self._by_id.setdefault(roi.id, []).append(roi)
+        self._by_name.setdefault(roi.name, []).append(roi)
+
+    def _discard(self, roi: Roi) -> None:
+        for index, key in [(self._by_hash, roi.mask_hash()), (self._by_id, roi.id), (self._by_name, roi.name)]:
+            entries = index[key]
+            entries.pop(next(idx for idx, other in enumerate(entries) if other is roi))
+            if not entries:
+                del index[key]
+
+    def _reindex(self) -> None:
+        """Rebuild the indices from the list after changes to several positions at once."""
+
+        self._by_hash = {}
+        self._by_id = {}
+        self._by_name = {}
+        for roi in self:
+            self._add(roi)
@@ -0,0 +1,196 @@
+"""Streaming extraction of ROI time series from registered files.
+
+The registered files of a slice are split into chunks of frames at known offsets into the series. Every chunk is read
+on its own through the lazy readers of fleappy.tiffread.registered (memory mapped for tif files, chunked for HDF5
+files) and reduced to the time series of all ROIs by the sparse weight matrix of nproi.roi_weights. The series are
+written in place into a preallocated (roi, time) array, so memory use is one chunk of frames per worker however long
+the session is.
+
+With more than one worker, chunks are reduced on a pool of worker processes that write into the output array through
+shared memory. Only the file names, frame ranges and the sparse weights are sent to the workers.
+
+Registration can skip the registered files altogether: a TraceWriter passed as the writer of a slice extracts the time
+series from the registered frames while they are in memory and writes them as `stack_c<channel #>_<batch #>.npz`.
+read_traces reads them back as one (roi, time) array.
+
+Example:
+    Extract the time series of every ROI from the registered files of channel 1 with 4 workers:
+    ::code-block
+
+        $ weights = nproi.roi_weights([roi.mask for roi in rois])
+        $ ts_data = traces.extract_files(weights, sorted(slice_path.glob('stack_c1_*.tif')), workers=4)
+"""
+
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import natsort as ns
+import numpy as np
+from scipy.sparse import csr_matrix, issparse
+
+from fleappy.roimanager import nproi
+from fleappy.tiffread.registered import RegisteredStack
+from fleappy.tiffread.sharedstack import SharedStack, pool_context
+
+logger = logging.getLogger(__name__)
+
+
+def extract_files(weights: csr_matrix, files: list, workers: int = 1, chunk_frames: int = 500,
+                  dtype=np.float64) -> np.ndarray:
+    """Compute the time series of every roi over a series of registered files.
+
+    Args:
+        weights (scipy.sparse.csr_matrix): Roi weights (cells, y * x) as returned by nproi.roi_weights.
+        files (list): Registered files (tif or HDF5) in frame order.
+        workers (int, optional): Defaults to 1. Number of worker processes, 1 extracts in this process.
+        chunk_frames (int, optional): Defaults to 500. Number of frames read and reduced at once by a worker.
+        dtype (type, optional): Defaults to numpy.float64. Data type of the time series,
+            numpy.float32 halves the memory used.
+
+    Returns:
+        numpy.ndarray: Array of time series data (cell, time), rois with an empty mask are nan.
+    """
+
+    assert len(files) > 0, 'No registered files!'
+    assert chunk_frames > 0, 'Need at least one frame per chunk'
+    files = [Path(path) for path in files]
+    if workers <= 1:
+        with RegisteredStack(files) as stack:
+            return nproi.extract_traces(weights, stack, chunk_frames=chunk_frames, dtype=dtype)
+
+    units = chunk_units(files, chunk_frames)
+    num_frames = units[-1][3] + units[-1][2] - units[-1][1] if units else 0
+    logger.info('Extracting %i rois from %i frames in %i files on %i workers', weights.shape[0], num_frames,
+                len(files), workers)
+    target = SharedStack((weights.shape[0], num_frames), dtype)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context()) as executor:
+            futures = [executor.submit(_extract_unit, weights, str(path), start, stop, offset, target)
+                       for path, start, stop, offset in units]
+            for future in futures:
+                future.result()
+        return np.array(target.array)
+    finally:
+        target.close()
+
+
+class TraceWriter(object):
+    """Writes the time series of the rois of a piezo slice extracted from registered stacks instead of the images.
+
+    Attributes:
+        weights (scipy.sparse.csr_matrix): Sparse roi weights (cells, y * x), see nproi.roi_weights.
+        dtype (numpy.dtype): Data type of the time series.
+    """
+
+    __slots__ = ['weights', 'dtype']
+
+    suffix = '.npz'
+
+    def __init__(self, rois, dtype=np.float64) -> None:
+        """Prepare the roi weights of the slice.
+
+        Args:
+            rois (list or scipy.sparse.csr_matrix): Rois of the slice, either a list of masks (e.g. Roi.mask) or
+                weights as returned by nproi.roi_weights.
+            dtype (type, optional): Defaults to numpy.float64. Data type of the time series,
+                numpy.float32 halves the memory used.
+        """
+
+        self.dtype = np.dtype(dtype)
+        self.weights = rois.tocsr().astype(self.dtype) if issparse(rois) else nproi.roi_weights(rois, dtype=self.dtype)
+
+    def digest(self) -> str:
+        """Returns a hash of the roi weights, which identifies the time series a run writes."""
+
+        sha = hashlib.sha1(np.asarray(self.weights.shape, dtype=np.int64).tobytes())
+        for array in [self.weights.indptr, self.weights.indices, self.weights.data]:
+            sha.update(np.ascontiguousarray(array).tobytes())
+        return sha.hexdigest()
+
+    def write(self, img_stack, path_name) -> None:
+        """Write the time series of the rois over a stack (z, y, x) to an npz file.
+
+        Args:
+            img_stack (numpy.ndarray): Images (z, y, x) or a single image (y, x).
+            path_name (Path): File to write to, must end in .npz.
+        """
+
+        path_name = Path(path_name)
+        assert path_name.suffix == self.suffix, 'Please specify a .npz'
+        img_stack = np.asarray(img_stack)
+        if len(img_stack.shape) < 3:
+            img_stack = img_stack[np.newaxis, :, :]
+        traces = nproi.extract_traces(self.weights, img_stack, dtype=self.dtype)
+        with open(path_name, 'wb') as file:
+            np.savez(file, traces=traces)
+
+    def close(self) -> None:
+        """Does nothing, every call to write saves a complete npz file of the batch and keeps no file open.
+
+        Present because register closes the writers it creates once the run is done.
+        """
+
+
+def read_traces(slice_path, channel: int = None) -> np.ndarray:
+    """Read the time series written by a TraceWriter for a slice and channel.
+
+    Args:
+        slice_path (Path): Directory of the slice, '<directory>/<seriesname>/Registered/slice<#>'.
+        channel (int, optional): Defaults to None and will use the lowest channel found. ScanImage channel number.
+
+    Raises:
+        FileNotFoundError: If there are no time series files for the channel.
+
+    Returns:
+        numpy.ndarray: Time series (roi, time) of all batches.
+    """
+
+    files = list(Path(slice_path).glob(f'stack_c{"*" if channel is None else channel}_*{TraceWriter.suffix}'))
+    if channel is None and files:
+        channel = min(int(path.name.split('_')[1][1:]) for path in files)
+        files = [path for path in files if path.name.startswith(f'stack_c{channel}_')]
+    if not files:
+        raise FileNotFoundError(f'No time series files for channel {channel} in {slice_path}')
+    traces = []
+    for path in ns.natsorted(files, alg=ns.PATH):
+        with np.load(path, allow_pickle=False) as archive:
+            traces.append(archive['traces'])
+    return np.concatenate(traces, axis=1)
+
+
+def chunk_units(files: list, chunk_frames: int) -> list:
+    """Split registered files into chunks of frames.
+
+    Args:
+        files (list): Registered files in frame order.
+        chunk_frames (int): Largest number of frames in a chunk.
+
+    Returns:
+        list: (file, start, stop, offset) for each chunk, frames start:stop of the file are frames
+            offset:offset + stop - start of the series.
+    """
+
+    units = []
+    offset = 0
+    for path in files:
+        with RegisteredStack([path]) as stack:
+            num_frames = len(stack)
+        for start in range(0, num_frames, chunk_frames):
+            stop = min(start + chunk_frames, num_frames)
+            units.append((Path(path), start, stop, offset + start))
+        offset += num_frames
+    return units
+
+
+def _extract_unit(weights: csr_matrix, path: str, start: int, stop: int, offset: int, target: SharedStack) -> None:
+    """Worker: reduce frames start:stop of a file into columns offset:offset + stop - start of the shared output."""
+
+    try:
+        with RegisteredStack([path]) as stack:
+            frames = stack.read(start, stop)
+        nproi.extract_traces(weights, frames, chunk_frames=len(frames),
+                             out=target.array[:, offset:offset + len(frames)])
+    finally:
+        target.close()
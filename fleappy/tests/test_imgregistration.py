@@ -0,0 +1,398 @@
+import shutil
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+
+from fleappy.imgregistration import (ImageRegistration, dummy, fftreg, piecewise, prefetch, quality, stores,
+                                     templatematching, templatematchpc, templates, translate)
+from fleappy.imgregistration.pyramid import PyramidModule
+from fleappy.roimanager import nproi, traces
+from fleappy.tiffread import scanimage, synthetic
+
+SERIES = 'run_'
+
+
+def _series(directory, num_volumes=240, frames_per_file=100, **kwargs):
+    synthetic.make_series(directory, SERIES, num_volumes, frames_per_file=frames_per_file, shape=(64, 64), **kwargs)
+    return str(directory)
+
+
+def _registered(directory) -> dict:
+    """Returns the bytes of every registered image and transformation of a series, by relative path."""
+
+    registered = Path(directory, SERIES, 'Registered')
+    return {str(path.relative_to(registered)): path.read_bytes() for path in sorted(registered.rglob('*'))
+            if path.is_file() and 'checkpoint' not in path.parts}
+
+
+def _read_frames(path_name):
+    with scanimage.open_si_tiffstack(path_name) as stack:
+        return stack.read()
+
+
+class CrashingWriter(stores.TiffWriter):
+    """Tif writer failing on the stacks of a batch, as a run killed while writing."""
+
+    __slots__ = ['batch']
+
+    def __init__(self, batch: int) -> None:
+        self.batch = batch
+
+    def write(self, img_stack, path_name) -> None:
+        if Path(path_name).stem.endswith(f'_{self.batch}'):
+            raise RuntimeError('Crash')
+        stores.TiffWriter.write(self, img_stack, path_name)
+
+
+@pytest.mark.parametrize('reg_module', [templatematchpc, PyramidModule(fftreg, levels=1),
+                                        PyramidModule(templatematching, levels=1, maxmovement=12)],
+                         ids=['templatematchpc', 'pyramid_fftreg', 'pyramid_templatematching'])
+def test_parallel_matches_serial(tmp_path, reg_module):
+    registered = []
+    for name, kwargs in [('serial', {'workers': 1}), ('parallel', {'workers': 2, 'chunk_frames': 33})]:
+        directory = _series(tmp_path / name, slices=2, channels=(1, 2))
+        ImageRegistration(reg_module=reg_module).register(directory, SERIES, chunksize=120, **kwargs)
+        registered.append(_registered(directory))
+    assert registered[0].keys() == registered[1].keys()
+    assert all(registered[0][key] == registered[1][key] for key in registered[0])
+
+
+@pytest.mark.parametrize('batch_size', [1, 64, 100, 150, 1000])
+@pytest.mark.parametrize('skip', [0, 30])
+def test_iter_batches_keeps_every_frame(batch_size, skip):
+    data = [np.arange(start, stop)[:, np.newaxis, np.newaxis] * np.ones((1, 2, 3), dtype=np.int16)
+            for start, stop in [(0, 100), (100, 137), (137, 138), (138, 300)]]
+    batches = [batch.copy() for batch in prefetch.iter_batches(enumerate(data), batch_size, total_frames=300,
+                                                                skip=skip)]
+    assert all(len(batch) == batch_size for batch in batches[:-1])
+    np.testing.assert_array_equal(np.concatenate(batches), np.concatenate(data)[skip:])
+
+
+def test_iter_batches_of_files(tmp_path):
+    truth = synthetic.make_series(tmp_path, SERIES, 250, frames_per_file=60, shape=(32, 32))
+    frames = np.concatenate([_read_frames(path) for path in truth['files']])
+    with prefetch.PrefetchReader(truth['files'], _read_frames) as reader:
+        batches = [batch.copy() for batch in prefetch.iter_batches(reader, 80, total_frames=250)]
+    np.testing.assert_array_equal(np.concatenate(batches), frames)
+
+
+def test_iter_batches_checks_total_frames():
+    with pytest.raises(ValueError):
+        list(prefetch.iter_batches(enumerate([np.zeros((10, 2, 2))]), 4, total_frames=12))
+
+
+def test_prefetch_checks_file_size_before_reading(tmp_path):
+    files = []
+    for file_idx in range(8):
+        files.append(tmp_path / f'file{file_idx}.raw')
+        files[-1].write_bytes(bytes(1000))
+    started = []
+
+    def read_func(path_name):
+        started.append(path_name)
+        return np.frombuffer(Path(path_name).read_bytes(), dtype=np.uint8)
+
+    with prefetch.PrefetchReader(files, read_func, depth=8, max_bytes=2500) as reader:
+        for file_idx, (path_name, data) in enumerate(reader):
+            time.sleep(0.02)
+            # The file handed out and at most two files of 1000 bytes read ahead
+            assert len(started) <= file_idx + 3
+            assert path_name == files[file_idx] and len(data) == 1000
+    assert started == files
+
+
+def _frames(directory, num_volumes=200, **kwargs):
+    truth = synthetic.make_series(directory, SERIES, num_volumes, frames_per_file=num_volumes, shape=(96, 96),
+                                  **kwargs)
+    return _read_frames(truth['files'][0]), truth
+
+
+@pytest.mark.parametrize('reg_module', [fftreg, templatematching], ids=['fftreg', 'templatematching'])
+def test_pyramid_is_independent_of_the_stack(tmp_path, reg_module):
+    frames, _ = _frames(tmp_path, max_shift=6)
+    pyramid_module = PyramidModule(reg_module, levels=1, maxmovement=14)
+    template = frames.mean(axis=0)
+    whole = pyramid_module.register(template, frames)
+    pieces = np.concatenate([pyramid_module.register(template, frames[start:start + 33])
+                             for start in range(0, len(frames), 33)])
+    np.testing.assert_array_equal(whole, pieces)
+
+
+def test_pyramid_finds_large_shifts(tmp_path):
+    frames, truth = _frames(tmp_path, max_shift=8, line_phase=0)
+    transform_spec = PyramidModule(fftreg, levels=2, maxmovement=20).register(frames[0].astype(float), frames)
+    error = transform_spec[:, 0:2] - (truth['shifts'] - truth['shifts'][0])
+    assert np.abs(np.abs(truth['shifts'] - truth['shifts'][0])).max() > 8
+    assert np.sqrt(np.mean(np.sum(error ** 2, axis=1))) < 0.5
+
+
+def test_pyramid_rejects_modules_without_search_window():
+    with pytest.raises(AssertionError):
+        PyramidModule(dummy)
+
+
+@pytest.mark.parametrize('num_frames, num_blocks, block_frames', [(400, 8, 20), (400, 1, 50), (100, 8, 20),
+                                                                 (15, 3, 20)])
+def test_sample_blocks(num_frames, num_blocks, block_frames):
+    starts = templates.sample_blocks(num_frames, num_blocks, block_frames)
+    assert starts[0] == 0 and (np.diff(starts) >= block_frames).all()
+    assert starts[-1] + block_frames <= num_frames or len(starts) == 1
+    assert len(starts) == min(num_blocks, -(-num_frames // block_frames))
+
+
+def test_refined_template_registers_better(tmp_path):
+    frames, truth = _frames(tmp_path, num_volumes=400, max_shift=6, line_phase=0)
+
+    def shift_rms(template):
+        error = fftreg.register(template, frames)[:, 0:2] - truth['shifts']
+        error -= np.median(error, axis=0)
+        return np.sqrt(np.mean(np.sum(error ** 2, axis=1)))
+
+    initial = fftreg.create_template(frames[:20])
+    refined = templates.refine(fftreg, frames, initial=initial, num_blocks=8, block_frames=20)
+    assert refined.shape == initial.shape and np.isfinite(refined).all()
+    assert shift_rms(refined) < 0.5 * shift_rms(initial)
+    np.testing.assert_array_equal(templates.refine(fftreg, frames, initial=initial, iterations=0), initial)
+
+
+def _deformed(num_frames=6, shape=(128, 128)):
+    """Returns a template and frames moved by a smooth shift field, with the field (frames, y, x) of each axis."""
+
+    template = gaussian_filter(np.random.RandomState(0).normal(size=shape), 2) * 1000 + 2000
+    grid_y, grid_x = np.mgrid[:shape[0], :shape[1]] / shape[0]
+    frame_idx = np.arange(num_frames)[:, np.newaxis, np.newaxis]
+    field_y = 1.5 * np.sin(np.pi * (grid_x + frame_idx / num_frames)) + frame_idx * 0.5
+    field_x = 1.5 * np.cos(np.pi * grid_y) - frame_idx * 0.3
+    frames = piecewise._remap(np.repeat(template[np.newaxis], num_frames, axis=0), field_y, field_x)
+    return template, frames, field_y, field_x
+
+
+def test_piecewise_follows_smooth_deformation(tmp_path):
+    template, frames, field_y, field_x = _deformed()
+    transform_spec = piecewise.register(template, frames, patch_size=48)
+    grid_y, grid_x, patch_y, patch_x = transform_spec[0, 2:6].astype(int)
+    assert (grid_y, grid_x, patch_y, patch_x) == (4, 4, 48, 48)
+    assert transform_spec.shape == (len(frames), 6 + 2 * grid_y * grid_x)
+
+    # Patch shifts undo the field at the patch centers
+    centers = piecewise._patch_starts(128, patch_y, 0, grid_y)[0] + patch_y // 2
+    patch_shifts = transform_spec[:, 6:].reshape(len(frames), grid_y, grid_x, 2)
+    assert np.abs(patch_shifts[..., 0] + field_y[:, centers][:, :, centers]).max() < 0.5
+    assert np.abs(patch_shifts[..., 1] + field_x[:, centers][:, :, centers]).max() < 0.5
+
+    inside = (slice(None), slice(12, -12), slice(12, -12))
+    warped = piecewise.transform(frames, transform_spec, out=np.empty(frames.shape, dtype=np.float32), block_size=4)
+    rigid = translate.apply_shifts(frames, transform_spec[:, 0:2], dtype=np.float32)
+    assert np.abs(warped - template)[inside].mean() < 0.5 * np.abs(rigid - template)[inside].mean()
+
+    piecewise.save(transform_spec, tmp_path / 'transform.tspec')
+    np.testing.assert_array_equal(piecewise.load(tmp_path / 'transform.tspec'), transform_spec)
+
+
+def test_piecewise_rigid_frames_are_translated():
+    template, frames, _, _ = _deformed(num_frames=3)
+    transform_spec = piecewise.register(template, frames, patch_size=64)
+    transform_spec[1, 6:] = np.tile(transform_spec[1, 0:2], (transform_spec.shape[1] - 6) // 2)
+    out = piecewise.transform(frames, transform_spec, out=np.empty(frames.shape, dtype=np.float32))
+    np.testing.assert_array_equal(out[1], translate.apply_shifts(frames[1:2], transform_spec[1:2, 0:2],
+                                                                 dtype=np.float32)[0])
+    np.testing.assert_array_equal(out[[0, 2]], piecewise.transform(frames[[0, 2]], transform_spec[[0, 2]],
+                                                                  out=np.empty((2,) + frames.shape[1:],
+                                                                               dtype=np.float32)))
+
+
+def test_phase_offsets_per_block(tmp_path):
+    frames, truth = _frames(tmp_path, num_volumes=120, line_phase=1.5)
+    offsets = templatematchpc.phase_offsets(frames)
+    assert offsets.shape == (120,)
+    np.testing.assert_allclose(offsets, truth['phase'], atol=0.1)
+    for start in range(0, 120, templatematchpc.FRAME_BLOCK):
+        block = offsets[start:start + templatematchpc.FRAME_BLOCK]
+        assert (block == block[0]).all()
+        # A block is fit from its own frames only
+        np.testing.assert_array_equal(templatematchpc.phase_offsets(frames[start:start + templatematchpc.FRAME_BLOCK]),
+                                      block)
+
+
+def test_phase_offsets_per_frame(tmp_path):
+    frames, truth = _frames(tmp_path, num_volumes=20, line_phase=-2)
+    offsets = templatematchpc.phase_offsets(frames, phase_block=1)
+    np.testing.assert_array_equal(offsets, [templatematchpc.phase_offsets(frame[np.newaxis])[0] for frame in frames])
+    np.testing.assert_allclose(offsets, truth['phase'], atol=0.25)
+
+
+def test_quality_metrics(tmp_path):
+    rng = np.random.RandomState(0)
+    template = rng.uniform(100, 200, (40, 50))
+    corrected = np.stack([template, 3 * template, template + 50, np.roll(template, 7, axis=1),
+                          rng.uniform(100, 200, (40, 50))])
+    transform_spec = np.array([[0, 0], [3, 4], [0, -2], [1, 0], [0, 0]], dtype=float)
+    metrics = quality.frame_metrics(template, corrected, transform_spec, block_size=2)
+    correlation, residual, shift = (metrics[:, quality.FIELDS.index(field)] for field in
+                                    ['correlation', 'residual', 'shift'])
+    np.testing.assert_allclose(correlation[:3], 1)
+    np.testing.assert_allclose(residual[:2], 0, atol=1e-6)
+    # A change of baseline leaves the correlation but not the residual
+    assert residual[2] > 0.01
+    assert correlation[3:].max() < 0.3 and residual[3:].min() > residual[2]
+    np.testing.assert_allclose(shift, [0, 5, 2, 1, 0])
+
+    quality.write(tmp_path / 'quality.npz', metrics)
+    np.testing.assert_array_equal(quality.read(tmp_path / 'quality.npz'), metrics)
+
+
+def test_apply_reproduces_register(tmp_path):
+    directory = _series(tmp_path, channels=(1, 2))
+    ImageRegistration(reg_module=fftreg).register(directory, SERIES, chunksize=100)
+    registered = _registered(directory)
+    for path in Path(directory, SERIES, 'Registered').glob('slice*/stack_*'):
+        path.unlink()
+    ImageRegistration(reg_module=fftreg).apply(directory, SERIES, chunksize=100)
+    assert _registered(directory) == registered
+
+
+def test_resume_after_crash(tmp_path):
+    directory = _series(tmp_path / 'complete')
+    ImageRegistration(reg_module=fftreg).register(directory, SERIES, chunksize=60)
+
+    resumed = _series(tmp_path / 'resumed')
+    with pytest.raises(RuntimeError):
+        ImageRegistration(reg_module=fftreg).register(resumed, SERIES, chunksize=60, output=CrashingWriter(3))
+    assert not list(Path(resumed, SERIES, 'Registered', 'slice1').glob('stack_c1_3.tif'))
+    imgreg = ImageRegistration(reg_module=fftreg)
+    imgreg.register(resumed, SERIES, chunksize=60)
+    assert _registered(resumed) == _registered(directory)
+    assert len(imgreg.transform[SERIES][0]) == 240
+
+
+def test_batch_register_matches_sequential(tmp_path):
+    lengths = {'run_': 120, 'second_': 200, 'third_': 90}
+    registered = []
+    for name in ['sequential', 'batch']:
+        for seed, (seriesname, num_volumes) in enumerate(lengths.items()):
+            synthetic.make_series(tmp_path / name, seriesname, num_volumes, frames_per_file=50, shape=(64, 64),
+                                  seed=seed)
+        imgreg = ImageRegistration(reg_module=fftreg)
+        if name == 'sequential':
+            for seriesname in lengths:
+                imgreg.register(str(tmp_path / name), seriesname, chunksize=60)
+        else:
+            imgreg.batch_register(str(tmp_path / name), ['second_', 'third_'], referenceseries='run_',
+                                  max_concurrent=2, workers=2, chunksize=60)
+        registered.append({seriesname: _registered(tmp_path / name / seriesname) for seriesname in lengths})
+        assert {seriesname: len(imgreg.transform[seriesname][0]) for seriesname in lengths} == lengths
+    assert registered[0] == registered[1]
+
+
+def test_batch_register_finishes_other_series_on_failure(tmp_path):
+    synthetic.make_series(tmp_path, 'run_', 120, frames_per_file=50, shape=(64, 64))
+    synthetic.make_series(tmp_path, 'other_', 80, frames_per_file=50, shape=(64, 64), seed=1)
+    synthetic.make_series(tmp_path, 'larger_', 80, frames_per_file=50, shape=(80, 80), seed=2)
+    imgreg = ImageRegistration(reg_module=fftreg)
+    with pytest.raises(RuntimeError, match='larger_'):
+        imgreg.batch_register(str(tmp_path), ['run_', 'larger_', 'other_'], chunksize=60)
+    assert len(imgreg.transform['other_'][0]) == 80
+
+
+def test_watch_registers_while_acquired(tmp_path):
+    truth = synthetic.make_series(tmp_path / 'acquired', SERIES, 240, frames_per_file=60, shape=(64, 64))
+    directory = _series(tmp_path / 'complete', frames_per_file=60)
+    ImageRegistration(reg_module=fftreg).register(directory, SERIES, chunksize=60, template_frames=100)
+
+    watched = tmp_path / 'watched'
+    watched.mkdir()
+
+    def acquire():
+        for path in truth['files']:
+            shutil.copy(path, watched / Path(path).name)
+            time.sleep(0.3)
+
+    acquisition = threading.Thread(target=acquire)
+    acquisition.start()
+    imgreg = ImageRegistration(reg_module=fftreg)
+    imgreg.watch(str(watched), SERIES, template_frames=100, poll_interval=0.05, idle_timeout=1)
+    acquisition.join()
+    assert _registered(watched) == _registered(directory)
+    assert len(imgreg.transform[SERIES][0]) == 240
+
+
+def test_watch_stops_after_complete_files(tmp_path):
+    directory = _series(tmp_path, frames_per_file=60)
+    stop = threading.Event()
+    stop.set()
+    imgreg = ImageRegistration(reg_module=fftreg)
+    imgreg.watch(directory, SERIES, template_frames=100, poll_interval=0.05, stop=stop)
+    # The last file could still be written to
+    assert len(imgreg.transform[SERIES][0]) == 180
+
+
+def test_hdf5_matches_tif(tmp_path):
+    stacks = []
+    for output in ['.tif', '.h5']:
+        directory = _series(tmp_path / output[1:], channels=(1, 2))
+        ImageRegistration(reg_module=fftreg).register(directory, SERIES, chunksize=100, output=output)
+        for channel in [1, 2]:
+            with stores.open_registered(Path(directory, SERIES, 'Registered', 'slice1'), channel) as stack:
+                assert all(path.suffix == output for path in stack.files)
+                stacks.append(stack[:])
+    for tif_stack, hdf5_stack in zip(stacks[:2], stacks[2:]):
+        assert tif_stack.dtype == hdf5_stack.dtype
+        np.testing.assert_array_equal(tif_stack, hdf5_stack)
+
+
+def _slice_rois(seed, num_slices=2) -> list:
+    rng = np.random.RandomState(seed)
+    return [[rng.uniform(size=(64, 64)) < 0.05 for _ in range(5)] for _ in range(num_slices)]
+
+
+def test_fused_traces_match_registered_files(tmp_path):
+    rois = _slice_rois(0)
+    directory = _series(tmp_path / 'files', slices=2, channels=(1, 2))
+    ImageRegistration(reg_module=fftreg).register(directory, SERIES, chunksize=100)
+    fused = _series(tmp_path / 'fused', slices=2, channels=(1, 2))
+    ImageRegistration(reg_module=fftreg).register(fused, SERIES, chunksize=100, rois=rois)
+    for slice_id in range(2):
+        slice_path = Path(SERIES, 'Registered', f'slice{slice_id + 1}')
+        assert not list(Path(fused, slice_path).glob('stack_*.tif'))
+        for channel in [1, 2]:
+            files = sorted(Path(directory, slice_path).glob(f'stack_c{channel}_*.tif'),
+                           key=lambda path: int(path.stem.split('_')[-1]))
+            expected = traces.extract_files(nproi.roi_weights(rois[slice_id]), files)
+            ts_data = traces.read_traces(Path(fused, slice_path), channel)
+            assert ts_data.shape == (5, 240)
+            np.testing.assert_allclose(ts_data, expected, rtol=1e-12)
+        np.testing.assert_array_equal(traces.read_traces(Path(fused, slice_path)),
+                                      traces.read_traces(Path(fused, slice_path), 1))
+
+
+def test_fused_traces_resume(tmp_path, monkeypatch):
+    rois = _slice_rois(1, num_slices=1)
+    directory = _series(tmp_path / 'complete')
+    ImageRegistration(reg_module=fftreg).register(directory, SERIES, chunksize=60, rois=rois)
+    complete = traces.read_traces(Path(directory, SERIES, 'Registered', 'slice1'))
+
+    resumed = _series(tmp_path / 'resumed')
+    write = traces.TraceWriter.write
+
+    def crashing_write(self, img_stack, path_name):
+        if Path(path_name).stem.endswith('_3'):
+            raise RuntimeError('Crash')
+        write(self, img_stack, path_name)
+
+    monkeypatch.setattr(traces.TraceWriter, 'write', crashing_write)
+    with pytest.raises(RuntimeError):
+        ImageRegistration(reg_module=fftreg).register(resumed, SERIES, chunksize=60, rois=rois)
+    monkeypatch.setattr(traces.TraceWriter, 'write', write)
+    ImageRegistration(reg_module=fftreg).register(resumed, SERIES, chunksize=60, rois=rois)
+    np.testing.assert_array_equal(traces.read_traces(Path(resumed, SERIES, 'Registered', 'slice1')), complete)
+
+    # Other rois do not resume from the time series of the first
+    other_rois = _slice_rois(2, num_slices=1)
+    ImageRegistration(reg_module=fftreg).register(resumed, SERIES, chunksize=60, rois=other_rois)
+    ImageRegistration(reg_module=fftreg).register(directory, SERIES, chunksize=60, rois=other_rois, resume=False)
+    np.testing.assert_array_equal(traces.read_traces(Path(resumed, SERIES, 'Registered', 'slice1')),
+                                  traces.read_traces(Path(directory, SERIES, 'Registered', 'slice1')))
@@ -0,0 +1,211 @@
+import pickle
+
+import numpy as np
+import pytest
+from matplotlib.path import Path as MplPath
+from scipy.sparse import coo_matrix, csr_matrix
+
+from fleappy.imgregistration import stores
+from fleappy.roimanager import Roi, RoiSet, imagejroi, nproi, traces
+
+
+def _polygon(rng, roi_type, center, radius, num_vertices=12) -> dict:
+    angles = np.sort(rng.uniform(0, 2 * np.pi, num_vertices))
+    radii = radius * rng.uniform(0.4, 1, num_vertices)
+    return {'type': roi_type, 'x': list(center[1] + radii * np.cos(angles)),
+            'y': list(center[0] + radii * np.sin(angles))}
+
+
+def _full_frame(roi_value, framesize) -> np.ndarray:
+    """Rasterize a polygon by testing every pixel of the frame."""
+
+    grid_y, grid_x = np.mgrid[:framesize[0], :framesize[1]]
+    pth = MplPath(np.column_stack((roi_value['x'], roi_value['y'])))
+    return pth.contains_points(np.column_stack((grid_x.ravel(), grid_y.ravel()))).reshape(framesize)
+
+
+@pytest.mark.parametrize('roi_type', imagejroi.POLYGON_TYPES)
+@pytest.mark.parametrize('framesize', [(64, 64), (48, 80)])
+def test_polygon_to_sparse_matches_to_array(roi_type, framesize):
+    rng = np.random.RandomState(0)
+    # Rois inside the frame, on its edges and corners, and outside of it
+    centers = [(24, 30), (0, 40), (47, 79), (-5, 20), (30, 200)]
+    for center in centers:
+        for radius in [0.8, 3, 15]:
+            roi_value = _polygon(rng, roi_type, center, radius)
+            mask = imagejroi.to_sparse(roi_value, framesize=framesize)
+            assert mask.shape == framesize
+            assert mask.has_canonical_format
+            np.testing.assert_array_equal(mask.toarray(), imagejroi.to_array(roi_value, framesize=framesize))
+            np.testing.assert_array_equal(mask.toarray(), _full_frame(roi_value, framesize))
+
+
+def _centers(framesize) -> tuple:
+    grid_y, grid_x = np.mgrid[:framesize[0], :framesize[1]]
+    return grid_y + 0.5, grid_x + 0.5
+
+
+@pytest.mark.parametrize('box', [(10, 12, 5, 7), (10.4, 12.6, 5.2, 7.7), (-3, 40, 10, 20), (44, 58, 20, 20),
+                                 (60, 80, 4, 4)])
+def test_rectangle_to_sparse(box):
+    framesize = (48, 64)
+    top, left, height, width = box
+    roi_value = {'type': 'rectangle', 'top': top, 'left': left, 'height': height, 'width': width}
+    centers_y, centers_x = _centers(framesize)
+    expected = (centers_y >= top) & (centers_y < top + height) & (centers_x >= left) & (centers_x < left + width)
+    mask = imagejroi.to_sparse(roi_value, framesize=framesize)
+    assert mask.has_canonical_format
+    np.testing.assert_array_equal(mask.toarray(), expected)
+    if box == (10, 12, 5, 7):
+        assert mask.nnz == 35
+
+
+@pytest.mark.parametrize('box', [(10, 12, 9, 15), (20.5, 3.2, 6.4, 11.1), (-4, 50, 12, 20), (30, 40, 0, 5)])
+def test_oval_to_sparse(box):
+    framesize = (48, 64)
+    top, left, height, width = box
+    roi_value = {'type': 'oval', 'top': top, 'left': left, 'height': height, 'width': width}
+    centers_y, centers_x = _centers(framesize)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = (((centers_y - top - height / 2) / (height / 2)) ** 2 +
+                    ((centers_x - left - width / 2) / (width / 2)) ** 2 <= 1)
+    np.testing.assert_array_equal(imagejroi.to_array(roi_value, framesize=framesize), expected)
+
+
+@pytest.mark.parametrize('angle', [0, 30, 90, 135])
+@pytest.mark.parametrize('center', [(20, 30), (2, 60)])
+def test_ellipse_to_sparse(angle, center):
+    framesize = (48, 64)
+    major, aspect_ratio = 12, 0.4
+    direction = np.array([np.sin(np.radians(angle)), np.cos(np.radians(angle))])
+    (ey1, ex1), (ey2, ex2) = np.array(center) - major * direction, np.array(center) + major * direction
+    roi_value = {'type': 'freehand', 'ex1': ex1, 'ey1': ey1, 'ex2': ex2, 'ey2': ey2, 'aspect_ratio': aspect_ratio,
+                 'x': [], 'y': []}
+    centers_y, centers_x = _centers(framesize)
+    along = (centers_y - center[0]) * direction[0] + (centers_x - center[1]) * direction[1]
+    across = (centers_y - center[0]) * direction[1] - (centers_x - center[1]) * direction[0]
+    expected = (along / major) ** 2 + (across / (major * aspect_ratio)) ** 2 <= 1
+    mask = imagejroi.to_sparse(roi_value, framesize=framesize)
+    assert mask.has_canonical_format and mask.nnz > 0
+    np.testing.assert_array_equal(mask.toarray(), expected)
+    if angle == 0:
+        oval = {'type': 'oval', 'top': center[0] - major * aspect_ratio, 'left': center[1] - major,
+                'height': 2 * major * aspect_ratio, 'width': 2 * major}
+        np.testing.assert_array_equal(mask.toarray(), imagejroi.to_array(oval, framesize=framesize))
+
+
+def test_unsupported_roi_type():
+    with pytest.raises(ValueError):
+        imagejroi.to_sparse({'type': 'line', 'x1': 0, 'y1': 0, 'x2': 5, 'y2': 5})
+
+
+def _roi(idx, pixels, framesize=(16, 16)) -> Roi:
+    rows, cols = zip(*pixels)
+    mask = csr_matrix((np.ones(len(pixels), dtype=bool), (rows, cols)), shape=framesize)
+    return Roi(id=idx, roi_type='polygon', mask=mask, name=f'roi{idx}')
+
+
+def test_roiset_membership_and_lookup():
+    rois = RoiSet([_roi(idx, [(idx, idx), (idx, idx + 1)]) for idx in range(5)])
+    assert len(rois) == 5 and [roi.id for roi in rois] == list(range(5))
+    # Equal masks in another dtype and storage, with a duplicate and an explicit zero entry
+    same = Roi(id='other', mask=coo_matrix(([1., 1., 0.], ([2, 2, 2], [3, 2, 3])), shape=(16, 16)))
+    assert same.mask_hash() == rois[2].mask_hash()
+    assert same in rois
+    assert _roi(9, [(2, 2)]) not in rois
+    assert _roi(9, [(2, 2), (2, 3)], framesize=(16, 17)) not in rois
+    assert 'roi2' not in rois
+    assert rois.by_id(3) is rois[3] and rois.by_name('roi4') is rois[4]
+    with pytest.raises(KeyError):
+        rois.by_name('roi9')
+
+
+def test_roiset_keeps_indices_on_changes():
+    rois = RoiSet([_roi(idx, [(idx, 0)]) for idx in range(6)])
+    removed = rois.pop(1)
+    rois.remove(rois[0])
+    del rois[-1]
+    rois.insert(0, removed)
+    rois[1] = _roi(7, [(7, 0)])
+    rois += [_roi(8, [(8, 0)])]
+    assert [roi.id for roi in rois] == [1, 7, 3, 4, 8]
+    assert all(rois.by_id(roi.id) is roi for roi in rois)
+    assert not any(_roi(idx, [(idx, 0)]) in rois for idx in [0, 2, 5])
+    with pytest.raises(KeyError):
+        rois.by_id(2)
+    with pytest.raises(ValueError):
+        rois.remove(_roi(0, [(0, 0)]))
+
+    copy = pickle.loads(pickle.dumps(rois))
+    assert isinstance(copy, RoiSet) and copy.by_name('roi8').id == 8
+    rois.clear()
+    assert len(rois) == 0 and _roi(1, [(1, 0)]) not in rois
+
+
+def test_roiset_merge_skips_equal_masks():
+    rois = RoiSet([_roi(idx, [(idx, 0)]) for idx in range(3)])
+    num_added = rois.merge([_roi(10 + idx, [(idx, 0)]) for idx in range(1, 5)])
+    assert num_added == 2
+    assert [roi.id for roi in rois] == [0, 1, 2, 13, 14]
+
+
+def _masks(rng, num_rois=6, framesize=(20, 30)) -> list:
+    masks = [rng.uniform(size=framesize) < 0.1 for _ in range(num_rois)]
+    masks[2] = np.zeros(framesize, dtype=bool)
+    masks[3] = masks[3] * rng.uniform(0.5, 2, framesize)
+    return masks
+
+
+def test_sparse_weights_match_dense_mean():
+    rng = np.random.RandomState(0)
+    masks = _masks(rng)
+    timedata = rng.randint(0, 2 ** 16, (45, 20, 30)).astype(np.uint16)
+    weights = nproi.roi_weights([csr_matrix(mask) for mask in masks])
+    assert weights.shape == (6, 600) and weights.dtype == np.float64
+    np.testing.assert_array_equal(nproi.roi_weights(np.stack(masks)).toarray(), weights.toarray())
+    np.testing.assert_allclose(weights.sum(axis=1).A1, [1, 1, 0, 1, 1, 1])
+
+    expected = np.stack([np.full(len(timedata), np.nan) if not mask.any() else
+                         (timedata * mask).sum(axis=(1, 2)) / mask.sum() for mask in masks])
+    for chunk_frames in [1, 7, 45, 500]:
+        ts_data = nproi.extract_traces(weights, timedata, chunk_frames=chunk_frames)
+        assert ts_data.dtype == np.float64
+        np.testing.assert_allclose(ts_data, expected, rtol=1e-12)
+    np.testing.assert_allclose(nproi.tseries_data(np.stack(masks), timedata, dtype=np.float32), expected, rtol=1e-5)
+
+
+def test_extract_traces_into_out():
+    rng = np.random.RandomState(1)
+    masks = _masks(rng, framesize=(8, 9))
+    timedata = rng.uniform(size=(12, 8, 9))
+    weights = nproi.roi_weights(masks)
+    out = np.zeros((6, 12), dtype=np.float32)
+    assert nproi.extract_traces(weights, timedata, chunk_frames=5, out=out) is out
+    np.testing.assert_allclose(out, nproi.extract_traces(weights, timedata), rtol=1e-5)
+    with pytest.raises(AssertionError):
+        nproi.extract_traces(weights, timedata[:, :, :8])
+
+
+@pytest.mark.parametrize('writer', [stores.TiffWriter(), stores.HDF5Writer(chunk_frames=8, tile_size=16)],
+                         ids=['tif', 'h5'])
+def test_extract_files_on_workers(tmp_path, writer):
+    rng = np.random.RandomState(2)
+    frames = rng.randint(0, 2 ** 16, (130, 20, 30)).astype(np.uint16)
+    files = []
+    for batch_num, start in enumerate([0, 50, 53, 100]):
+        files.append(tmp_path / f'stack_c1_{batch_num}{writer.suffix}')
+        writer.write(frames[start:[50, 53, 100, 130][batch_num]], files[-1])
+    writer.close()
+
+    units = traces.chunk_units(files, 20)
+    assert [unit[1:] for unit in units if unit[0] == files[2]] == [(0, 20, 53), (20, 40, 73), (40, 47, 93)]
+    assert sum(stop - start for _, start, stop, _ in units) == 130
+
+    weights = nproi.roi_weights(_masks(rng))
+    expected = nproi.extract_traces(weights, frames)
+    for workers in [1, 3]:
+        ts_data = traces.extract_files(weights, files, workers=workers, chunk_frames=20)
+        assert ts_data.dtype == np.float64
+        np.testing.assert_array_equal(ts_data, expected)
+    np.testing.assert_allclose(traces.extract_files(weights, files, workers=2, dtype=np.float32), expected,
+                               rtol=1e-5)
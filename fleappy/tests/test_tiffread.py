@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from fleappy.tiffread import scanimage, siindex, synthetic
+
+SERIES = 'run_'
+
+
+@pytest.fixture
+def series(tmp_path):
+    truth = synthetic.make_series(tmp_path, SERIES, 110, frames_per_file=60, shape=(32, 48), slices=2,
+                                  channels=(1, 2))
+    pages = []
+    for path in truth['files']:
+        with scanimage.open_si_tiffstack(path) as stack:
+            pages.append(stack.read())
+    return tmp_path, np.concatenate(pages)
+
+
+def test_synthetic_header(series):
+    directory, pages = series
+    index = siindex.SIIndex(directory, SERIES)
+    assert scanimage.piezo_slices(index.header) == 2
+    assert list(scanimage.channels(index.header)) == [1, 2]
+    assert index.total_frames == len(pages) == 110 * 2 * 2
+    assert pages.shape[1:] == (32, 48)
+
+
+def test_index_locate(series):
+    directory, pages = series
+    index = siindex.SIIndex(directory, SERIES)
+    assert index.file_lengths == [120, 120, 120, 80]
+    for frame_idx in [0, 119, 120, 239, 360, len(pages) - 1]:
+        file_idx, page_idx = index.locate(frame_idx)
+        assert index.file_start(file_idx) + page_idx == frame_idx
+    with pytest.raises(IndexError):
+        index.locate(len(pages))
+
+
+def test_series_views(series):
+    directory, pages = series
+    with siindex.SIIndex(directory, SERIES).open_series() as stack:
+        np.testing.assert_array_equal(stack[:], pages)
+        for slice_id in range(2):
+            for channel_idx, channel in enumerate([1, 2]):
+                plane = pages[slice_id * 2 + channel_idx::4]
+                view = stack.view(slice_id, channel)
+                assert len(view) == 110
+                np.testing.assert_array_equal(view[:], plane)
+                np.testing.assert_array_equal(view[55:65], plane[55:65])
+                np.testing.assert_array_equal(view[[3, 70, 29]], plane[[3, 70, 29]])
+                np.testing.assert_array_equal(view[-1, 5:9, 10:20], plane[-1, 5:9, 10:20])
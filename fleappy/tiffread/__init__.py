@@ -1,5 +1,7 @@
 name = 'tiffread'
 
-from .scanimage import read_si_tiffstack
+from .scanimage import read_si_tiffstack, open_si_tiffstack
+from .tiffstack import TiffStack
+from .siseries import SISeries, open_si_series
 
-__all__ = ['scanimage']
\ No newline at end of file
+__all__ = ['scanimage', 'tiffstack', 'siseries', 'siindex', 'synthetic', 'registered', 'sharedstack']
@@ -0,0 +1,176 @@
+"""Readers of registered images.
+
+Registration writes one file per batch, slice and channel as `stack_c<channel #>_<batch #><suffix>`, either
+uncompressed multi-page tif files or chunked, compressed HDF5 files (see fleappy.imgregistration.stores).
+RegisteredStack reads the batch files of a slice and channel as a single lazy stack of frames, whatever format they
+were written in, reading only the files and, of HDF5 files, only the chunks that hold the requested frames and pixels.
+
+Example:
+    Read frames 5000 to 6000 of channel 1 of the first slice:
+    ::code-block
+
+        $ with open_registered(Path(filepath, seriesname, 'Registered', 'slice1'), channel=1) as stack:
+        $     frames = stack[5000:6000]
+"""
+
+from pathlib import Path
+
+import h5py
+import natsort as ns
+import numpy as np
+
+from fleappy.tiffread.tiffstack import TiffStack
+
+DATASET = 'data'
+"""str: Name of the image dataset in HDF5 files."""
+
+TIFF_SUFFIX = '.tif'
+"""str: Suffix of registered tif files."""
+
+HDF5_SUFFIX = '.h5'
+"""str: Suffix of registered HDF5 files."""
+
+SUFFIXES = (TIFF_SUFFIX, HDF5_SUFFIX)
+"""tuple: Suffixes of the registered file formats."""
+
+
+class RegisteredStack(object):
+    """Lazy, indexable stack over the batch files of one registered slice and channel.
+
+    Indexing follows numpy semantics on the (frames, y, x) stack. Only the files holding the requested frames are read,
+    and of HDF5 files only the chunks holding the requested frames and pixels.
+
+    Attributes:
+        files (list): Batch files in order.
+        shape (tuple): Shape of the full stack (frames, y, x).
+        dtype (numpy.dtype): Data type of the image data.
+    """
+
+    __slots__ = ['files', 'shape', 'dtype', '_stacks', '_file_starts']
+
+    def __init__(self, files: list) -> None:
+        assert len(files) > 0, 'No registered files!'
+        self.files = [Path(x) for x in files]
+        self._stacks = [_open_file(path) for path in self.files]
+        self.dtype = np.dtype(self._stacks[0].dtype)
+        self._file_starts = np.concatenate(([0], np.cumsum([len(stack) for stack in self._stacks]))).astype(np.int64)
+        self.shape = (int(self._file_starts[-1]),) + tuple(self._stacks[0].shape[1:])
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        frame_key, pixel_key = key[0], key[1:]
+        if isinstance(frame_key, (int, np.integer)):
+            frame_idx = int(frame_key) + len(self) if frame_key < 0 else int(frame_key)
+            if not 0 <= frame_idx < len(self):
+                raise IndexError(f'Frame {frame_key} is out of range for a stack of {len(self)} frames')
+            file_idx = int(np.searchsorted(self._file_starts, frame_idx, side='right')) - 1
+            return np.asarray(self._stacks[file_idx][(frame_idx - int(self._file_starts[file_idx]),) + pixel_key])
+
+        frame_list = np.arange(len(self))[frame_key]
+        file_list = np.searchsorted(self._file_starts, frame_list, side='right') - 1
+        frame_shape = np.empty(self.shape[1:], dtype=bool)[pixel_key].shape
+        out = np.empty((len(frame_list),) + frame_shape, dtype=self.dtype)
+        for file_idx in np.unique(file_list):
+            out_idx = np.flatnonzero(file_list == file_idx)
+            out[out_idx] = self._read(int(file_idx), frame_list[out_idx] - self._file_starts[file_idx], pixel_key)
+        return out
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def read(self, start: int = 0, stop: int = None) -> np.ndarray:
+        """Read a contiguous range of frames into memory.
+
+        Args:
+            start (int, optional): Defaults to 0. First frame to read.
+            stop (int, optional): Defaults to None, reading to the end of the stack. Frame to stop reading at.
+
+        Returns:
+            numpy.ndarray: Image data (z, y, x)
+        """
+
+        return self[start:stop]
+
+    def close(self) -> None:
+        """Close all files."""
+
+        for stack in self._stacks:
+            if isinstance(stack, h5py.Dataset):
+                stack.file.close()
+            else:
+                stack.close()
+        self._stacks = []
+
+    def _read(self, file_idx: int, local_idx: np.ndarray, pixel_key: tuple) -> np.ndarray:
+        """Read frames of one file, as a single range if they are contiguous."""
+
+        stack = self._stacks[file_idx]
+        if len(local_idx) > 0 and local_idx[-1] - local_idx[0] == len(local_idx) - 1:
+            return stack[(slice(int(local_idx[0]), int(local_idx[-1]) + 1),) + pixel_key]
+        if isinstance(stack, h5py.Dataset):
+            # HDF5 selections need increasing indices
+            unique_idx, inverse = np.unique(local_idx, return_inverse=True)
+            return stack[(unique_idx,) + pixel_key][inverse]
+        return stack[(local_idx,) + pixel_key]
+
+
+def open_registered(slice_path, channel: int, suffix: str = None) -> RegisteredStack:
+    """Open the registered images of a slice and channel.
+
+    Args:
+        slice_path (Path): Directory of the slice, '<directory>/<seriesname>/Registered/slice<#>'.
+        channel (int): ScanImage channel number.
+        suffix (str, optional): Defaults to None and will use the format found. Format of the files to read, '.tif'
+            or '.h5'.
+
+    Raises:
+        FileNotFoundError: If there are no registered files for the channel.
+        ValueError: If registered files of more than one format are found and no suffix is given.
+
+    Returns:
+        RegisteredStack: Lazy stack of the registered frames.
+    """
+
+    files = [path for path in Path(slice_path).glob(f'stack_c{channel}_*')
+             if path.suffix in SUFFIXES and (suffix is None or path.suffix == _suffix(suffix))]
+    if not files:
+        raise FileNotFoundError(f'No registered files for channel {channel} in {slice_path}')
+    suffixes = {path.suffix for path in files}
+    if len(suffixes) > 1:
+        raise ValueError(f'Found registered files of formats {", ".join(sorted(suffixes))} in {slice_path}, '
+                         f'please specify a suffix')
+    return RegisteredStack(ns.natsorted(files, alg=ns.PATH))
+
+
+def read_stack(path_name) -> np.ndarray:
+    """Read a whole registered file, tif or HDF5, into memory."""
+
+    if Path(path_name).suffix == HDF5_SUFFIX:
+        with h5py.File(str(path_name), 'r') as file:
+            return file[DATASET][()]
+    with TiffStack(path_name) as stack:
+        return stack.read()
+
+
+def _suffix(suffix: str) -> str:
+    """Returns a file suffix with its dot, raising a ValueError if it is not a registered file format."""
+
+    suffix = suffix if suffix.startswith('.') else '.' + suffix
+    if suffix not in SUFFIXES:
+        raise ValueError(f'Unknown registered file format {suffix}, use one of {", ".join(SUFFIXES)}')
+    return suffix
+
+
+def _open_file(path: Path):
+    """Open a registered file as an indexable stack."""
+
+    if path.suffix == HDF5_SUFFIX:
+        return h5py.File(str(path), 'r')[DATASET]
+    return TiffStack(path)
@@ -13,6 +13,8 @@ from PIL import Image
 import skimage.io as io
 import tifffile
 
+from fleappy.tiffread.tiffstack import TiffStack
+
 
 def read_si_tiffstack(path_name: str, header_only: bool = False) -> tuple:
     """Open a scanimage tiff file
@@ -35,19 +37,46 @@ def read_si_tiffstack(path_name: str, header_only: bool = False) -> tuple:
         file_to_open = path_name
     assert file_to_open.exists(), 'File does not exist!'
 
-    img = tifffile.TiffFile(file_to_open)
-    if img.is_bigtiff:
-        header = parse_si_header(img.scanimage_metadata['FrameData'])
-    else:
-        header = parse_si_header(img.scanimage_metadata['Description'])
-
-    if not header_only:
-        img_data = img.asarray()
-    else:
-        img_data = None
+    with tifffile.TiffFile(str(file_to_open)) as img:
+        header = _read_header(img)
+        if not header_only:
+            img_data = img.asarray()
+        else:
+            img_data = None
     return img_data, header
 
 
+def open_si_tiffstack(path_name: str, use_memmap: bool = True):
+    """Open a scanimage tiff file for lazy frame access.
+
+    Parses the header once and keeps the file open, frames are only read when indexed. Use this instead of
+    read_si_tiffstack when the whole file does not need to be in memory at once.
+
+    Args:
+        path_name (str): Path to a tif file
+        use_memmap (bool, optional): Defaults to True. Memory map the frames when the page layout allows it.
+
+    Returns:
+        SITiffStack: Lazy stack (z,y,x) with parsed header information.
+    """
+
+    return SITiffStack(path_name, use_memmap=use_memmap)
+
+
+class SITiffStack(TiffStack):
+    """Lazy ScanImage tif stack.
+
+    Attributes:
+        header (dict): Cleansed ScanImage header information.
+    """
+
+    __slots__ = ['header']
+
+    def __init__(self, path_name, use_memmap: bool = True) -> None:
+        TiffStack.__init__(self, path_name, use_memmap=use_memmap)
+        self.header = _read_header(self._tiff)
+
+
 def parse_si_header(header) -> dict:
     """Cleans ScanImage header information into a useable format.
 
@@ -77,6 +106,21 @@ def to_json(header: dict, filename: str):
         json.dump(header, fid)
 
 
+def _read_header(img: tifffile.TiffFile) -> dict:
+    """Reads the ScanImage header from an open tif file.
+
+    Args:
+        img (tifffile.TiffFile): Open ScanImage tif file.
+
+    Returns:
+        dict: ScanImage header information as a useable dict.
+    """
+
+    if img.is_bigtiff:
+        return parse_si_header(img.scanimage_metadata['FrameData'])
+    return parse_si_header(img.scanimage_metadata['Description'])
+
+
 def _parse_dict(header: dict) ->dict:
     """Makes header information consistent between scanimage file version 1 and 3.
 
@@ -135,7 +179,7 @@ def piezo_slices(header: dict) -> int:
     """
     file_version_num = si_file_version(header)
     if file_version_num == 1 or file_version_num == 3:
-        if header['SI.hFastZ.enable'] is 1:
+        if header['SI.hFastZ.enable'] == 1:
             return int(header['SI.hFastZ.numFramesPerVolume'])
         else:
             return 1
@@ -157,7 +201,9 @@ def channels(header: dict)-> np.array:
     """
     file_version_num = si_file_version(header)
     if file_version_num == 1 or file_version_num == 3:
-        channel_list = str(header['SI.hChannels.channelSave'])
+        channel_list = header['SI.hChannels.channelSave']
+        if not isinstance(channel_list, str):
+            return np.array(channel_list, dtype=int).flatten()
         channel_list = ''.join(x for x in channel_list if x not in '[]')
         return np.fromstring(channel_list, dtype=int, sep=';')
     else:
@@ -0,0 +1,84 @@
+"""Numpy arrays in shared memory for pools of worker processes.
+
+A SharedStack is created by the parent process and sent to workers by name, so workers read their input from and write
+their results into the same block of memory instead of pickling image data. pool_context gives the start method the
+worker pools of fleappy use.
+
+Example:
+    Let workers fill the columns of a shared output:
+    ::code-block
+
+        $ target = SharedStack((num_rois, num_frames), np.float64)
+        $ with ProcessPoolExecutor(max_workers=4, mp_context=pool_context()) as executor:
+        $     executor.submit(work, target, start, stop).result()
+        $ result = np.array(target.array)
+        $ target.close()
+"""
+
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+
+class SharedStack(object):
+    """Numpy array backed by a block of shared memory.
+
+    Attributes:
+        shape (tuple): Shape of the array.
+        dtype (numpy.dtype): Data type of the array.
+        array (numpy.ndarray): Array view onto the shared memory.
+    """
+
+    __slots__ = ['shape', 'dtype', 'array', '_shm', '_owner']
+
+    def __init__(self, shape: tuple, dtype, name: str = None) -> None:
+        """Create a new shared array, or attach to an existing one if a name is given.
+
+        Args:
+            shape (tuple): Shape of the array.
+            dtype (numpy.dtype): Data type of the array.
+            name (str, optional): Defaults to None. Name of an existing shared memory block to attach to.
+        """
+
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        nbytes = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self._owner = True
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+            # Only the creating process may unlink the block, but attaching registers it with this process's resource
+            # tracker. Processes started by multiprocessing share the tracker of their parent, any other process has
+            # its own, which would unlink the block when it exits, see https://bugs.python.org/issue39959
+            if multiprocessing.parent_process() is None:
+                resource_tracker.unregister(self._shm._name, 'shared_memory')  # pylint: disable=protected-access
+            self._owner = False
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    def __reduce__(self):
+        return (SharedStack, (self.shape, self.dtype.str, self._shm.name))
+
+    def close(self) -> None:
+        """Detach from the shared memory, and free it if this process created it."""
+
+        self.array = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def pool_context():
+    """Returns the multiprocessing context worker pools are started with.
+
+    Registration runs alongside reader and writer threads, and forking a process with running threads can deadlock the
+    child on a lock held at the time of the fork. Workers are therefore started by a fork server where the platform
+    has one, and spawned otherwise.
+
+    Returns:
+        multiprocessing.context.BaseContext: Context of the forkserver or spawn start method.
+    """
+
+    return multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+                                       else 'spawn')
@@ -0,0 +1,218 @@
+"""Persistent index of the files in a ScanImage series.
+
+Opening every file of a long session just to count its pages is slow, so the page count, data layout and header hash
+of every file is kept in a small json sidecar next to the data. Only files whose size or modification time changed
+since the sidecar was written are opened again.
+
+Example:
+    Look up where frame 123456 of a series is stored:
+    ::code-block
+
+        $ index = SIIndex(directory, seriesname)
+        $ file_idx, page_idx = index.locate(123456)
+        $ index.files[file_idx]
+"""
+
+import hashlib
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from fleappy.tiffread import scanimage, siseries
+
+INDEX_VERSION = 1
+"""int: Version of the sidecar format, sidecars of other versions are rebuilt."""
+
+logger = logging.getLogger(__name__)
+
+
+class SIIndex(object):
+    """Index of page counts and page layout for a ScanImage series.
+
+    Attributes:
+        directory (Path): Directory with the tif files.
+        seriesname (str): Name of the series, files follow the format '<series>*.tif'.
+        header (dict): ScanImage header of the first file.
+        entries (list): One dict per file with name, size, mtime, pages, offset, stride, header_hash, slices,
+            channels and first_plane (index of the interleaved (slice, channel) plane of the first page).
+    """
+
+    __slots__ = ['directory', 'seriesname', 'header', 'entries', '_file_starts', '_pages_per_file']
+
+    def __init__(self, directory: str, seriesname: str, update: bool = True) -> None:
+        self.directory = Path(directory)
+        self.seriesname = seriesname
+        self.header = None
+        self.entries = []
+        self._read_sidecar()
+        if update:
+            self.update()
+        else:
+            self._build_lookup()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def sidecar(self) -> Path:
+        """Path: Location of the json sidecar."""
+        return self.directory.joinpath(f'.{self.seriesname}.siindex.json')
+
+    @property
+    def files(self) -> list:
+        """list: Paths of the indexed files in acquisition order."""
+        return [self.directory.joinpath(entry['name']) for entry in self.entries]
+
+    @property
+    def file_lengths(self) -> list:
+        """list: Number of pages in each file."""
+        return [entry['pages'] for entry in self.entries]
+
+    @property
+    def total_frames(self) -> int:
+        """int: Exact number of pages (all slices and channels) in the series."""
+        return int(self._file_starts[-1])
+
+    def file_start(self, file_idx: int) -> int:
+        """Returns the series page index of the first page of a file.
+
+        Args:
+            file_idx (int): Index of the file in the series.
+
+        Returns:
+            int: Page index in the interleaved series.
+        """
+
+        return int(self._file_starts[file_idx])
+
+    def update(self, files: list = None) -> bool:
+        """Rescan the directory and re-index new or changed files.
+
+        Args:
+            files (list, optional): Defaults to None and will use all files of the series in the directory. Paths of
+                the files to index in acquisition order, e.g. to leave out a file that is still being written.
+
+        Returns:
+            bool: True if the index changed and the sidecar was rewritten.
+        """
+
+        if files is None:
+            files = siseries.find_series_files(self.directory, self.seriesname)
+        known = {entry['name']: entry for entry in self.entries}
+        entries = []
+        changed = False
+        series_start = 0
+        for file_path in files:
+            file_path = Path(file_path)
+            stat = file_path.stat()
+            entry = known.get(file_path.name)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+                logger.debug('Indexing %s', file_path.name)
+                entry, header = _index_file(file_path, stat)
+                if len(entries) == 0:
+                    self.header = header
+                changed = True
+            if entry['first_plane'] != series_start % (entry['slices'] * len(entry['channels'])):
+                entry['first_plane'] = series_start % (entry['slices'] * len(entry['channels']))
+                changed = True
+            series_start += entry['pages']
+            entries.append(entry)
+
+        changed = changed or [x['name'] for x in entries] != [x['name'] for x in self.entries]
+        self.entries = entries
+        for entry in entries[1:]:
+            if entry['header_hash'] != entries[0]['header_hash']:
+                logger.warning('Header of %s differs from the first file in the series', entry['name'])
+        self._build_lookup()
+        if changed:
+            self._write_sidecar()
+        return changed
+
+    def locate(self, frame_idx: int) -> tuple:
+        """Find the file holding a page of the series.
+
+        Constant time when all files but the last hold the same number of pages, which is how ScanImage writes them.
+
+        Args:
+            frame_idx (int): Page index in the interleaved series.
+
+        Returns:
+            tuple: file index, page index within that file
+        """
+
+        if not 0 <= frame_idx < self.total_frames:
+            raise IndexError(f'Frame {frame_idx} is out of range for a series of {self.total_frames} frames')
+        if self._pages_per_file is not None:
+            file_idx = min(frame_idx // self._pages_per_file, len(self.entries) - 1)
+        else:
+            file_idx = int(np.searchsorted(self._file_starts, frame_idx, side='right')) - 1
+        return file_idx, int(frame_idx - self._file_starts[file_idx])
+
+    def open_series(self, **kwargs):
+        """Open the indexed files as a virtual series without recounting pages.
+
+        Args:
+            **kwargs: Passed on to SISeries.
+
+        Returns:
+            SISeries: Virtual series over all indexed files.
+        """
+
+        return siseries.SISeries(self.files, file_lengths=self.file_lengths, **kwargs)
+
+    def _build_lookup(self) -> None:
+        lengths = self.file_lengths
+        self._file_starts = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        if len(lengths) > 0 and len(set(lengths[:-1])) <= 1 and lengths[-1] <= lengths[0]:
+            self._pages_per_file = lengths[0]
+        else:
+            self._pages_per_file = None
+
+    def _read_sidecar(self) -> None:
+        if not self.sidecar.exists():
+            return
+        try:
+            with open(self.sidecar, 'r') as fid:
+                contents = json.load(fid)
+        except ValueError:
+            logger.warning('Could not parse %s, rebuilding index', self.sidecar.name)
+            return
+        if contents.get('version') == INDEX_VERSION:
+            self.header = contents['header']
+            self.entries = contents['files']
+
+    def _write_sidecar(self) -> None:
+        with open(self.sidecar, 'w') as fid:
+            json.dump({'version': INDEX_VERSION, 'header': self.header, 'files': self.entries}, fid, default=str)
+
+
+def _index_file(file_path: Path, stat) -> tuple:
+    """Read page count, page layout and header of a single file."""
+
+    with scanimage.open_si_tiffstack(file_path, use_memmap=False) as stack:
+        offsets = stack.page_offsets()
+        header = stack.header
+        pages = len(stack)
+    entry = {'name': file_path.name,
+             'size': stat.st_size,
+             'mtime': stat.st_mtime_ns,
+             'pages': pages,
+             'offset': None,
+             'stride': None,
+             'header_hash': _header_hash(header),
+             'slices': scanimage.piezo_slices(header),
+             'channels': [int(x) for x in scanimage.channels(header)],
+             'first_plane': 0}
+    if (offsets >= 0).all():
+        entry['offset'] = int(offsets[0])
+        strides = np.unique(np.diff(offsets))
+        entry['stride'] = int(strides[0]) if len(strides) == 1 else None
+    return entry, header
+
+
+def _header_hash(header: dict) -> str:
+    """Returns a stable hash of ScanImage header information."""
+
+    return hashlib.sha1(json.dumps(header, sort_keys=True, default=str).encode()).hexdigest()
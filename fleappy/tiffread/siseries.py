@@ -0,0 +1,251 @@
+"""Virtual access to ScanImage acquisitions that are split across multiple tif files.
+
+ScanImage writes an acquisition as a numbered series of files with piezo slices and channels interleaved page by page
+(all channels of slice 1, all channels of slice 2, ... for every volume). SISeries presents the pages of all files as a
+single lazily read stack, and SISeriesView deinterleaves a single (slice, channel) plane out of it.
+
+Example:
+    Read frames 10000 to 12000 of the second piezo slice in channel 1:
+    ::code-block
+
+        $ series = open_si_series(directory, seriesname)
+        $ frames = series.view(1, 1)[10000:12000]
+"""
+
+from collections import OrderedDict
+from pathlib import Path
+
+import natsort as ns
+import numpy as np
+
+from fleappy.tiffread import scanimage
+
+
+class SISeries(object):
+    """Lazy, indexable stack over all pages of a multi-file ScanImage acquisition.
+
+    Files are opened on demand and a small number of them are kept open. Indexing follows numpy semantics on the
+    (pages, y, x) stack. Requests that fall within a single memory mapped file are returned without copying.
+
+    Attributes:
+        files (list): Paths to the tif files in acquisition order.
+        header (dict): ScanImage header of the first file.
+        num_slices (int): Number of piezo slices.
+        channels (numpy.ndarray): Saved channels.
+        shape (tuple): Shape of the full interleaved stack (pages, y, x).
+        dtype (numpy.dtype): Data type of the image data.
+    """
+
+    __slots__ = ['files', 'header', 'num_slices', 'channels', 'shape', 'dtype', '_file_starts', '_stacks',
+                 '_max_open']
+
+    def __init__(self, files: list, file_lengths: list = None, max_open: int = 4) -> None:
+        """Create a series from a list of files.
+
+        Args:
+            files (list): Paths to the tif files of the series, in acquisition order.
+            file_lengths (list, optional): Defaults to None. Number of pages in each file. If not given, all files but
+                the last are assumed to hold as many pages as the first file and the last file is opened to count.
+            max_open (int, optional): Defaults to 4. Maximum number of files kept open at the same time.
+        """
+
+        assert len(files) > 0, 'No files in series!'
+        self.files = [Path(x) for x in files]
+        self._stacks = OrderedDict()
+        self._max_open = max_open
+
+        first_stack = self._stack(0)
+        self.header = first_stack.header
+        self.num_slices = scanimage.piezo_slices(self.header)
+        self.channels = scanimage.channels(self.header)
+        self.dtype = first_stack.dtype
+
+        if file_lengths is None:
+            file_lengths = [len(first_stack)] * len(self.files)
+            file_lengths[-1] = len(self._stack(len(self.files) - 1))
+        assert len(file_lengths) == len(self.files), 'Need a page count for every file!'
+        self._file_starts = np.concatenate(([0], np.cumsum(file_lengths))).astype(np.int64)
+        self.shape = (int(self._file_starts[-1]),) + first_stack.shape[1:]
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        frame_key, pixel_key = key[0], key[1:]
+
+        if isinstance(frame_key, (int, np.integer)):
+            frame_idx = int(frame_key) + len(self) if frame_key < 0 else int(frame_key)
+            if not 0 <= frame_idx < len(self):
+                raise IndexError(f'Frame {frame_key} is out of range for a series of {len(self)} frames')
+            file_idx, local_idx = self.locate(frame_idx)
+            return self._stack(file_idx)[(local_idx,) + pixel_key]
+
+        if isinstance(frame_key, slice):
+            frame_list = range(*frame_key.indices(len(self)))
+            if frame_list.step > 0 and len(frame_list) > 0:
+                first_file, _ = self.locate(frame_list[0])
+                last_file, _ = self.locate(frame_list[-1])
+                if first_file == last_file:
+                    file_start = self._file_starts[first_file]
+                    local_key = slice(frame_list.start - file_start, frame_list[-1] - file_start + 1, frame_list.step)
+                    return self._stack(first_file)[(local_key,) + pixel_key]
+            frame_list = np.array(frame_list, dtype=np.int64)
+        else:
+            frame_list = np.arange(len(self))[frame_key]
+        return self._gather(frame_list, pixel_key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def locate(self, frame_idx: int) -> tuple:
+        """Find the file holding a page of the series.
+
+        Args:
+            frame_idx (int): Page index in the interleaved series.
+
+        Returns:
+            tuple: file index, page index within that file
+        """
+
+        file_idx = int(np.searchsorted(self._file_starts, frame_idx, side='right')) - 1
+        return file_idx, int(frame_idx - self._file_starts[file_idx])
+
+    def view(self, slice_id: int, channel: int):
+        """Returns a deinterleaved view of a single piezo slice and channel.
+
+        Args:
+            slice_id (int): Piezo slice (0 indexed, as used for the Registered/slice<slice_id + 1> directories).
+            channel (int): ScanImage channel number, as listed by scanimage.channels.
+
+        Returns:
+            SISeriesView: Lazy view of the (slice, channel) plane.
+        """
+
+        assert 0 <= slice_id < self.num_slices, f'Slice {slice_id} is not in a series of {self.num_slices} slices'
+        assert channel in self.channels, f'Channel {channel} is not one of the saved channels {self.channels}'
+        channel_idx = int(np.flatnonzero(self.channels == channel)[0])
+        return SISeriesView(self, slice_id * len(self.channels) + channel_idx, self.num_slices * len(self.channels))
+
+    def close(self) -> None:
+        """Close all open files of the series."""
+
+        for stack in self._stacks.values():
+            stack.close()
+        self._stacks.clear()
+
+    def _stack(self, file_idx: int):
+        """Returns the open stack for a file, opening it and closing the least recently used file if needed."""
+
+        if file_idx in self._stacks:
+            self._stacks.move_to_end(file_idx)
+        else:
+            self._stacks[file_idx] = scanimage.open_si_tiffstack(self.files[file_idx])
+            while len(self._stacks) > self._max_open:
+                _, stack = self._stacks.popitem(last=False)
+                stack.close()
+        return self._stacks[file_idx]
+
+    def _gather(self, frame_list: np.ndarray, pixel_key: tuple) -> np.ndarray:
+        """Read an arbitrary list of pages into a new array, reading each file once."""
+
+        frame_list = np.where(frame_list < 0, frame_list + len(self), frame_list)
+        if len(frame_list) > 0 and (frame_list.min() < 0 or frame_list.max() >= len(self)):
+            raise IndexError(f'Frames out of range for a series of {len(self)} frames')
+        file_list = np.searchsorted(self._file_starts, frame_list, side='right') - 1
+
+        frame_shape = np.empty(self.shape[1:], dtype=bool)[pixel_key].shape
+        out = np.empty((len(frame_list),) + frame_shape, dtype=self.dtype)
+        for file_idx in np.unique(file_list):
+            out_idx = np.flatnonzero(file_list == file_idx)
+            local_idx = frame_list[out_idx] - self._file_starts[file_idx]
+            out[out_idx] = self._stack(int(file_idx))[(local_idx,) + pixel_key]
+        return out
+
+
+class SISeriesView(object):
+    """Lazy view of one interleaved plane (piezo slice and channel) of a SISeries.
+
+    Frame k of the view is page `offset + k * period` of the series. Indexing follows numpy semantics on the
+    (frames, y, x) stack of the plane.
+
+    Attributes:
+        series (SISeries): Parent series.
+        offset (int): Page of the series holding the first frame of the view.
+        period (int): Number of series pages between consecutive frames of the view.
+        shape (tuple): Shape of the view (frames, y, x).
+    """
+
+    __slots__ = ['series', 'offset', 'period', 'shape']
+
+    def __init__(self, series: SISeries, offset: int, period: int) -> None:
+        self.series = series
+        self.offset = offset
+        self.period = period
+        num_frames = max(0, -(-(len(series) - offset) // period))
+        self.shape = (num_frames,) + series.shape[1:]
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        frame_key, pixel_key = key[0], key[1:]
+
+        if isinstance(frame_key, (int, np.integer)):
+            frame_idx = int(frame_key) + len(self) if frame_key < 0 else int(frame_key)
+            if not 0 <= frame_idx < len(self):
+                raise IndexError(f'Frame {frame_key} is out of range for a view of {len(self)} frames')
+            series_key = self.offset + frame_idx * self.period
+        elif isinstance(frame_key, slice):
+            start, stop, step = frame_key.indices(len(self))
+            if step > 0:
+                stop = max(start, stop)
+                series_key = slice(self.offset + start * self.period, self.offset + stop * self.period,
+                                   step * self.period)
+            else:
+                series_key = self.offset + np.arange(start, stop, step) * self.period
+        else:
+            series_key = self.offset + np.arange(len(self))[frame_key] * self.period
+        return self.series[(series_key,) + pixel_key]
+
+    @property
+    def dtype(self) -> np.dtype:
+        """numpy.dtype: Data type of the image data."""
+        return self.series.dtype
+
+
+def find_series_files(directory: str, seriesname: str) -> list:
+    """Collect the files of a ScanImage series in acquisition order.
+
+    Args:
+        directory (str): Directory with the tif files.
+        seriesname (str): Name of the series. Files should follow the format '<series>*.tif'
+
+    Returns:
+        list: Naturally sorted list of file paths.
+    """
+
+    pth = Path(directory)
+    assert pth.exists(), 'Unknown Path!'
+    return ns.natsorted(list(pth.glob('{0}*.tif'.format(seriesname))), alg=ns.PATH)
+
+
+def open_si_series(directory: str, seriesname: str, **kwargs) -> SISeries:
+    """Open all files of a ScanImage series as one virtual stack.
+
+    Args:
+        directory (str): Directory with the tif files.
+        seriesname (str): Name of the series. Files should follow the format '<series>*.tif'
+        **kwargs: Passed on to SISeries.
+
+    Returns:
+        SISeries: Virtual series over all files.
+    """
+
+    return SISeries(find_series_files(directory, seriesname), **kwargs)
@@ -0,0 +1,220 @@
+"""Synthetic ScanImage acquisitions with known motion.
+
+Writes a series of BigTIFF files laid out as ScanImage 2018 writes them: the non-varying header and ROI data follow the
+tif header, and piezo slices and channels are interleaved page by page. The headers parse with scanimage, so the files
+can be read, indexed and registered like recorded data.
+
+Every piezo slice and channel images a static field of randomly placed cells on a smooth background. The field moves
+by a smooth random walk shared by all slices and channels of a volume. Odd lines are offset along x as by a
+bidirectional scan with a line phase error. Shot noise and read noise are added. The motion and line phase that undo
+this are returned as ground truth.
+
+Example:
+    Write 2000 frames of a 2 slice, 2 channel acquisition:
+    ::code-block
+
+        $ truth = make_series(directory, 'bench_', num_volumes=1000, slices=2, channels=(1, 2))
+        $ truth['shifts']  # (volumes, 2) shift in (y,x) that registers each volume
+"""
+
+import struct
+from pathlib import Path
+
+import numpy as np
+
+TIFF_FORMAT_VERSION = 3
+"""int: ScanImage tif file version written, as read by scanimage.si_file_version."""
+
+
+def si_header(frames_per_file: int, slices: int = 1, channels: tuple = (1,), shape: tuple = (512, 512),
+              frame_rate: float = 30.0, bidirectional: bool = True) -> dict:
+    """Returns the non-varying ScanImage header of a synthetic acquisition.
+
+    Args:
+        frames_per_file (int): Number of frames logged per file, every frame holds a page for each channel.
+        slices (int, optional): Defaults to 1. Number of piezo slices.
+        channels (tuple, optional): Defaults to (1,). Saved channels.
+        shape (tuple, optional): Defaults to (512, 512). Frame size (lines, pixels per line).
+        frame_rate (float, optional): Defaults to 30. Frame rate in Hz.
+        bidirectional (bool, optional): Defaults to True. Lines are scanned in both directions.
+
+    Returns:
+        dict: Header keys and values as ScanImage writes them.
+    """
+
+    return {'SI.VERSION_MAJOR': "'2018b'",
+            'SI.TIFF_FORMAT_VERSION': TIFF_FORMAT_VERSION,
+            'SI.hScan2D.logFramesPerFile': frames_per_file,
+            'SI.hScan2D.bidirectional': _matlab(bidirectional),
+            'SI.hFastZ.enable': _matlab(slices > 1),
+            'SI.hFastZ.numFramesPerVolume': slices,
+            'SI.hStackManager.numSlices': slices,
+            'SI.hChannels.channelSave': '[' + ';'.join(str(channel) for channel in channels) + ']',
+            'SI.hRoiManager.linesPerFrame': shape[0],
+            'SI.hRoiManager.pixelsPerLine': shape[1],
+            'SI.hRoiManager.scanFrameRate': frame_rate,
+            'SI.hRoiManager.scanVolumeRate': frame_rate / slices}
+
+
+def write_si_tiff(path_name, frames: np.ndarray, header: dict, first_frame: int = 1) -> None:
+    """Write pages to a ScanImage BigTIFF file.
+
+    Args:
+        path_name (Path): File to write.
+        frames (numpy.ndarray): Pages (z, y, x), written as int16.
+        header (dict): Non-varying ScanImage header, see si_header.
+        first_frame (int, optional): Defaults to 1. Frame number of the first page in the acquisition.
+    """
+
+    frames = np.ascontiguousarray(frames, dtype='<i2')
+    num_pages, shape_y, shape_x = frames.shape
+    static = ''.join(f'{key} = {value}\n' for key, value in header.items()).encode() + b'\0'
+    roi = b'{"RoiGroups": {}}\0'
+    software = (f'SI.LINE_FORMAT_VERSION = 1\nSI.TIFF_FORMAT_VERSION = {TIFF_FORMAT_VERSION}\n'
+                f'SI.VERSION_MAJOR = {header.get("SI.VERSION_MAJOR", "2018b")}\n').encode() + b'\0'
+    frame_period = 1 / float(header.get('SI.hRoiManager.scanFrameRate', 30.0))
+
+    with open(Path(path_name), 'wb') as file:
+        file.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+        file.write(struct.pack('<IIII', 0x07030301, TIFF_FORMAT_VERSION, len(static), len(roi)))
+        file.write(static + roi)
+        pointer_position = 8
+        for page_idx, page in enumerate(frames):
+            frame_number = first_frame + page_idx
+            description = (f'frameNumbers = {frame_number}\nframeNumberAcquisition = {frame_number}\n'
+                           f'frameTimestamps_sec = {(frame_number - 1) * frame_period:.6f}\n').encode() + b'\0'
+            ifd_position = file.tell()
+            tags = [(256, 4, 1, shape_x), (257, 4, 1, shape_y), (258, 3, 1, 16), (259, 3, 1, 1), (262, 3, 1, 1),
+                    (270, 2, len(description), None), (273, 16, 1, None), (277, 3, 1, 1), (278, 4, 1, shape_y),
+                    (279, 16, 1, page.nbytes), (305, 2, len(software), None), (339, 3, 1, 2)]
+            description_offset = ifd_position + 8 + 20 * len(tags) + 8
+            software_offset = description_offset + len(description)
+            data_offset = software_offset + len(software)
+            offsets = {270: description_offset, 273: data_offset, 305: software_offset}
+
+            file.write(struct.pack('<Q', len(tags)))
+            for code, tag_type, count, value in tags:
+                value = offsets.get(code, value)
+                if tag_type == 3:
+                    file.write(struct.pack('<HHQH6x', code, tag_type, count, value))
+                elif tag_type == 4:
+                    file.write(struct.pack('<HHQI4x', code, tag_type, count, value))
+                else:
+                    file.write(struct.pack('<HHQQ', code, tag_type, count, value))
+            next_pointer = file.tell()
+            file.write(struct.pack('<Q', 0))
+            file.write(description + software + page.tobytes())
+            end = file.tell()
+            file.seek(pointer_position)
+            file.write(struct.pack('<Q', ifd_position))
+            file.seek(end)
+            pointer_position = next_pointer
+
+
+def make_series(directory, seriesname: str, num_volumes: int, frames_per_file: int = 500, shape: tuple = (256, 256),
+                slices: int = 1, channels: tuple = (1,), max_shift: float = 4.0, line_phase: float = 1.5,
+                brightness: float = 200.0, read_noise: float = 5.0, num_cells: int = None, seed: int = 0) -> dict:
+    """Write a synthetic ScanImage acquisition with known motion.
+
+    Args:
+        directory (Path): Directory to write the files to, created if it does not exist.
+        seriesname (str): Name of the series, files are named '<seriesname><file #>.tif'.
+        num_volumes (int): Number of volumes, every volume holds a frame of each slice and channel.
+        frames_per_file (int, optional): Defaults to 500. Number of frames logged per file.
+        shape (tuple, optional): Defaults to (256, 256). Frame size (y, x).
+        slices (int, optional): Defaults to 1. Number of piezo slices.
+        channels (tuple, optional): Defaults to (1,). Saved channels.
+        max_shift (float, optional): Defaults to 4. Largest displacement of the field in pixels, relative to the
+            template frames move by up to twice as much.
+        line_phase (float, optional): Defaults to 1.5. Offset in pixels along x of the odd lines.
+        brightness (float, optional): Defaults to 200. Mean photon count of the brightest cells.
+        read_noise (float, optional): Defaults to 5. Standard deviation of the gaussian read noise in counts.
+        num_cells (int, optional): Defaults to None and will place a cell per 400 square pixels. Number of cells in
+            each slice and channel.
+        seed (int, optional): Defaults to 0. Seed of the random number generator.
+
+    Returns:
+        dict: Ground truth, 'shifts' (volumes, 2) the (y,x) shift that registers each volume up to a constant,
+            'phase' the line phase offset to apply to the odd lines, 'files' the paths written and 'header' the
+            ScanImage header.
+    """
+
+    rng = np.random.RandomState(seed)
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    pad = int(np.ceil(max_shift + abs(line_phase))) + 2
+    if num_cells is None:
+        num_cells = max(1, shape[0] * shape[1] // 400)
+    scenes = [[_scene(rng, (shape[0] + 2 * pad, shape[1] + 2 * pad), num_cells, brightness)
+               for _ in channels] for _ in range(slices)]
+    displacement = _random_walk(rng, num_volumes, max_shift)
+
+    header = si_header(frames_per_file, slices=slices, channels=channels, shape=shape)
+    pages_per_file = frames_per_file * len(channels)
+    total_pages = num_volumes * slices * len(channels)
+    files = []
+    for file_start in range(0, total_pages, pages_per_file):
+        pages = np.empty((min(pages_per_file, total_pages - file_start),) + tuple(shape), dtype=np.int16)
+        for page_idx in range(len(pages)):
+            volume, plane = divmod(file_start + page_idx, slices * len(channels))
+            slice_id, channel_idx = divmod(plane, len(channels))
+            intensity = _render(scenes[slice_id][channel_idx], displacement[volume], line_phase, pad, shape)
+            counts = rng.poisson(intensity) + rng.normal(0, read_noise, size=shape)
+            pages[page_idx] = np.clip(np.round(counts), -32768, 32767)
+        files.append(directory.joinpath(f'{seriesname}{len(files) + 1:05d}.tif'))
+        write_si_tiff(files[-1], pages, header, first_frame=file_start // len(channels) + 1)
+
+    return {'shifts': -displacement, 'phase': -line_phase, 'files': files, 'header': header}
+
+
+def _matlab(value: bool) -> str:
+    return 'true' if value else 'false'
+
+
+def _scene(rng: np.random.RandomState, shape: tuple, num_cells: int, brightness: float) -> np.ndarray:
+    """Smooth background with gaussian cells of random size and brightness."""
+
+    grid_y, grid_x = np.mgrid[0:shape[0], 0:shape[1]]
+    scene = 0.1 * brightness * (1 + 0.5 * np.sin(grid_y / shape[0] * 2 * np.pi * rng.uniform(0.5, 2))
+                                * np.cos(grid_x / shape[1] * 2 * np.pi * rng.uniform(0.5, 2)))
+    for center_y, center_x, radius, peak in zip(rng.uniform(0, shape[0], num_cells),
+                                                rng.uniform(0, shape[1], num_cells),
+                                                rng.uniform(2.5, 5, num_cells),
+                                                rng.uniform(0.3, 1, num_cells) * brightness):
+        extent = int(3 * radius) + 1
+        top, left = max(0, int(center_y) - extent), max(0, int(center_x) - extent)
+        bottom, right = min(shape[0], int(center_y) + extent + 1), min(shape[1], int(center_x) + extent + 1)
+        distance = ((grid_y[top:bottom, left:right] - center_y) ** 2 +
+                    (grid_x[top:bottom, left:right] - center_x) ** 2) / (2 * radius ** 2)
+        scene[top:bottom, left:right] += peak * np.exp(-distance)
+    return scene
+
+
+def _random_walk(rng: np.random.RandomState, num_volumes: int, max_shift: float) -> np.ndarray:
+    """Smooth random (y,x) displacement of every volume within max_shift pixels."""
+
+    displacement = np.zeros((num_volumes, 2))
+    velocity = np.zeros(2)
+    position = np.zeros(2)
+    for volume in range(num_volumes):
+        velocity = 0.8 * velocity + rng.normal(0, max(max_shift, 1e-6) / 20, 2)
+        position = np.clip(position + velocity, -max_shift, max_shift)
+        displacement[volume] = position
+    return displacement
+
+
+def _render(scene: np.ndarray, displacement: np.ndarray, line_phase: float, pad: int, shape: tuple) -> np.ndarray:
+    """Bilinearly sample the scene moved by the displacement, with the odd lines offset by the line phase."""
+
+    frame = np.empty(shape)
+    for rows, offset_x in ((slice(0, None, 2), 0.0), (slice(1, None, 2), line_phase)):
+        source_y = pad - displacement[0]
+        source_x = pad - displacement[1] - offset_x
+        top, left = int(np.floor(source_y)), int(np.floor(source_x))
+        fraction_y, fraction_x = source_y - top, source_x - left
+        window = scene[top:top + shape[0] + 1, left:left + shape[1] + 1]
+        frame[rows] = ((1 - fraction_y) * (1 - fraction_x) * window[:-1, :-1] +
+                       (1 - fraction_y) * fraction_x * window[:-1, 1:] +
+                       fraction_y * (1 - fraction_x) * window[1:, :-1] +
+                       fraction_y * fraction_x * window[1:, 1:])[rows]
+    return frame
@@ -0,0 +1,142 @@
+"""Lazy access to multi-page tif stacks.
+
+Provides a stack object that keeps the tif file open and only reads the frames that are asked for. When the page data
+of the file is laid out at a fixed stride (uncompressed, single strip or contiguous strips per page) the stack is
+backed by a memory map, otherwise individual pages are read on demand.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import tifffile
+
+
+class TiffStack(object):
+    """Lazy, indexable view of a multi-page tif file.
+
+    Indexing follows numpy semantics on the (z, y, x) stack, i.e. `stack[10:20]` returns frames 10 to 19. Only the
+    requested frames are read from disk.
+
+    Attributes:
+        path (Path): Path to the tif file.
+        shape (tuple): Shape of the full stack (z, y, x).
+        dtype (numpy.dtype): Data type of the image data.
+    """
+
+    __slots__ = ['path', 'shape', 'dtype', '_tiff', '_memmap']
+
+    def __init__(self, path_name, use_memmap: bool = True) -> None:
+        if not isinstance(path_name, Path):
+            path_name = Path(path_name)
+        assert path_name.exists(), 'File does not exist!'
+        self.path = path_name
+        self._tiff = tifffile.TiffFile(str(path_name))
+        first_page = self._tiff.pages[0]
+        self.dtype = first_page.dtype.newbyteorder(self._tiff.byteorder)
+        self.shape = (len(self._tiff.pages),) + tuple(first_page.shape)
+        self._memmap = self._map_pages() if use_memmap else None
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        if self._memmap is not None:
+            return self._memmap[key]
+
+        if not isinstance(key, tuple):
+            key = (key,)
+        frame_key, pixel_key = key[0], key[1:]
+        if isinstance(frame_key, (int, np.integer)):
+            frame_idx = int(frame_key) + len(self) if frame_key < 0 else int(frame_key)
+            if not 0 <= frame_idx < len(self):
+                raise IndexError(f'Frame {frame_key} is out of range for a stack of {len(self)} frames')
+            frames = self._tiff.pages[frame_idx].asarray()
+            return frames[pixel_key] if pixel_key else frames
+
+        if isinstance(frame_key, slice):
+            frame_list = range(*frame_key.indices(len(self)))
+        else:
+            frame_list = np.arange(len(self))[frame_key]
+        if len(frame_list) == 0:
+            frames = np.empty((0,) + self.shape[1:], dtype=self.dtype)
+        else:
+            frames = self._tiff.asarray(key=list(frame_list))
+            frames = frames.reshape((len(frame_list),) + self.shape[1:])
+        return frames[(slice(None),) + pixel_key] if pixel_key else frames
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def is_memmapped(self) -> bool:
+        """bool: True if frames are served from a memory map."""
+        return self._memmap is not None
+
+    def read(self, start: int = 0, stop: int = None) -> np.ndarray:
+        """Read a contiguous range of frames into memory.
+
+        Args:
+            start (int, optional): Defaults to 0. First frame to read.
+            stop (int, optional): Defaults to None, reading to the end of the stack. Frame to stop reading at.
+
+        Returns:
+            numpy.ndarray: Image data (z, y, x)
+        """
+
+        return np.array(self[start:stop])
+
+    def close(self) -> None:
+        """Release the memory map and close the underlying tif file."""
+
+        self._memmap = None
+        self._tiff.close()
+
+    def page_offsets(self) -> np.ndarray:
+        """Returns the file offset of the image data of every page.
+
+        Returns:
+            numpy.ndarray: Byte offsets (z,), -1 for pages that are compressed or not stored contiguously.
+        """
+
+        page_shape = self.shape[1:]
+        page_bytes = int(np.prod(page_shape)) * self.dtype.itemsize
+        offsets = np.empty(len(self), dtype=np.int64)
+        for idx, page in enumerate(self._tiff.pages):
+            offsets[idx] = _page_offset(page, page_bytes, page_shape)
+        return offsets
+
+    def _map_pages(self):
+        """Memory map the stack if every page is stored uncompressed at a constant stride.
+
+        Returns:
+            numpy.ndarray: Strided view onto a memory map of the file or None if the layout can not be mapped.
+        """
+
+        offsets = self.page_offsets()
+        page_shape = self.shape[1:]
+        page_bytes = int(np.prod(page_shape)) * self.dtype.itemsize
+        stride = int(offsets[1] - offsets[0]) if len(offsets) > 1 else page_bytes
+        if (offsets < 0).any() or stride < page_bytes or (np.diff(offsets) != stride).any():
+            return None
+
+        buffer = np.memmap(self.path, dtype=np.uint8, mode='r', offset=int(offsets[0]),
+                           shape=(stride * (len(offsets) - 1) + page_bytes,))
+        page_strides = np.empty(page_shape, dtype=self.dtype).strides
+        return np.ndarray(shape=self.shape, dtype=self.dtype, buffer=buffer, strides=(stride,) + page_strides)
+
+
+def _page_offset(page, page_bytes: int, page_shape: tuple) -> int:
+    """Returns the file offset of the image data in a page, or -1 if the data can not be memory mapped."""
+
+    if int(page.compression) != 1 or int(getattr(page, 'predictor', 1)) != 1 or tuple(page.shape) != page_shape:
+        return -1
+    offsets, bytecounts = page.dataoffsets, page.databytecounts
+    if sum(bytecounts) != page_bytes:
+        return -1
+    for idx in range(1, len(offsets)):
+        if offsets[idx] != offsets[idx - 1] + bytecounts[idx - 1]:
+            return -1
+    return int(offsets[0])
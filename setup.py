@@ -17,5 +17,5 @@ setup(
     install_requires=required,
     long_description='See ' + 'https://mpif-ic.readthedocs.io',
     license='MIT',
-    python_requires='~=3.7'
+    python_requires='~=3.8'
 )